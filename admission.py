@@ -0,0 +1,258 @@
+from collections import deque
+import asyncio, itertools, threading, time
+from werkzeug.exceptions import TooManyRequests
+from counters import counters
+
+
+def estimate_tokens(raw, body):
+    # what a call may count against a tokens-per-minute limit: its prompt, roughly, plus what it may generate
+    return len(raw) // 4 + (body.get('max_tokens') or 0)
+
+
+class _Usage:
+    # Concurrency and sliding-window tokens of one project or internal API key
+    def __init__(self):
+        self.in_flight = 0
+        self.calls = deque()  # (time, tokens) over the last minute
+        self.tokens = 0
+        self.last_finish = 0.0  # weighted fair queuing finish tag of the newest ticket
+
+    def trim(self, now):
+        while self.calls and self.calls[0][0] < now - 60:
+            self.tokens -= self.calls.popleft()[1]
+
+    def fits(self, max_concurrency, tokens_per_minute, tokens):
+        if max_concurrency and self.in_flight >= max_concurrency:
+            return False
+        # a call bigger than the whole budget still gets through once the window is empty
+        if tokens_per_minute and self.calls and self.tokens + tokens > tokens_per_minute:
+            return False
+        return True
+
+    def frees_at(self, tokens_per_minute, tokens):
+        # when enough of the window has expired for `tokens` more
+        over = self.tokens + tokens - tokens_per_minute
+        for t, n in self.calls:
+            over -= n
+            if over <= 0:
+                return t + 60
+        return self.calls[-1][0] + 60 if self.calls else 0
+
+
+class Ticket:
+    __slots__ = ('project_id', 'internal_api_key_id', 'tokens', 'finish', 'seq', 'limits', 'admitted')
+
+    def __init__(self, entry, tokens, finish, seq):
+        self.project_id = entry.project_id
+        self.internal_api_key_id = entry.internal_api_key_id
+        self.tokens = tokens
+        self.finish = finish
+        self.seq = seq
+        self.limits = (entry.project_max_concurrency, entry.project_tokens_per_minute,
+                       entry.max_concurrency, entry.tokens_per_minute)
+        self.admitted = False
+
+
+class AdmissionScheduler:
+    """Decides when a call may go upstream, so one busy project can't take all capacity.
+
+    Calls wait for a free slot under ADMISSION_MAX_CONCURRENCY (0 means no
+    global cap) and under the max_concurrency and tokens_per_minute of their
+    project and internal API key. Waiting calls are admitted by weighted
+    fair queuing over projects (Project.share_weight), so a project with a
+    thousand queued calls doesn't hold back one with a single call. A call
+    gets a 429 at once when ADMISSION_MAX_QUEUE calls are already waiting,
+    or after waiting ADMISSION_MAX_WAIT seconds. All limits are per worker;
+    with a shared COUNTERS_BACKEND, tokens_per_minute is also checked across
+    workers once a call is admitted here, and a call over it gets a 429.
+    """
+
+    def __init__(self):
+        self.max_concurrency = 0
+        self.max_queue = 100
+        self.max_wait = 30
+        self._cond = threading.Condition()
+        self._async_waiters = []
+        self._seq = itertools.count()
+        self._waiting = []
+        self._in_flight = 0
+        self._virtual_time = 0.0
+        self._projects = {}
+        self._keys = {}
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.rejected_rate = 0
+        self.max_depth = 0
+        self._waits = deque(maxlen=1000)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_MAX_CONCURRENCY', self.max_concurrency)
+        app.config.setdefault('ADMISSION_MAX_QUEUE', self.max_queue)
+        app.config.setdefault('ADMISSION_MAX_WAIT', self.max_wait)
+        self.max_concurrency = app.config['ADMISSION_MAX_CONCURRENCY']
+        self.max_queue = app.config['ADMISSION_MAX_QUEUE']
+        self.max_wait = app.config['ADMISSION_MAX_WAIT']
+
+    def _usage(self, table, id):
+        usage = table.get(id)
+        if usage is None:
+            usage = table[id] = _Usage()
+        return usage
+
+    def _eligible(self, ticket, now):
+        project_concurrency, project_tpm, key_concurrency, key_tpm = ticket.limits
+        project, key = self._projects[ticket.project_id], self._keys[ticket.internal_api_key_id]
+        project.trim(now)
+        key.trim(now)
+        return (project.fits(project_concurrency, project_tpm, ticket.tokens)
+                and key.fits(key_concurrency, key_tpm, ticket.tokens))
+
+    def _next(self, now):
+        # the waiting ticket with the smallest finish tag that its limits allow to run now
+        if self.max_concurrency and self._in_flight >= self.max_concurrency:
+            return None
+        for ticket in sorted(self._waiting, key=lambda t: (t.finish, t.seq)):
+            if self._eligible(ticket, now):
+                return ticket
+        return None
+
+    def _retry_in(self, now):
+        # how long until a token window frees up for someone waiting, if that's what holds them
+        soonest = None
+        for ticket in self._waiting:
+            project_concurrency, project_tpm, key_concurrency, key_tpm = ticket.limits
+            for usage, tpm in ((self._projects[ticket.project_id], project_tpm),
+                               (self._keys[ticket.internal_api_key_id], key_tpm)):
+                if tpm and usage.calls:
+                    at = usage.frees_at(tpm, ticket.tokens)
+                    if at > now:
+                        soonest = at - now if soonest is None else min(soonest, at - now)
+        return soonest
+
+    def _start(self, ticket, now):
+        self._waiting.remove(ticket)
+        ticket.admitted = True
+        self._in_flight += 1
+        self._virtual_time = max(self._virtual_time, ticket.finish)
+        for usage in (self._projects[ticket.project_id], self._keys[ticket.internal_api_key_id]):
+            usage.in_flight += 1
+            usage.calls.append((now, ticket.tokens))
+            usage.tokens += ticket.tokens
+        self.admitted += 1
+
+    def _enqueue(self, entry, tokens):
+        if len(self._waiting) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise TooManyRequests("Too many calls are waiting for capacity, try again shortly")
+        project = self._usage(self._projects, entry.project_id)
+        self._usage(self._keys, entry.internal_api_key_id)
+        finish = max(self._virtual_time, project.last_finish) + max(tokens, 1) / (entry.project_weight or 1)
+        project.last_finish = finish
+        ticket = Ticket(entry, tokens, finish, next(self._seq))
+        self._waiting.append(ticket)
+        self.max_depth = max(self.max_depth, len(self._waiting))
+        return ticket
+
+    def _poll(self, ticket, start):
+        # Admits the ticket if it's its turn. Otherwise -> seconds to wait before trying again.
+        now = time.monotonic()
+        if self._next(now) is ticket:
+            self._start(ticket, now)
+            self._waits.append(now - start)
+            # someone behind us may be able to go as well
+            self._wake()
+            return 0
+        left = start + self.max_wait - now
+        if left <= 0:
+            self._waiting.remove(ticket)
+            self.rejected_timeout += 1
+            self._wake()
+            raise TooManyRequests("Timed out waiting for capacity, try again shortly")
+        retry_in = self._retry_in(now)
+        return min(left, retry_in) if retry_in else left
+
+    def _wake(self):
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._async_waiters.clear()
+
+    def _count_shared(self, ticket):
+        # tokens_per_minute over all workers, in fixed one-minute windows
+        project_concurrency, project_tpm, key_concurrency, key_tpm = ticket.limits
+        limits = [(f'p:{ticket.project_id}', ticket.tokens, project_tpm),
+                  (f'k:{ticket.internal_api_key_id}', ticket.tokens, key_tpm)]
+        limits = [limit for limit in limits if limit[2]]
+        if counters.shared and limits and counters.consume_rate(limits):
+            self.release(ticket)
+            self.rejected_rate += 1
+            raise TooManyRequests("Over the tokens per minute limit, try again shortly")
+        return ticket
+
+    def acquire(self, entry, tokens):
+        # entry is an auth_cache.AuthEntry. Blocks until the call may go upstream.
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(entry, tokens)
+            while True:
+                wait = self._poll(ticket, start)
+                if not wait:
+                    break
+                self._cond.wait(wait)
+        return self._count_shared(ticket)
+
+    async def acquire_async(self, entry, tokens):
+        # acquire() for the asyncio engine (asgi.py); waits without holding a thread
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            ticket = self._enqueue(entry, tokens)
+        while True:
+            event = asyncio.Event()
+            with self._cond:
+                wait = self._poll(ticket, start)
+                if not wait:
+                    return self._count_shared(ticket)
+                self._async_waiters.append((loop, event))
+            try:
+                await asyncio.wait_for(event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, ticket):
+        if ticket is None or not ticket.admitted:
+            return
+        with self._cond:
+            ticket.admitted = False
+            self._in_flight -= 1
+            self._projects[ticket.project_id].in_flight -= 1
+            self._keys[ticket.internal_api_key_id].in_flight -= 1
+            self._wake()
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            now = time.monotonic()
+            projects = {}
+            for project_id, usage in self._projects.items():
+                usage.trim(now)
+                projects[project_id] = {'in_flight': usage.in_flight, 'tokens_last_minute': usage.tokens,
+                                        'waiting': sum(1 for t in self._waiting if t.project_id == project_id)}
+            return {
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._waiting),
+                'max_queue_depth': self.max_depth,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'rejected_rate': self.rejected_rate,
+                'wait_avg': sum(waits) / len(waits) if waits else 0,
+                'wait_p50': waits[len(waits) // 2] if waits else 0,
+                'wait_p95': waits[int(len(waits) * .95)] if waits else 0,
+                'wait_max': waits[-1] if waits else 0,
+                'projects': projects,
+            }
+
+
+admission = AdmissionScheduler()
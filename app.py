@@ -1,26 +1,38 @@
 from collections import defaultdict
-import uuid, requests, random, json
-from flask import Flask, request, redirect, url_for, jsonify, app, render_template, flash, Response, make_response, g
-from flask_admin import Admin
+import uuid, requests, random, json, os, time
+import click
+from flask import Flask, request, redirect, url_for, jsonify, app, render_template, flash, Response, stream_with_context, send_from_directory
+from flask_admin import Admin, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
 from flask_login import LoginManager, current_user, AnonymousUserMixin, login_user, logout_user, login_required
-from flask_migrate import Migrate
+from flask_migrate import Migrate, upgrade
 from models import db, User, Project, APIKey, APIResponse, OpenAIModel, ModelCost, InternalAPIKey
-from werkzeug.exceptions import Unauthorized, Forbidden
+from upstream import upstream
+from spend import spend_ledger
+from usage import project_activity, rebuild_usage_daily
+from archive import create_partitions, archive_partitions
+from export import export, FORMATS
+from response_cache import response_cache
+from coalescer import embedding_coalescer
+from key_scheduler import key_scheduler
+from resilience import resilience
+from admission import admission
+from tracing import tracer
+from proxy_app import configure, init_proxy
+from batches import batch_runner
+from werkzeug.exceptions import Forbidden
 from werkzeug.urls import url_parse
 from forms import LoginForm, ModelCostForm, OpenAIModelForm, ProjectForm, APIKeyForm, APIResponseFilterForm, RegistrationForm
 from datetime import datetime, timedelta
-from functools import wraps
 
 app = Flask(__name__)
-# app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db' # Use SQLite for simplicity
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://myuser:mypassword@db/mydatabase'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+configure(app)
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 TEMPLATES_AUTO_RELOAD = True
-app.config['SECRET_KEY'] = '2e3368c5ee5bd49c9635924c55bd22277bddebcd379c662b'
-
-db.init_app(app)
+# off for an admin role that leaves the /v1/* calls to proxy workers (proxy_app.py)
+app.config.setdefault('PROXY_ROUTES', True)
+if app.config['PROXY_ROUTES']:
+    init_proxy(app)
 
 migrate = Migrate(app, db)
 
@@ -43,16 +55,79 @@ class ProjectAdminModelView(ModelView):
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for('login'))
 
-with app.app_context():
-    db.create_all()
-    admin = Admin(app, name='API Proxy', template_mode='bootstrap3')
-    admin.add_view(AdminModelView(User, db.session))
-    admin.add_view(ProjectAdminModelView(APIKey, db.session, name="Open API Keys"))
-    admin.add_view(ProjectAdminModelView(Project, db.session,))
-    admin.add_view(ProjectAdminModelView(APIResponse, db.session, name="API Responses"))
-    admin.add_view(ProjectAdminModelView(OpenAIModel, db.session, name="OpenAI Model"))
-    admin.add_view(ProjectAdminModelView(ModelCost, db.session, name="Model cost"))
-    admin.add_view(ProjectAdminModelView(InternalAPIKey, db.session, name="Internal API Key"))
+class APIResponseAdminView(ProjectAdminModelView):
+    # Lists without the request/response bodies (deferred on the model, loaded when a
+    # record is opened) and pages by (time_created, id) instead of OFFSET
+    list_template = 'admin/api_response_list.html'
+    column_list = ('time_created', 'internal_api_key', 'model_name', 'tokens_in', 'tokens_out', 'in_cost', 'out_cost', 'cached')
+    column_details_list = column_list + ('request', 'response')
+    column_formatters_detail = {'request': lambda v, c, m, n: m.get_request(),
+                                'response': lambda v, c, m, n: m.get_response()}
+    column_filters = ('model_name', 'internal_api_key_id', 'time_created', 'cached')
+    column_default_sort = [('time_created', True), ('id', True)]
+    can_view_details = True
+    simple_list_pager = True  # no count(*) over the whole table
+
+    def _keyset(self):
+        # -> (time_created, id) of the last row of the previous page, when paging in the default order
+        after = request.args.get('after')
+        if not after or request.args.get('sort') is not None:
+            return None
+        try:
+            time_created, id = after.rsplit(',', 1)
+            return datetime.fromisoformat(time_created), int(id)
+        except ValueError:
+            return None
+
+    def _apply_pagination(self, query, page, page_size):
+        keyset = self._keyset()
+        if keyset is None:
+            return super()._apply_pagination(query, page, page_size)
+        query = query.filter(db.tuple_(APIResponse.time_created, APIResponse.id) < keyset)
+        return query.limit(page_size if page_size is not None else self.page_size)
+
+    def keyset_url(self, data, page_size):
+        # link to the page after data, None on the last page; data None links to the first page
+        args = {k: v for k, v in request.args.items() if k not in ('page', 'after')}
+        if data is None:
+            return url_for('.index_view', **args)
+        if request.args.get('sort') is not None or not data or len(data) < page_size:
+            return None
+        last = data[-1]
+        return url_for('.index_view', **args, after=f'{last.time_created.isoformat()},{last.id}')
+
+class SlowRequestsView(BaseView):
+    @expose('/')
+    def index(self):
+        return self.render('admin/slow_requests.html', requests=reversed(tracer.slow), slow_ms=tracer.slow_ms,
+                           profiling=tracer.profiling(), profiles=tracer.profiles())
+
+    @expose('/profile', methods=['POST'])
+    def profile(self):
+        tracer.profile_next(request.form.get('requests', 0, type=int))
+        return redirect(url_for('.index'))
+
+    @expose('/profile/<filename>')
+    def download(self, filename):
+        return send_from_directory(tracer.profile_dir, filename, as_attachment=True)
+
+    def is_accessible(self):
+        if current_user.get_id() == None:
+            return False
+        return current_user.is_authenticated and current_user.is_admin
+    def inaccessible_callback(self, name, **kwargs):
+        return redirect(url_for('login'))
+
+# the schema is created by `flask init-db`, not on import, so a worker can start while the db is down
+admin = Admin(app, name='API Proxy', template_mode='bootstrap3')
+admin.add_view(AdminModelView(User, db.session))
+admin.add_view(ProjectAdminModelView(APIKey, db.session, name="Open API Keys"))
+admin.add_view(ProjectAdminModelView(Project, db.session,))
+admin.add_view(APIResponseAdminView(APIResponse, db.session, name="API Responses"))
+admin.add_view(ProjectAdminModelView(OpenAIModel, db.session, name="OpenAI Model"))
+admin.add_view(ProjectAdminModelView(ModelCost, db.session, name="Model cost"))
+admin.add_view(ProjectAdminModelView(InternalAPIKey, db.session, name="Internal API Key"))
+admin.add_view(SlowRequestsView(name="Slow requests", endpoint='slow_requests'))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -78,7 +153,8 @@ def home():
     models = OpenAIModel.query.all()
     users = User.query.all()
     print(users)
-    return render_template('home.html', projects=projects, api_keys=api_keys, models=models, users=users)
+    return render_template('home.html', projects=projects, api_keys=api_keys, models=models, users=users,
+                           key_stats=key_scheduler.stats())
 
 
 @app.route('/test')
@@ -115,16 +191,19 @@ def register():
 def new_project():
     form = ProjectForm()
     form.api_key.choices = [(key.id, key.name) for key in APIKey.query.filter(APIKey.user_id == current_user.id).all()]
+    form.extra_api_keys.choices = form.api_key.choices
     form.users.choices = [(user.id, user.username) for user in User.query.all()]
     form.project_leads.choices = [(user.id, user.username) for user in User.query.all()]
     form.allowed_models.choices = [(model.id, model.name) for model in OpenAIModel.query.all()]
     form.spending_limit.data = 0
     if form.validate_on_submit():
-        project = Project(name=form.name.data, spending_limit=form.spending_limit.data)
+        project = Project(name=form.name.data, spending_limit=form.spending_limit.data, payload_policy=form.payload_policy.data,
+                          response_cache_enabled=form.response_cache_enabled.data)
         project.users = User.query.filter(User.id.in_(form.users.data)).all()
         project.project_leads = User.query.filter(User.id.in_(form.project_leads.data)).all()
         project.allowed_models = OpenAIModel.query.filter(OpenAIModel.id.in_(form.allowed_models.data)).all()
         project.api_key_id = form.api_key.data
+        project.api_keys = APIKey.query.filter(APIKey.id.in_(form.extra_api_keys.data or [])).all()
         db.session.add(project)
         db.session.commit()
         all_users = []
@@ -166,7 +245,7 @@ def new_api_key():
         api_key = form.key_string.data
         headers = {"Authorization": f"Bearer {api_key}"}
         data = {"input": "test", "model": "text-embedding-ada-002"}
-        response = requests.post('https://api.openai.com/v1/embeddings', headers=headers, json=data)
+        response = upstream.post('v1/embeddings', None, headers=headers, json=data)
         if response.status_code != 200:
             flash('Error: {}'.format(response.json()['error']), 'error')
             return redirect(url_for('new_api_key'))
@@ -199,53 +278,10 @@ def api_responses(project_id):
     all_users = list(set(all_users))  # remove potential duplicates
     form = APIResponseFilterForm()
     form.users.choices = [(u.id, u.username) for u in all_users]
-    responses = {}
-    total_costs = {'tokens_in': 0, 'tokens_out': 0}  # to store total costs
-    model_costs = defaultdict(lambda: {'tokens_in': 0, 'tokens_out': 0})  # to store costs per model
+    responses, total_costs, model_costs = {}, {'tokens_in': 0, 'tokens_out': 0}, {}
     if request.method == 'POST':
-        start_date = form.start_date.data
-        end_date = form.end_date.data
-        users = [int(n) for n in form.users.data]
-        model_name = None
-        # Get the projects associated with the given user (or all projects if no user is specified)
-        key_filters = []
-        if users != []:
-            key_filters.append(InternalAPIKey.user_id.in_(form.users.data))
-        internal_api_keys = project.internal_api_keys.all() if len(key_filters) == 0 else project.internal_api_keys.filter(*key_filters).all()
-        api_response_filters = []
-        if start_date:
-            api_response_filters.append(APIResponse.time_created >= start_date)
-        if end_date:
-            api_response_filters.append(APIResponse.time_created <= end_date)
-        if model_name:  # filter api responses by model name if given
-            api_response_filters.append(APIResponse.model_name == model_name)
-        for internal_api_key in internal_api_keys:
-            # Get the API responses for the key within the date range
-            api_responses = internal_api_key.api_responses.filter(*api_response_filters).all()
-            for api_response in api_responses:
-                # Aggregate the data by day, user and model
-                day = api_response.time_created.strftime('%Y-%m-%d')
-                username = api_response.internal_api_key.user.username
-                model_name = api_response.model_name
-                if day not in responses:
-                    responses[day] = {
-                        'total': {'tokens_in': 0, 'tokens_out': 0, 'cost': {'in_cost': 0, 'out_cost': 0}},
-                        'users': defaultdict(lambda: defaultdict(lambda: {'tokens_in': 0, 'tokens_out': 0, 'cost': {'in_cost': 0, 'out_cost': 0}}))
-                    }
-                responses[day]['users'][username][model_name]['tokens_in'] += api_response.tokens_in
-                responses[day]['users'][username][model_name]['tokens_out'] += api_response.tokens_out
-                cost = api_response.get_costs()  # calculate cost
-                if cost is not None:  # if costs could be calculated
-                    responses[day]['users'][username][model_name]['cost']['in_cost'] += cost['in_cost']
-                    responses[day]['users'][username][model_name]['cost']['out_cost'] += cost['out_cost']
-                    responses[day]['total']['tokens_in'] += api_response.tokens_in
-                    responses[day]['total']['tokens_out'] += api_response.tokens_out
-                    responses[day]['total']['cost']['in_cost'] += cost['in_cost']
-                    responses[day]['total']['cost']['out_cost'] += cost['out_cost']
-                    total_costs['tokens_in'] += cost['in_cost']  # sum total costs
-                    total_costs['tokens_out'] += cost['out_cost']
-                    model_costs[model_name]['tokens_in'] += cost['in_cost']  # sum costs per model
-                    model_costs[model_name]['tokens_out'] += cost['out_cost']
+        users = [int(n) for n in form.users.data or []]
+        responses, total_costs, model_costs = project_activity(project, users, form.start_date.data, form.end_date.data)
     return render_template('project_activity.html', form=form, responses=responses, total_costs=total_costs, model_costs=model_costs)
 
 
@@ -293,112 +329,82 @@ def delete_cost(cost_id):
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+@app.route('/api_response/<int:api_response_id>/payload')
+@login_required
+def api_response_payload(api_response_id):
+    if not (current_user.is_admin or current_user.is_project_admin):
+        raise Forbidden("Only admins can read request and response bodies")
+    api_response = db.session.get(APIResponse, api_response_id)
+    if api_response is None:
+        return jsonify({'error': 'No such API response'}), 404
+    return jsonify({'request': api_response.get_request(), 'response': api_response.get_response()})
+
+@app.route('/api_responses/export')
+@login_required
+def export_api_responses():
+    # ?format=ndjson|csv&project_id=&user_id=&model=&start=YYYY-MM-DD&end=YYYY-MM-DD&payloads=1&gzip=1
+    if not (current_user.is_admin or current_user.is_project_admin):
+        raise Forbidden("Only admins can export API responses")
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(FORMATS)}"}), 400
+    try:
+        start, end = (datetime.strptime(request.args[d], '%Y-%m-%d') if request.args.get(d) else None
+                      for d in ('start', 'end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates like 2023-07-31'}), 400
+    project_id = request.args.get('project_id', type=int)
+    gzip = request.args.get('gzip') == '1'
+    chunks = export(fmt, payloads=request.args.get('payloads') == '1', gzip=gzip,
+                    project_ids=None if project_id is None else [project_id],
+                    user_id=request.args.get('user_id', type=int), model=request.args.get('model'),
+                    start=start, end=end)
+    headers = {'Content-Disposition': f'attachment; filename=api_responses.{fmt}'}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    # no Content-Length: the body goes out with chunked transfer encoding as it is read
+    return Response(stream_with_context(chunks), content_type=FORMATS[fmt], headers=headers)
+
+@app.route('/upstream/stats')
+@login_required
+def upstream_stats():
+    if not current_user.is_admin:
+        raise Forbidden("Only admins can see upstream pool statistics")
+    return jsonify(upstream.stats())
+
+@app.route('/upstream/resilience/stats')
+@login_required
+def upstream_resilience_stats():
+    if not current_user.is_admin:
+        raise Forbidden("Only admins can see upstream circuit and hedging statistics")
+    return jsonify(resilience.stats())
+
+@app.route('/embeddings/coalescer/stats')
+@login_required
+def embedding_coalescer_stats():
+    if not current_user.is_admin:
+        raise Forbidden("Only admins can see coalescer statistics")
+    return jsonify(embedding_coalescer.stats())
+
+@app.route('/admission/stats')
+@login_required
+def admission_stats():
+    if not current_user.is_admin:
+        raise Forbidden("Only admins can see admission statistics")
+    return jsonify(admission.stats())
+
+@app.route('/response_cache/stats')
+@login_required
+def response_cache_stats():
+    if not current_user.is_admin:
+        raise Forbidden("Only admins can see response cache statistics")
+    return jsonify(response_cache.stats())
+
 @app.route('/api_key/<int:api_key_id>')
 def api_key(api_key_id):
     iak = db.session.get(InternalAPIKey, api_key_id)
     return jsonify(iak.project.model_names())
 
-##### This is to handle the logic of the actual end points
-
-@app.errorhandler(Unauthorized)
-def handle_unauthorized(e):
-    return jsonify({'error': str(e)}), 401
-
-@app.errorhandler(Forbidden)
-def handle_forbidden(e):
-    return jsonify({'error': str(e)}), 403
-
-## function for creating APIResponse objects for db 
-def save_api_call_and_response(the_request, the_response):
-    req_json = the_request.get_json()
-    resp_json = the_response.json()
-    model_name = req_json['model']
-    tokens_in = resp_json['usage'].get('prompt_tokens', 0)
-    tokens_out = resp_json['usage'].get('completion_tokens', 0)
-    internal_api_key_id = g.internal_api_key_id
-    api_response = APIResponse(model_name=model_name, 
-                               tokens_in=tokens_in, 
-                               tokens_out=tokens_out, 
-                               internal_api_key_id=internal_api_key_id, 
-                               request=req_json,
-                               response=resp_json)
-    api_response.update_cost()
-    db.session.add(api_response)
-    db.session.commit()
-
-### route wrapper for checking if API key is current, can use the model, and has money
-def require_api_key(view_function):
-    @wraps(view_function)
-    def decorator(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        token = None
-        if not auth_header:
-            raise Unauthorized('No Authorization header')
-        try:
-            auth_type, token = auth_header.split()
-            if auth_type.lower() != 'bearer':
-                raise Unauthorized('Invalid Authorization type')
-        except ValueError:
-            raise Unauthorized('Invalid Authorization header')
-        print(InternalAPIKey.query.count()) 
-        for ik in InternalAPIKey.query.all():
-            print("key1", ik.internal_api_key_string)
-        # ik = InternalAPIKey.get_by_string(token)
-        ik = InternalAPIKey.query.filter(InternalAPIKey.internal_api_key_string==token).first()
-        g.internal_api_key_id = ik.id
-        if not ik.is_current():
-            raise Forbidden("Your API key is not current")
-        proj = ik.project
-        print("1")
-        if proj.total_spent > proj.spending_limit * .98 and proj.spending_limit != 0:
-            raise Forbidden("Your project is out of money")
-        print("2")
-        if ik.total_spent > ik.spending_limit * .98 and ik.spending_limit != 0:
-            raise Forbidden("Your API key is out of money")
-        print("3")
-        print("3a")
-        # if (model_name := request.get_json()['model']) not in ik.project.model_names():
-        #     print(request.get_json()['model'], ik.project.model_names())
-        #     raise Forbidden(f"Your API key does not have access to the model {model_name}")
-        # if you have lived a good life and made it this far, we send the request to OpenAI with the real APIKey
-        print("4")
-        api_key = APIKey.query.filter(APIKey.id == proj.api_key_id).first().key_string
-
-        print("test", api_key)
-        print("----")
-        request.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        print(request.headers)
-        return view_function(*args, **kwargs)
-    return decorator
-
-# don't think I'm using this.. just had to special case out tokens in save_api_call
-# @require_api_key
-# def completions():
-#     url = f"https://api.openai.com/{request.url_rule.endpoint}"
-#     resp = requests.post(url, headers=request.headers, data=request.data)
-#     save_api_call_and_response(request, resp)
-#     return resp.json(), 200
-
-# one endpoint to rule them all
-@app.route('/v1/chat/completions', methods=['POST', 'GET'], endpoint='v1/chat/completions')
-@app.route('/v1/completions', methods=['POST'], endpoint='v1/completions')
-@app.route('/v1/embeddings', methods=['POST'], endpoint='v1/embeddings')
-@require_api_key
-def open_ai_call():
-    if request.method == 'GET':
-        return jsonify("hello")
-    url = f"https://api.openai.com/{request.url_rule.endpoint}"
-    print(request.json)
-    resp = requests.post(url, headers=request.headers, data=request.data)
-    print(resp.json())
-    save_api_call_and_response(request, resp)
-    # return jsonify("Hep")
-    return resp.json(), 200
-
-
 def generate_random_time():
     start_date = datetime(2023, 6, 1)
     end_date = datetime(2023, 7, 27)
@@ -430,10 +436,75 @@ def add_test_data():
             in_tokens = random.randint(5, 400)
             out_tokens = random.randint(5, 400)
             response = APIResponse(model_name = model_name, tokens_in = in_tokens, tokens_out = out_tokens, internal_api_key_id = ik.id, time_created = generate_random_time())
+            cost = response.get_costs()
+            if cost:
+                response.in_cost, response.out_cost = cost['in_cost'], cost['out_cost']
             db.session.add(response)
             db.session.commit()
+    rebuild_usage_daily()
+    db.session.commit()
     return redirect(url_for('home'))
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the tables, then apply the migrations (they skip what already exists)."""
+    db.create_all()
+    upgrade()
+
+@app.cli.command('batch-worker')
+@click.option('--once', is_flag=True, help='Exit when no batch job is left instead of waiting for more.')
+def batch_worker_command(once):
+    """Run uploaded batch jobs (POST /v1/batches)."""
+    batch_runner.run_forever(once)
+
+@app.cli.command('update-spending')
+def update_spending_command():
+    """Recompute every project's spend totals from its saved API calls."""
+    spend_ledger.recompute()
+
+@app.cli.command('rebuild-usage-daily')
+def rebuild_usage_daily_command():
+    """Recompute the usage_daily rollup from api_response."""
+    print(f"Rebuilt {rebuild_usage_daily()} usage_daily rows")
+    db.session.commit()
+
+@app.cli.group()
+def partitions():
+    """Manage the monthly partitions of api_response."""
+
+@partitions.command('create')
+@click.option('--months-ahead', default=3, help='Create partitions up to this many months from now.')
+def create_partitions_command(months_ahead):
+    """Create upcoming monthly partitions (PostgreSQL only)."""
+    for name in create_partitions(months_ahead):
+        print(f"Created {name}")
+    db.session.commit()
+
+@partitions.command('archive')
+@click.option('--retention-months', default=12, help='Keep this many months (plus the current one) in the database.')
+@click.option('--out-dir', default='archive', help='Where the archive files are written.')
+@click.option('--format', 'fmt', type=click.Choice(['parquet', 'arrow']), default='parquet')
+def archive_partitions_command(retention_months, out_dir, fmt):
+    """Export old months to columnar files, then drop them from api_response."""
+    for name, path, rows in archive_partitions(retention_months, os.path.abspath(out_dir), fmt):
+        print(f"Archived {rows} rows of {name} to {path}")
+
+@app.cli.command('export-api-responses')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='ndjson')
+@click.option('--project-id', type=int, multiple=True, help='Only these projects (repeatable).')
+@click.option('--user-id', type=int)
+@click.option('--model')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), help='First day to include.')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), help='Last day to include.')
+@click.option('--payloads', is_flag=True, help='Include request and response bodies.')
+@click.option('--gzip', is_flag=True)
+@click.option('--out', type=click.File('wb', lazy=False), default='-', help='File to write to (default: stdout).')
+def export_api_responses_command(fmt, project_id, user_id, model, start, end, payloads, gzip, out):
+    """Stream saved API calls as NDJSON or CSV."""
+    for chunk in export(fmt, payloads=payloads, gzip=gzip, project_ids=list(project_id) or None, user_id=user_id,
+                        model=model, start=start, end=end):
+        out.write(chunk)
+
 @app.route('/delete_and_init_db')
 def init_db():
     with app.app_context():
@@ -0,0 +1,226 @@
+"""Monthly partitions of api_response and archival of old months to columnar files.
+
+On PostgreSQL api_response is range partitioned by month on time_created
+(see migration 0002). create_partitions() adds upcoming months, and
+archive_partitions() exports months older than the retention window to
+Parquet or Arrow IPC files, then detaches and drops them. On other
+databases the same months are exported and their rows deleted.
+
+The archived months stay visible through the readers at the bottom:
+archived_spend() for Project.update_spending and archived_usage() for
+rebuild_usage_daily(). Both need pyarrow.
+"""
+from datetime import datetime
+import json, os
+from sqlalchemy import text
+from models import db, APIResponse, ArchivedPartition
+
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+def add_months(dt, n):
+    month = dt.month - 1 + n
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+def partition_name(start):
+    return f'api_response_y{start.year}m{start.month:02d}'
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise RuntimeError('Archiving api_response needs pyarrow (pip install pyarrow)')
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def existing_partitions():
+    # name -> range start, for the monthly partitions of api_response
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'api_response'")).scalars()
+    partitions = {}
+    for name in rows:
+        if name.startswith('api_response_y'):
+            partitions[name] = datetime(int(name[14:18]), int(name[19:21]), 1)
+    return partitions
+
+
+def create_partitions(months_ahead=3, since=None):
+    # Creates the monthly partitions from `since` (default: this month) up to months_ahead from now
+    if not _is_postgres():
+        return []
+    existing = existing_partitions()
+    start = month_start(since or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), months_ahead)
+    created = []
+    while start <= last:
+        name = partition_name(start)
+        if name not in existing:
+            end = add_months(start, 1)
+            # rows may already sit in the default partition; move them before attaching
+            db.session.execute(text(f"CREATE TABLE {name} (LIKE api_response INCLUDING DEFAULTS)"))
+            db.session.execute(text(
+                f"WITH moved AS (DELETE FROM api_response_default "
+                f"WHERE time_created >= '{start:%Y-%m-%d}' AND time_created < '{end:%Y-%m-%d}' RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"))
+            db.session.execute(text(
+                f"ALTER TABLE api_response ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"))
+            created.append(name)
+        start = add_months(start, 1)
+    return created
+
+
+def _arrow_schema(pa):
+    fields = []
+    for column in APIResponse.__table__.columns:
+        t = column.type
+        if isinstance(t, db.DateTime):
+            pa_type = pa.timestamp('us')
+        elif isinstance(t, db.Integer):
+            pa_type = pa.int64()
+        elif isinstance(t, db.Float):
+            pa_type = pa.float64()
+        elif isinstance(t, db.Boolean):
+            pa_type = pa.bool_()
+        elif isinstance(t, db.LargeBinary):
+            pa_type = pa.binary()
+        else:  # strings, and JSON bodies as JSON text
+            pa_type = pa.string()
+        fields.append(pa.field(column.name, pa_type))
+    return pa.schema(fields)
+
+
+def export_month(start, out_dir, fmt='parquet', chunk_size=50000):
+    # Streams one month of api_response to a zstd-compressed file. Returns (path, rows).
+    pa = _pyarrow()
+    schema = _arrow_schema(pa)
+    json_columns = [c.name for c in APIResponse.__table__.columns if isinstance(c.type, db.JSON)]
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f'{partition_name(start)}.{FORMATS[fmt]}')
+    tmp = path + '.tmp'
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(tmp, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(tmp, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    table = APIResponse.__table__
+    query = table.select().where(table.c.time_created >= start, table.c.time_created < add_months(start, 1))
+    rows = 0
+    with writer:
+        result = db.session.connection().execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for chunk in result.mappings().partitions():
+            records = [dict(r) for r in chunk]
+            for r in records:
+                for c in json_columns:
+                    if r[c] is not None:
+                        r[c] = json.dumps(r[c])
+            writer.write_batch(pa.RecordBatch.from_pylist(records, schema=schema))
+            rows += len(records)
+    os.replace(tmp, path)
+    return path, rows
+
+
+def archive_partitions(retention_months, out_dir, fmt='parquet'):
+    # Exports and drops every month that ended before the retention window. Commits per month.
+    cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+    if _is_postgres():
+        months = sorted(start for start in existing_partitions().values() if add_months(start, 1) <= cutoff)
+    else:
+        oldest = db.session.query(db.func.min(APIResponse.time_created)).scalar()
+        months = []
+        start = month_start(oldest) if oldest else cutoff
+        while start < cutoff:
+            months.append(start)
+            start = add_months(start, 1)
+    archived = []
+    for start in months:
+        name = partition_name(start)
+        if db.session.query(ArchivedPartition).filter_by(name=name).first():
+            continue
+        path, rows = export_month(start, out_dir, fmt)
+        if _is_postgres():
+            db.session.execute(text(f'ALTER TABLE api_response DETACH PARTITION {name}'))
+            db.session.execute(text(f'DROP TABLE {name}'))
+        else:
+            db.session.query(APIResponse).filter(APIResponse.time_created >= start,
+                                                 APIResponse.time_created < add_months(start, 1)) \
+                .delete(synchronize_session=False)
+        if rows:
+            db.session.add(ArchivedPartition(name=name, range_start=start, range_end=add_months(start, 1),
+                                             path=path, format=fmt, row_count=rows))
+            archived.append((name, path, rows))
+        else:
+            os.remove(path)
+        db.session.commit()
+    return archived
+
+
+##### readers over the archived months
+
+def _dataset(start=None, end=None):
+    query = db.session.query(ArchivedPartition)
+    if start:
+        query = query.filter(ArchivedPartition.range_end > start)
+    if end:
+        query = query.filter(ArchivedPartition.range_start <= end)
+    archives = query.all()
+    if not archives:
+        return None
+    _pyarrow()
+    import pyarrow.dataset as ds
+    # a month is archived in one format; group in case the format was changed over time
+    datasets = [ds.dataset([a.path for a in archives if a.format == fmt], format='parquet' if fmt == 'parquet' else 'ipc')
+                for fmt in {a.format for a in archives}]
+    return datasets[0] if len(datasets) == 1 else ds.dataset(datasets)
+
+
+def archived_spend(internal_api_key_ids=None):
+    # internal_api_key_id -> summed in_cost + out_cost of the archived months
+    dataset = _dataset()
+    if dataset is None:
+        return {}
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    expr = None
+    if internal_api_key_ids is not None:
+        expr = ds.field('internal_api_key_id').isin(list(internal_api_key_ids))
+    table = dataset.to_table(columns=['internal_api_key_id', 'in_cost', 'out_cost'], filter=expr)
+    cost = pc.add(pc.fill_null(table['in_cost'], 0.0), pc.fill_null(table['out_cost'], 0.0))
+    table = table.append_column('cost', cost).group_by('internal_api_key_id').aggregate([('cost', 'sum')])
+    return dict(zip(table['internal_api_key_id'].to_pylist(), table['cost_sum'].to_pylist()))
+
+
+def archived_usage(start=None, end=None):
+    # usage_daily shaped rows (see usage.py) for the archived months
+    dataset = _dataset(start, end)
+    if dataset is None:
+        return []
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    expr = None
+    if start:
+        expr = ds.field('time_created') >= pa.scalar(start, pa.timestamp('us'))
+    if end:
+        upper = ds.field('time_created') <= pa.scalar(end, pa.timestamp('us'))
+        expr = upper if expr is None else expr & upper
+    table = dataset.to_table(columns=['time_created', 'internal_api_key_id', 'model_name',
+                                      'tokens_in', 'tokens_out', 'in_cost', 'out_cost'], filter=expr)
+    table = table.append_column('day', pc.cast(table['time_created'], pa.date32()))
+    table = table.group_by(['day', 'internal_api_key_id', 'model_name']).aggregate(
+        [('model_name', 'count'), ('tokens_in', 'sum'), ('tokens_out', 'sum'), ('in_cost', 'sum'), ('out_cost', 'sum')])
+    return [dict(day=r['day'], internal_api_key_id=r['internal_api_key_id'], model_name=r['model_name'],
+                 requests=r['model_name_count'], tokens_in=r['tokens_in_sum'] or 0, tokens_out=r['tokens_out_sum'] or 0,
+                 in_cost=r['in_cost_sum'] or 0, out_cost=r['out_cost_sum'] or 0,
+                 cached_requests=0, saved_cost=0)  # cache savings aren't kept for archived months
+            for r in table.to_pylist()]
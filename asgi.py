@@ -0,0 +1,241 @@
+"""Asyncio engine for the /v1/* proxy routes, with the Flask app mounted for everything else.
+
+    pip install uvicorn httpx a2wsgi
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker asgi:app
+
+A call waiting on upstream holds a coroutine instead of a worker thread, so
+one process can carry thousands of them. Auth, admission, key scheduling,
+the response cache and saving the call work as in open_ai_call. Steps that
+may block (auth cache misses, the spend check on shared counters and its
+worst-case price lookup, response cache reads and writes, and handing the
+row to api_response_writer, which may journal, wait for room or insert it
+itself) run in threads, inside the Flask app context.
+"""
+import asyncio, json, time
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException, BadRequest
+from app import app as flask_app
+from auth_cache import auth_cache
+from spend import spend_ledger
+from admission import admission, estimate_tokens
+from key_scheduler import key_scheduler
+from coalescer import embedding_coalescer
+from response_cache import response_cache, cache_key, is_cacheable
+from upstream import async_upstream
+from write_behind import api_response_writer
+from metrics import metrics
+from tracing import tracer, phase
+from proxy import bearer_token, check_api_key, cache_ttl, api_call_record, count_usage, hedge_recorder, streamed_request, \
+    StreamUsage, forwarded_headers
+
+PROXY_PATHS = {'/v1/chat/completions': 'v1/chat/completions',
+               '/v1/completions': 'v1/completions',
+               '/v1/embeddings': 'v1/embeddings'}
+
+wsgi = WSGIMiddleware(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in PROXY_PATHS:
+        return await proxy(scope, receive, send, PROXY_PATHS[scope['path']])
+    return await wsgi(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_upstream.aclose()
+            await asyncio.to_thread(api_response_writer.stop)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def respond(send, status, body, content_type=b'application/json', headers=None):
+    if headers is None:
+        headers = [(b'content-type', content_type)]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [*headers, (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def in_app_context(function, *args):
+    with flask_app.app_context():
+        return function(*args)
+
+
+def _reserve(ik, endpoint, req_json):
+    return spend_ledger.reserve(ik, spend_ledger.worst_case(endpoint, req_json))
+
+
+def _save(ik, record):
+    count_usage(ik, record)
+    api_response_writer.submit(record)
+
+
+async def save(ik, record):
+    await asyncio.to_thread(in_app_context, _save, ik, record)
+
+
+async def release(ik, reservation):
+    if reservation:
+        await asyncio.to_thread(spend_ledger.release, ik.internal_api_key_id, ik.project_id, reservation)
+
+
+async def authorize(headers):
+    token = bearer_token(headers.get(b'authorization', b'').decode('latin-1'))
+    ik = auth_cache.peek(token)
+    if ik is None:
+        ik = await asyncio.to_thread(in_app_context, auth_cache.get, token)
+    check_api_key(ik)
+    return ik
+
+
+async def proxy(scope, receive, send, endpoint):
+    started = time.perf_counter()
+    metrics.request_started(endpoint)
+    trace = tracer.start()
+    call = {'project': None, 'model': None, 'status': 500, 'finished': False}
+
+    def finish():
+        # counted when the response starts, as the Flask views do
+        if not call['finished']:
+            call['finished'] = True
+            metrics.request_finished(endpoint, call['project'], call['model'], call['status'],
+                                     time.perf_counter() - started)
+            tracer.finish(trace, endpoint, call['project'], call['model'], call['status'])
+
+    async def send_and_count(message):
+        if message['type'] == 'http.response.start':
+            call['status'] = message['status']
+            message = {**message, 'headers': [*message['headers'], (b'server-timing', trace.server_timing().encode())]}
+            finish()
+        await send(message)
+
+    try:
+        await handle(scope, receive, send_and_count, endpoint, started, call)
+    finally:
+        finish()
+
+
+async def handle(scope, receive, send, endpoint, started, call):
+    reservation = 0
+    ik = None
+    try:
+        with phase('auth'):
+            ik = await authorize(dict(scope['headers']))
+        metrics.observe_auth(time.perf_counter() - started)
+        call['project'] = ik.project_name
+        body = await read_body(receive)
+        try:
+            req_json = json.loads(body)
+        except ValueError:
+            raise BadRequest('The request body is not valid JSON')
+        call['model'] = req_json.get('model')
+        # checks committed spend plus what in-flight calls have reserved, and reserves this call's worst case
+        with phase('spend'):
+            reservation = await asyncio.to_thread(in_app_context, _reserve, ik, endpoint, req_json)
+        if req_json.get('stream'):
+            # stream_call settles the reservation itself
+            reservation, held = 0, reservation
+            return await stream_call(send, endpoint, ik, body, req_json, held)
+        key = None
+        ttl = cache_ttl(ik)
+        if ttl is not None and is_cacheable(endpoint, req_json):
+            key = cache_key(ik.project_id, endpoint, req_json)
+            with phase('cache'):
+                cached = await asyncio.to_thread(in_app_context, response_cache.get, key)
+            if cached is not None:
+                with phase('save'):
+                    await save(ik, api_call_record(ik, req_json, cached, reservation, cached=True))
+                reservation = 0
+                return await respond(send, 200, cached)
+        resp = None
+        on_hedge = hedge_recorder(flask_app, ik, req_json)
+        with phase('queue'):
+            ticket = await admission.acquire_async(ik, estimate_tokens(body, req_json))
+        upstream_started = time.perf_counter()
+        try:
+            with phase('upstream'):
+                if endpoint == 'v1/embeddings' and embedding_coalescer.enabled:
+                    # the coalescer batches across threads, so it gets one
+                    resp = await asyncio.to_thread(embedding_coalescer.post, endpoint, ik.api_keys, req_json, on_hedge)
+                if resp is None:
+                    resp = await key_scheduler.post_async(endpoint, ik.api_keys, body, model=call['model'],
+                                                          on_hedge=on_hedge)
+        finally:
+            admission.release(ticket)
+            metrics.observe_upstream(endpoint, ik.project_name, call['model'], time.perf_counter() - upstream_started)
+        if resp.status_code == 200:
+            if key is not None:
+                await asyncio.to_thread(in_app_context, response_cache.set, key, resp.content, ttl)
+            with phase('save'):
+                await save(ik, api_call_record(ik, req_json, resp.content, reservation))
+            reservation = 0
+        await respond(send, resp.status_code, resp.content,
+                      headers=[(name.encode(), value.encode()) for name, value in forwarded_headers(resp.headers)])
+    except HTTPException as e:
+        headers = None
+        if getattr(e, 'retry_after', None):
+            headers = [(b'content-type', b'application/json'), (b'retry-after', str(e.retry_after).encode())]
+        await respond(send, e.code, json.dumps({'error': str(e)}).encode(), headers=headers)
+    finally:
+        if reservation:
+            # the call never got saved, so give the money back
+            await release(ik, reservation)
+
+
+async def stream_call(send, endpoint, ik, body, req_json, reservation):
+    upstream_json, client_wants_usage = streamed_request(req_json)
+    # the slot is held until the stream is done
+    try:
+        with phase('queue'):
+            ticket = await admission.acquire_async(ik, estimate_tokens(body, req_json))
+    except BaseException:
+        # a 429 from admission: handle() left the reservation to us
+        await release(ik, reservation)
+        raise
+    started = time.perf_counter()
+    try:
+        with phase('upstream'):
+            resp = await key_scheduler.post_async(endpoint, ik.api_keys, json.dumps(upstream_json).encode(),
+                                                  stream=True, model=req_json.get('model'))
+    except BaseException:
+        admission.release(ticket)
+        await release(ik, reservation)
+        raise
+    finally:
+        metrics.observe_upstream(endpoint, ik.project_name, req_json.get('model'), time.perf_counter() - started)
+    if resp.status_code != 200:
+        content = await resp.read()
+        await resp.aclose()
+        admission.release(ticket)
+        await release(ik, reservation)
+        return await respond(send, resp.status_code, content,
+                             resp.headers.get('content-type', 'application/json').encode())
+    tally = StreamUsage(client_wants_usage, endpoint, req_json)
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        async for line in resp.aiter_lines():
+            if tally.feed(line):
+                await send({'type': 'http.response.body', 'body': line + b'\n', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await resp.aclose()
+        admission.release(ticket)
+        await save(ik, api_call_record(ik, req_json, tally.response(), reservation))
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from datetime import datetime
+import threading, time
+from models import db, InternalAPIKey, Project, APIKey, projects_api_keys, on_commit_of
+
+
+class AuthEntry:
+    # Everything require_api_key needs to authorize a call, resolved once from the db
+    __slots__ = ('internal_api_key_id', 'project_id', 'project_name', 'api_key_id', 'api_key_string', 'api_keys',
+                 'start_date', 'end_date', 'spending_limit', 'total_spent',
+                 'project_spending_limit', 'project_total_spent', 'payload_policy',
+                 'payload_sample_rate', 'response_cache_enabled', 'response_cache_ttl',
+                 'max_concurrency', 'tokens_per_minute', 'project_max_concurrency',
+                 'project_tokens_per_minute', 'project_weight', 'expires')
+
+    def __init__(self, ik, proj, api_key, expires, pool=()):
+        self.internal_api_key_id = ik.id
+        self.project_id = proj.id
+        self.project_name = proj.name
+        self.api_key_id = api_key.id if api_key else None
+        self.api_key_string = api_key.key_string if api_key else None
+        # (api_key_id, key_string) of every key the project may use, its own key first
+        keys = [(api_key.id, api_key.key_string)] if api_key else []
+        self.api_keys = tuple(keys + [k for k in pool if k not in keys])
+        self.start_date = ik.start_date
+        self.end_date = ik.end_date
+        self.spending_limit = ik.spending_limit or 0
+        self.total_spent = ik.total_spent or 0
+        self.project_spending_limit = proj.spending_limit or 0
+        self.project_total_spent = proj.total_spent or 0
+        self.payload_policy = proj.payload_policy or 'full'
+        self.payload_sample_rate = proj.payload_sample_rate
+        self.response_cache_enabled = bool(proj.response_cache_enabled)
+        self.response_cache_ttl = proj.response_cache_ttl
+        self.max_concurrency = ik.max_concurrency
+        self.tokens_per_minute = ik.tokens_per_minute
+        self.project_max_concurrency = proj.max_concurrency
+        self.project_tokens_per_minute = proj.tokens_per_minute
+        self.project_weight = proj.share_weight or 1.0
+        self.expires = expires
+
+    def is_current(self):
+        today = datetime.utcnow()
+        if self.end_date is None:
+            return today >= self.start_date
+        return self.start_date <= today <= self.end_date
+
+
+class AuthCache:
+    """TTL + LRU cache of internal API key string -> AuthEntry.
+
+    Entries are dropped whenever a commit in this process touches an
+    InternalAPIKey, Project or APIKey row. Other gunicorn workers only see
+    such changes once their own entries expire, so keep the TTL short.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.config.setdefault('AUTH_CACHE_SIZE', self.maxsize)
+        app.config.setdefault('AUTH_CACHE_TTL', self.ttl)
+        self.maxsize = app.config['AUTH_CACHE_SIZE']
+        self.ttl = app.config['AUTH_CACHE_TTL']
+        on_commit_of([InternalAPIKey, Project, APIKey], self.clear)
+
+    def peek(self, token):
+        # the cached entry, without going to the db on a miss (the asyncio engine does that in a thread)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry
+        return None
+
+    def get(self, token):
+        entry = self.peek(token)
+        if entry is not None:
+            return entry
+        now = time.monotonic()
+        self.misses += 1
+        entry = self._load(token, now + self.ttl)
+        if entry is None:
+            return None
+        with self._lock:
+            self._entries[token] = entry
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _load(self, token, expires):
+        row = db.session.query(InternalAPIKey, Project, APIKey) \
+            .join(Project, InternalAPIKey.project_id == Project.id) \
+            .outerjoin(APIKey, Project.api_key_id == APIKey.id) \
+            .filter(InternalAPIKey.internal_api_key_string == token).first()
+        if row is None:
+            return None
+        pool = db.session.query(APIKey.id, APIKey.key_string) \
+            .join(projects_api_keys, projects_api_keys.c.api_key_id == APIKey.id) \
+            .filter(projects_api_keys.c.project_id == row[1].id).order_by(APIKey.id).all()
+        return AuthEntry(*row, expires=expires, pool=[tuple(k) for k in pool])
+
+    def add_spend(self, key_costs, project_costs):
+        # Keep cached totals in step with the increments the writer commits
+        with self._lock:
+            for entry in self._entries.values():
+                entry.total_spent += key_costs.get(entry.internal_api_key_id, 0)
+                entry.project_total_spent += project_costs.get(entry.project_id, 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,327 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+import json, logging, os, random, shutil, tempfile, time
+from werkzeug.exceptions import BadRequest, Forbidden, HTTPException, TooManyRequests
+from models import db, BatchJob, InternalAPIKey
+from auth_cache import auth_cache
+from spend import spend_ledger, OutOfMoney
+from admission import admission, estimate_tokens
+from key_scheduler import key_scheduler, RETRY_STATUSES, TRANSIENT_ERRORS
+from resilience import UPSTREAM_ERRORS
+from coalescer import embedding_coalescer
+from write_behind import api_response_writer
+from pricing import price_index
+from proxy import check_api_key, api_call_record, count_usage, hedge_recorder
+from upstream import loads
+
+log = logging.getLogger(__name__)
+
+ENDPOINTS = ('v1/chat/completions', 'v1/completions', 'v1/embeddings')
+
+
+def _lines(f):
+    # (line number, raw line) of the non-blank lines of an input file
+    n = 0
+    for raw in f:
+        if raw.strip():
+            yield n, raw
+            n += 1
+
+
+def parse_line(raw, default_url=None):
+    # {"custom_id": ..., "url": "/v1/embeddings", "body": {...}} -> (custom_id, endpoint, body)
+    try:
+        line = json.loads(raw)
+    except ValueError:
+        raise BadRequest('not valid JSON')
+    if not isinstance(line, dict) or not isinstance(line.get('body'), dict):
+        raise BadRequest('each line needs a "body" object')
+    endpoint = (line.get('url') or default_url or '').strip('/')
+    if endpoint not in ENDPOINTS:
+        raise BadRequest(f"url must be one of {', '.join('/' + e for e in ENDPOINTS)}")
+    if not line['body'].get('model'):
+        raise BadRequest('the body has no model')
+    if line['body'].get('stream'):
+        raise BadRequest('batch calls can not be streamed')
+    return line.get('custom_id'), endpoint, line['body']
+
+
+class BatchRunner:
+    """Runs batch jobs: JSONL files of /v1/* calls uploaded to /v1/batches.
+
+    `flask batch-worker` claims queued jobs and sends their lines through the
+    same path as a proxied call: spend reservation, admission (so project
+    limits and fair sharing apply), the key scheduler and the api_response
+    writer. BATCH_CONCURRENCY lines of a job are in flight at a time. A line
+    that gets a 429, 5xx or connection error is retried BATCH_MAX_RETRIES
+    times with backoff. Results are appended to the job's output file, which
+    is also its checkpoint: a job whose worker stops sending heartbeats for
+    BATCH_HEARTBEAT_TIMEOUT seconds is taken over by another worker and
+    carries on from the lines that have no result yet.
+    """
+
+    def __init__(self):
+        self.concurrency = 8
+        self.max_retries = 5
+        self.backoff = 2.0
+        self.max_backoff = 60.0
+        self.checkpoint_interval = 5
+        self.heartbeat_timeout = 60
+        self.poll_interval = 5
+        self.max_lines = 1000000
+        self.app = None
+
+    def init_app(self, app):
+        app.config.setdefault('BATCH_DIR', os.path.join(app.instance_path, 'batches'))
+        app.config.setdefault('BATCH_CONCURRENCY', self.concurrency)
+        app.config.setdefault('BATCH_MAX_RETRIES', self.max_retries)
+        app.config.setdefault('BATCH_RETRY_BACKOFF', self.backoff)
+        app.config.setdefault('BATCH_RETRY_MAX_BACKOFF', self.max_backoff)
+        app.config.setdefault('BATCH_CHECKPOINT_INTERVAL', self.checkpoint_interval)
+        app.config.setdefault('BATCH_HEARTBEAT_TIMEOUT', self.heartbeat_timeout)
+        app.config.setdefault('BATCH_POLL_INTERVAL', self.poll_interval)
+        app.config.setdefault('BATCH_MAX_LINES', self.max_lines)
+        self.dir = app.config['BATCH_DIR']
+        self.concurrency = app.config['BATCH_CONCURRENCY']
+        self.max_retries = app.config['BATCH_MAX_RETRIES']
+        self.backoff = app.config['BATCH_RETRY_BACKOFF']
+        self.max_backoff = app.config['BATCH_RETRY_MAX_BACKOFF']
+        self.checkpoint_interval = app.config['BATCH_CHECKPOINT_INTERVAL']
+        self.heartbeat_timeout = app.config['BATCH_HEARTBEAT_TIMEOUT']
+        self.poll_interval = app.config['BATCH_POLL_INTERVAL']
+        self.max_lines = app.config['BATCH_MAX_LINES']
+        self.app = app
+
+    def input_path(self, job_id):
+        return os.path.join(self.dir, f'{job_id}.input.jsonl')
+
+    def output_path(self, job_id):
+        return os.path.join(self.dir, f'{job_id}.output.jsonl')
+
+    def create(self, ik, stream, default_url=None):
+        # Saves and checks an uploaded JSONL file (a binary stream) and queues it as a job for ik
+        os.makedirs(self.dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.dir, suffix='.upload', delete=False) as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        try:
+            total = 0
+            with open(f.name, 'rb') as upload:
+                for n, raw in _lines(upload):
+                    try:
+                        parse_line(raw, default_url)
+                    except BadRequest as e:
+                        raise BadRequest(f'Line {n + 1}: {e.description}')
+                    total += 1
+            if not total:
+                raise BadRequest('The file has no lines')
+            if total > self.max_lines:
+                raise BadRequest(f'At most {self.max_lines} lines per job')
+            job = BatchJob(internal_api_key_id=ik.internal_api_key_id, total_lines=total,
+                           endpoint=default_url and default_url.strip('/'))
+            db.session.add(job)
+            db.session.flush()
+            os.replace(f.name, self.input_path(job.id))
+            db.session.commit()
+            return job
+        finally:
+            if os.path.exists(f.name):
+                os.unlink(f.name)
+
+    def claim(self):
+        # -> the id of a queued job, or of one whose worker went quiet, now ours; or None
+        now = datetime.utcnow()
+        claimable = db.or_(BatchJob.status == 'queued',
+                           db.and_(BatchJob.status == 'running',
+                                   BatchJob.heartbeat < now - timedelta(seconds=self.heartbeat_timeout)))
+        for (job_id,) in db.session.query(BatchJob.id).filter(claimable).order_by(BatchJob.id).limit(10).all():
+            # only one worker's UPDATE matches
+            claimed = db.session.execute(db.update(BatchJob).where(BatchJob.id == job_id, claimable)
+                                         .values(status='running', heartbeat=now,
+                                                 time_started=db.func.coalesce(BatchJob.time_started, now))
+                                         .execution_options(synchronize_session=False)).rowcount
+            db.session.commit()
+            if claimed:
+                return job_id, now
+        return None
+
+    def run_forever(self, once=False):
+        # the loop of `flask batch-worker`; with once, returns when no job is left
+        while True:
+            claimed = self.claim()
+            if claimed is not None:
+                self.run(*claimed)
+            elif once:
+                return
+            else:
+                time.sleep(self.poll_interval)
+
+    def _checkpoint(self, job_id):
+        # -> (line numbers with a result, completed, failed, cost) from the output file. It is rewritten
+        # without a last line that a crash left half written, and with only the first result of a line:
+        # a worker that lost the job may have written another before it noticed
+        done, completed, failed, cost = set(), 0, 0, 0.0
+        path = self.output_path(job_id)
+        if not os.path.exists(path):
+            return done, completed, failed, cost
+        with open(path, 'rb') as f, open(path + '.tmp', 'wb') as kept:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    result = loads(raw)
+                except ValueError:
+                    break
+                if result['line'] in done:
+                    continue
+                done.add(result['line'])
+                if result.get('error') is None:
+                    completed += 1
+                else:
+                    failed += 1
+                cost += result.get('cost') or 0
+                kept.write(raw)
+        # the lost worker's handle is left on the old file
+        os.replace(path + '.tmp', path)
+        return done, completed, failed, cost
+
+    def run(self, job_id, heartbeat):
+        job = db.session.get(BatchJob, job_id)
+        token = db.session.query(InternalAPIKey.internal_api_key_string) \
+            .filter(InternalAPIKey.id == job.internal_api_key_id).scalar()
+        done, completed, failed, cost = self._checkpoint(job_id)
+        default_url = job.endpoint
+        stop = None  # why the job stops before its last line
+        dropped = 0
+        last_checkpoint = time.monotonic()
+        with open(self.input_path(job_id), 'rb') as input_file, open(self.output_path(job_id), 'ab') as out, \
+                ThreadPoolExecutor(self.concurrency, thread_name_prefix=f'batch-{job_id}') as pool:
+            lines = ((n, raw) for n, raw in _lines(input_file) if n not in done)
+            pending = set()
+            while True:
+                while stop is None and len(pending) < self.concurrency * 2:
+                    line = next(lines, None)
+                    if line is None:
+                        break
+                    pending.add(pool.submit(self._call, token, default_url, *line))
+                if not pending:
+                    break
+                finished, pending = wait(pending, timeout=self.checkpoint_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future.cancelled():
+                        continue
+                    try:
+                        result, line_cost = future.result()
+                    except HTTPException as e:
+                        # the key or its money is gone: the line stays without a result for a resume
+                        stop = stop or ('failed', e.description)
+                        continue
+                    except Exception as e:
+                        log.exception('Batch job %s failed on a line', job_id)
+                        stop = stop or ('failed', str(e)[:512])
+                        continue
+                    if heartbeat is None:
+                        # the job is no longer ours; a resume or the worker that took it over redoes the line
+                        dropped += 1
+                        continue
+                    out.write(result)
+                    if line_cost is None:
+                        failed += 1
+                    else:
+                        completed += 1
+                        cost += line_cost
+                if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    last_checkpoint = time.monotonic()
+                    out.flush()
+                    heartbeat = self._save(job_id, heartbeat, completed, failed, cost)
+                    if heartbeat is None:
+                        stop = stop or ('cancelled', None)  # or taken over by another worker
+                if stop is not None:
+                    for future in pending:
+                        future.cancel()
+            out.flush()
+        status, error = stop or ('completed', None)
+        if status != 'cancelled':
+            self._save(job_id, heartbeat, completed, failed, cost, status=status, error=error)
+        log.info('Batch job %s %s: %d completed, %d failed, $%.4f', job_id, status, completed, failed, cost)
+        if dropped:
+            log.warning('Batch job %s: dropped the results of %d lines that finished after the job was cancelled '
+                        'or taken over', job_id, dropped)
+
+    def _save(self, job_id, heartbeat, completed, failed, cost, status=None, error=None):
+        # Progress, and a new heartbeat. -> the heartbeat, or None when the job was cancelled or taken over
+        now = datetime.utcnow()
+        values = dict(completed_lines=completed, failed_lines=failed, cost=cost, heartbeat=now)
+        if status is not None:
+            values.update(status=status, error=error, time_finished=now)
+        updated = db.session.execute(db.update(BatchJob)
+                                     .where(BatchJob.id == job_id, BatchJob.status == 'running',
+                                            BatchJob.heartbeat == heartbeat)
+                                     .values(**values)
+                                     .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        return now if updated else None
+
+    def _sleep(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def _call(self, token, default_url, n, raw):
+        # One line, from a pool thread. -> (output line, its cost or None when it failed)
+        custom_id, endpoint, body = parse_line(raw, default_url)
+        result = {'line': n, 'custom_id': custom_id}
+        with self.app.app_context():
+            attempt = 0
+            while True:
+                ik = auth_cache.get(token)
+                check_api_key(ik)
+                try:
+                    reservation = spend_ledger.reserve(ik, spend_ledger.worst_case(endpoint, body))
+                except OutOfMoney:
+                    raise
+                except Forbidden as e:
+                    # this line's worst case doesn't fit in what's left; a smaller one may
+                    result.update(status_code=403, error={'message': e.description})
+                    return json.dumps(result).encode() + b'\n', None
+                resp = None
+                on_hedge = hedge_recorder(self.app, ik, body)
+                try:
+                    ticket = admission.acquire(ik, estimate_tokens(raw, body))
+                    try:
+                        if endpoint == 'v1/embeddings' and embedding_coalescer.enabled:
+                            resp = embedding_coalescer.post(endpoint, ik.api_keys, body, on_hedge)
+                        if resp is None:
+                            resp = key_scheduler.post(endpoint, ik.api_keys, json=body, model=body.get('model'),
+                                                      on_hedge=on_hedge)
+                    finally:
+                        admission.release(ticket)
+                except (TooManyRequests, *UPSTREAM_ERRORS, *TRANSIENT_ERRORS) as e:
+                    spend_ledger.release(ik.internal_api_key_id, ik.project_id, reservation)
+                    if attempt >= self.max_retries:
+                        result.update(status_code=getattr(e, 'code', None), error={'message': str(e)})
+                        return json.dumps(result).encode() + b'\n', None
+                except BaseException:
+                    spend_ledger.release(ik.internal_api_key_id, ik.project_id, reservation)
+                    raise
+                else:
+                    if resp.status_code == 200:
+                        record = api_call_record(ik, body, resp.content, reservation)
+                        count_usage(ik, record)
+                        api_response_writer.submit(record)
+                        line_cost = price_index.cost(record['model_name'], record['tokens_in'], record['tokens_out'])
+                        line_cost = sum(line_cost) if line_cost else 0.0
+                        # the upstream's body goes in as it is
+                        result.update(status_code=200, cost=line_cost)
+                        return json.dumps(result)[:-1].encode() + b', "body": ' + resp.content.strip() + b'}\n', line_cost
+                    spend_ledger.release(ik.internal_api_key_id, ik.project_id, reservation)
+                    if resp.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                        try:
+                            error = loads(resp.content).get('error')
+                        except (ValueError, AttributeError):
+                            error = None
+                        result.update(status_code=resp.status_code,
+                                      error=error or {'message': resp.content.decode(errors='replace')})
+                        return json.dumps(result).encode() + b'\n', None
+                attempt += 1
+                self._sleep(attempt)
+
+
+batch_runner = BatchRunner()
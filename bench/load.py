@@ -0,0 +1,148 @@
+"""Load generator for the /v1/* proxy routes.
+
+    python -m bench.stub_server --latency-ms 200 &
+    FLASK_UPSTREAM_BASE_URL=http://127.0.0.1:8765 python -m bench.load --seed 10 --requests 5000 --concurrency 32
+
+By default the calls go through app.test_client() in this process, so they
+run open_ai_call behind require_api_key without a web server in front; with
+--url they go over HTTP to a running proxy (gunicorn, asgi.py) instead, which
+must use the same database. Keys come from --keys-file (see bench.seed) or
+--seed N new projects. Reports latency percentiles, throughput, statuses and
+how many api_response rows were written.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import argparse, itertools, json, random, threading, time
+import requests
+from app import app
+from models import db, APIResponse
+from write_behind import api_response_writer
+from bench.seed import seed_models, seed_projects
+
+BODIES = {
+    'embeddings': ('/v1/embeddings', {'model': 'text-embedding-ada-002', 'input': 'The quick brown fox'}),
+    'chat': ('/v1/chat/completions', {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': 'Hi'}]}),
+    'completions': ('/v1/completions', {'model': 'text-davinci-003', 'prompt': 'Hi', 'max_tokens': 20}),
+    'stream': ('/v1/chat/completions', {'model': 'gpt-3.5-turbo', 'stream': True,
+                                        'messages': [{'role': 'user', 'content': 'Hi'}]}),
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def count_rows():
+    with app.app_context():
+        return db.session.query(db.func.count(APIResponse.id)).scalar()
+
+
+def wait_for_rows(expected, timeout):
+    # rows are written in the background; wait until they're all in or stop coming
+    deadline = time.monotonic() + timeout
+    last, since = count_rows(), time.monotonic()
+    while last < expected and time.monotonic() < deadline and time.monotonic() - since < 5:
+        time.sleep(0.5)
+        rows = count_rows()
+        if rows != last:
+            last, since = rows, time.monotonic()
+    return last
+
+
+def make_caller(url):
+    local = threading.local()
+
+    def call(path, body, key):
+        headers = {'Authorization': f'Bearer {key}'}
+        if url:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            resp = local.session.post(url.rstrip('/') + path, data=json.dumps(body), headers=headers,
+                                      stream=body.get('stream', False))
+            for _ in resp.iter_content(chunk_size=None):
+                pass
+            return resp.status_code
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        resp = local.client.post(path, json=body, headers=headers)
+        resp.get_data()
+        return resp.status_code
+    return call
+
+
+def run(keys, requests_total, concurrency, mix, url=None):
+    call = make_caller(url)
+    kinds = list(itertools.chain.from_iterable([kind] * weight for kind, weight in mix.items()))
+    latencies, statuses = [], Counter()
+    lock = threading.Lock()
+
+    def one(n):
+        path, body = BODIES[random.choice(kinds)]
+        started = time.perf_counter()
+        try:
+            status = call(path, body, random.choice(keys))
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(requests_total)))
+    return sorted(latencies), statuses, time.perf_counter() - started
+
+
+def parse_mix(value):
+    # 'embeddings=3,chat=1' -> {'embeddings': 3, 'chat': 1}
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in BODIES:
+            raise argparse.ArgumentTypeError(f'unknown call type {kind}, pick from {", ".join(BODIES)}')
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='proxy to call over HTTP, e.g. http://127.0.0.1:5000 (default: in-process)')
+    parser.add_argument('--keys-file', help='internal API keys, one per line, as written by bench.seed')
+    parser.add_argument('--seed', type=int, default=0, help='create this many projects with 5 users each')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('embeddings=1,chat=1'),
+                        help=f'weights of the call types ({", ".join(BODIES)}), e.g. embeddings=3,stream=1')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='seconds to wait for rows to be written')
+    args = parser.parse_args(argv)
+    keys = []
+    if args.keys_file:
+        with open(args.keys_file) as f:
+            keys = [line.strip() for line in f if line.strip()]
+    if args.seed:
+        with app.app_context():
+            db.create_all()
+            seed_models()
+            keys += seed_projects(args.seed, 5)
+    if not keys:
+        parser.error('no keys: pass --keys-file or --seed')
+
+    rows_before = count_rows()
+    latencies, statuses, elapsed = run(keys, args.requests, args.concurrency, args.mix, args.url)
+    if not args.url:
+        api_response_writer.stop()
+    rows = wait_for_rows(rows_before + statuses.get(200, 0), args.drain_timeout) - rows_before
+
+    print(f'{args.requests} calls in {elapsed:.2f}s with {args.concurrency} threads: '
+          f'{args.requests / elapsed:.1f} calls/s')
+    print('latency ms: ' + ', '.join(f'p{p} {percentile(latencies, p) * 1000:.1f}' for p in (50, 90, 99))
+          + f', max {latencies[-1] * 1000:.1f}')
+    print('statuses: ' + ', '.join(f'{status}: {n}' for status, n in sorted(statuses.items(), key=str)))
+    print(f'api_response rows written: {rows}')
+
+
+if __name__ == '__main__':
+    main()
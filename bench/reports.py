@@ -0,0 +1,60 @@
+"""Timings of the reporting paths over the seeded data (see bench.seed).
+
+    python -m bench.seed --rows 1000000 && python -m bench.reports --repeat 5
+
+Times the project activity report (whole range, last 7 days, one user),
+Project.update_spending for every project and rebuild_usage_daily, and prints
+the best and median of --repeat runs.
+"""
+from datetime import datetime, timedelta
+import argparse, statistics, time
+from app import app
+from models import db, Project, APIResponse, UsageDaily
+from usage import project_activity, rebuild_usage_daily
+
+
+def timed(fn, repeat):
+    # -> (best, median) seconds of repeat calls, each in its own transaction
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+        db.session.rollback()
+    return min(times), statistics.median(times)
+
+
+def benchmarks(projects, rebuild=True):
+    week_ago = datetime.utcnow() - timedelta(days=7)
+
+    def first_user(project):
+        user = project.users.first()
+        return [user.id] if user else None
+
+    yield 'activity report, all time', lambda: [project_activity(p) for p in projects]
+    yield 'activity report, last 7 days', lambda: [project_activity(p, start_date=week_ago) for p in projects]
+    yield 'activity report, one user', lambda: [project_activity(p, first_user(p)) for p in projects]
+    yield 'update_spending, all projects', lambda: [p.update_spending() for p in projects]
+    if rebuild:
+        yield 'rebuild_usage_daily', rebuild_usage_daily
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--projects', type=int, default=0, help='only the first N projects (default: all)')
+    parser.add_argument('--no-rebuild', action='store_true', help='skip rebuild_usage_daily, slow on big tables')
+    args = parser.parse_args(argv)
+    with app.app_context():
+        query = Project.query.order_by(Project.id)
+        projects = query.limit(args.projects).all() if args.projects else query.all()
+        rows = db.session.query(db.func.count(APIResponse.id)).scalar()
+        daily = db.session.query(db.func.count()).select_from(UsageDaily).scalar()
+        print(f'{len(projects)} projects, {rows} api_response rows, {daily} usage_daily rows')
+        for name, fn in benchmarks(projects, not args.no_rebuild):
+            best, median = timed(fn, args.repeat)
+            print(f'{name:32} best {best * 1000:9.1f} ms   median {median * 1000:9.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
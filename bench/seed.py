@@ -0,0 +1,100 @@
+"""Synthetic data for the benchmarks: projects with internal API keys, and api_response rows.
+
+    FLASK_SQLALCHEMY_DATABASE_URI=postgresql://... python -m bench.seed --projects 10 --users 5 --rows 1000000
+
+Writes the internal API key strings to --keys-file for bench.load. Rows are
+spread over --days days and the models of model_costs(), priced as the writer
+would, and usage_daily is rebuilt at the end. Like add_test_data, but sized for
+10^5 to 10^7 rows: they are inserted --batch rows per statement and commit.
+"""
+from datetime import datetime, timedelta
+import argparse, random, time, uuid
+from app import app, model_costs
+from models import db, User, Project, APIKey, APIResponse, OpenAIModel, ModelCost, InternalAPIKey
+from usage import rebuild_usage_daily
+
+
+def seed_models():
+    if OpenAIModel.query.first() is not None:
+        return
+    for d in model_costs():
+        m = OpenAIModel(name=d['model_name'], description=d['description'])
+        db.session.add(m)
+        db.session.flush()
+        db.session.add(ModelCost(model_id=m.id, in_tokens_cost=d['input_cost'], out_tokens_cost=d['output_cost'],
+                                 start_date=datetime(2021, 1, 1)))
+    db.session.commit()
+
+
+def seed_projects(projects, users, upstream_key='sk-bench'):
+    # -> the internal API key strings of the new projects
+    tag = uuid.uuid4().hex[:8]
+    api_key = APIKey.query.filter_by(key_string=upstream_key).first()
+    if api_key is None:
+        api_key = APIKey(name='Benchmark APIKey', key_string=upstream_key)
+        db.session.add(api_key)
+    models = OpenAIModel.query.all()
+    keys = []
+    for p in range(projects):
+        members = [User(username=f'bench-{tag}-{p}-{u}') for u in range(users)]
+        project = Project(name=f'bench-{tag}-{p}', api_key=api_key, allowed_models=models, users=members)
+        db.session.add(project)
+        for user in members:
+            key_string = str(uuid.uuid4())
+            db.session.add(InternalAPIKey(user=user, project=project, internal_api_key_string=key_string))
+            keys.append(key_string)
+    db.session.commit()
+    return keys
+
+
+def seed_responses(rows, days=90, batch=10000, key_ids=None):
+    # rows api_response rows for random internal API keys over the last days days
+    prices = {d['model_name']: (d['input_cost'], d['output_cost']) for d in model_costs()}
+    models = list(prices)
+    key_ids = key_ids or [id for (id,) in db.session.query(InternalAPIKey.id)]
+    end = datetime.utcnow()
+    span = days * 86400
+    table = APIResponse.__table__
+    for start in range(0, rows, batch):
+        records = []
+        for _ in range(min(batch, rows - start)):
+            model = random.choice(models)
+            tokens_in, tokens_out = random.randint(5, 2000), random.randint(0, 800)
+            in_price, out_price = prices[model]
+            records.append({'model_name': model, 'tokens_in': tokens_in, 'tokens_out': tokens_out,
+                            'internal_api_key_id': random.choice(key_ids),
+                            'time_created': end - timedelta(seconds=random.randint(0, span)),
+                            'in_cost': tokens_in / 1000 * in_price, 'out_cost': tokens_out / 1000 * out_price,
+                            'cached': False})
+        db.session.execute(table.insert(), records)
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--users', type=int, default=5, help='users, and so internal API keys, per project')
+    parser.add_argument('--rows', type=int, default=100000, help='api_response rows to add')
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--keys-file', default='bench-keys.txt')
+    args = parser.parse_args(argv)
+    with app.app_context():
+        db.create_all()
+        seed_models()
+        started = time.perf_counter()
+        keys = seed_projects(args.projects, args.users)
+        key_ids = [id for (id,) in db.session.query(InternalAPIKey.id)
+                   .filter(InternalAPIKey.internal_api_key_string.in_(keys))]
+        seed_responses(args.rows, args.days, args.batch, key_ids)
+        inserted = time.perf_counter()
+        rebuild_usage_daily()
+        db.session.commit()
+        print(f'{len(keys)} internal API keys, {args.rows} api_response rows in {inserted - started:.1f}s, '
+              f'usage_daily rebuilt in {time.perf_counter() - inserted:.1f}s')
+    with open(args.keys_file, 'w') as f:
+        f.write('\n'.join(keys) + '\n')
+
+
+if __name__ == '__main__':
+    main()
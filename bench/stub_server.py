@@ -0,0 +1,104 @@
+"""A local stand-in for the OpenAI API, for benchmarks and load tests.
+
+    python -m bench.stub_server --port 8765 --latency-ms 200 --rate-429 0.05
+    FLASK_UPSTREAM_BASE_URL=http://127.0.0.1:8765 gunicorn app:app
+
+Answers /v1/chat/completions (streamed too), /v1/completions and
+/v1/embeddings with fixed usage numbers after a configurable delay, and
+turns a fraction of calls into 429s with rate limit headers.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse, json, random, time
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None  # the parsed command line, set by main()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        o = self.options
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if random.random() < o.rate_429:
+            return self.send_json(429, {'error': {'message': 'Rate limit reached (stub)', 'type': 'requests'}},
+                                  {'retry-after-ms': str(o.retry_after_ms)})
+        time.sleep(max(0.0, random.gauss(o.latency_ms, o.jitter_ms)) / 1000)
+        model = body.get('model', 'gpt-3.5-turbo')
+        if self.path == '/v1/embeddings':
+            inputs = body.get('input')
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            return self.send_json(200, {
+                'object': 'list', 'model': model,
+                'data': [{'object': 'embedding', 'index': i, 'embedding': [random.random() for _ in range(o.dimensions)]}
+                         for i in range(len(inputs))],
+                'usage': {'prompt_tokens': o.prompt_tokens * len(inputs), 'total_tokens': o.prompt_tokens * len(inputs)}})
+        if self.path not in ('/v1/chat/completions', '/v1/completions'):
+            return self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+        chat = self.path == '/v1/chat/completions'
+        usage = {'prompt_tokens': o.prompt_tokens, 'completion_tokens': o.completion_tokens,
+                 'total_tokens': o.prompt_tokens + o.completion_tokens}
+        if body.get('stream'):
+            return self.send_stream(chat, model, usage, (body.get('stream_options') or {}).get('include_usage'))
+        text = 'lorem ' * o.completion_tokens
+        choice = {'index': 0, 'finish_reason': 'stop'}
+        choice.update({'message': {'role': 'assistant', 'content': text}} if chat else {'text': text})
+        self.send_json(200, {'id': 'stub', 'object': 'chat.completion' if chat else 'text_completion',
+                             'created': int(time.time()), 'model': model, 'choices': [choice], 'usage': usage})
+
+    def send_json(self, status, body, headers=None):
+        out = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.send_header('x-ratelimit-limit-requests', str(self.options.limit_requests))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def send_stream(self, chat, model, usage, include_usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for n in range(self.options.completion_tokens):
+            choice = {'index': 0, 'delta': {'content': 'lorem '}} if chat else {'index': 0, 'text': 'lorem '}
+            self.send_event({'id': 'stub', 'model': model, 'choices': [choice]})
+            time.sleep(self.options.chunk_delay_ms / 1000)
+        if include_usage:
+            self.send_event({'id': 'stub', 'model': model, 'choices': [], 'usage': usage})
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_event(self, event):
+        self.send_chunk(b'data: ' + json.dumps(event).encode() + b'\n\n')
+
+    def send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=100, help='mean time before answering')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='standard deviation of the latency')
+    parser.add_argument('--chunk-delay-ms', type=float, default=5, help='between streamed chunks')
+    parser.add_argument('--prompt-tokens', type=int, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=20)
+    parser.add_argument('--dimensions', type=int, default=1536, help='length of the embedding vectors')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of calls answered with a 429')
+    parser.add_argument('--retry-after-ms', type=int, default=500)
+    parser.add_argument('--limit-requests', type=int, default=10000, help='sent as x-ratelimit-limit-requests')
+    StubHandler.options = parser.parse_args(argv)
+    server = ThreadingHTTPServer((StubHandler.options.host, StubHandler.options.port), StubHandler)
+    server.daemon_threads = True
+    print(f'Stub OpenAI API on http://{StubHandler.options.host}:{StubHandler.options.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
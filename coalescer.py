@@ -0,0 +1,194 @@
+import json, threading
+from key_scheduler import key_scheduler
+from upstream import loads
+
+
+def _inputs(body):
+    # -> (kind, list of inputs) or None when the input can't be merged with others
+    value = body.get('input')
+    if isinstance(value, str):
+        return 'text', [value]
+    if isinstance(value, list) and value:
+        if all(isinstance(v, str) for v in value):
+            return 'text', list(value)
+        if all(isinstance(v, int) for v in value):
+            return 'tokens', [value]
+        if all(isinstance(v, list) and all(isinstance(t, int) for t in v) for v in value):
+            return 'tokens', list(value)
+    return None
+
+
+def estimate_tokens(kind, value):
+    if kind == 'tokens':
+        return len(value)
+    return max(1, len(value.encode()) // 4)
+
+
+def _shares(total, batch):
+    # total tokens split over the batch's callers by their estimated tokens, adding up exactly
+    shares, left = [], total
+    for n, caller in enumerate(batch.callers):
+        share = left if n == len(batch.callers) - 1 else round(total * caller.tokens / batch.tokens)
+        left -= share
+        shares.append(share)
+    return shares
+
+
+class CoalescedResponse:
+    # What a caller's share of a batched call looks like to open_ai_call, same interface as UpstreamResponse
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return loads(self.content)
+
+    def close(self):
+        pass
+
+
+class _Caller:
+    def __init__(self, inputs, tokens, on_hedge):
+        self.inputs = inputs
+        self.tokens = tokens
+        self.on_hedge = on_hedge
+        self.offset = 0
+        self.response = None
+
+
+class _Batch:
+    def __init__(self):
+        self.callers = []
+        self.inputs = 0
+        self.tokens = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class EmbeddingCoalescer:
+    """Merges concurrent /v1/embeddings calls into one upstream call.
+
+    Calls for the same APIKeys, model and options that arrive within
+    EMBEDDINGS_COALESCE_WINDOW_MS of each other are sent upstream as one
+    list `input`, up to EMBEDDINGS_COALESCE_MAX_INPUTS inputs and
+    EMBEDDINGS_COALESCE_MAX_TOKENS estimated tokens. The first caller of a
+    batch waits out the window and makes the call; everyone gets back their
+    own vectors, with the usage split by their share of the tokens.
+
+    Only calls handled by the same worker process are merged, so it needs
+    threaded workers (gunicorn --threads).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = 0.005
+        self.max_inputs = 256
+        self.max_tokens = 100000
+        self._open = {}
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+
+    def init_app(self, app):
+        app.config.setdefault('EMBEDDINGS_COALESCE', self.enabled)
+        app.config.setdefault('EMBEDDINGS_COALESCE_WINDOW_MS', self.window * 1000)
+        app.config.setdefault('EMBEDDINGS_COALESCE_MAX_INPUTS', self.max_inputs)
+        app.config.setdefault('EMBEDDINGS_COALESCE_MAX_TOKENS', self.max_tokens)
+        self.enabled = app.config['EMBEDDINGS_COALESCE']
+        self.window = app.config['EMBEDDINGS_COALESCE_WINDOW_MS'] / 1000
+        self.max_inputs = app.config['EMBEDDINGS_COALESCE_MAX_INPUTS']
+        self.max_tokens = app.config['EMBEDDINGS_COALESCE_MAX_TOKENS']
+
+    def post(self, path, keys, body, on_hedge=None):
+        # -> a response for this caller's body, or None if it should be sent upstream on its own.
+        # on_hedge: see key_scheduler.post; it gets this caller's share of a hedged batch's losing copy
+        parsed = _inputs(body)
+        if parsed is None:
+            return None
+        kind, inputs = parsed
+        tokens = sum(estimate_tokens(kind, v) for v in inputs)
+        if len(inputs) >= self.max_inputs or tokens >= self.max_tokens:
+            return None
+        options = {k: v for k, v in body.items() if k != 'input'}
+        group = (tuple(api_key_id for api_key_id, _ in keys), path, kind, json.dumps(options, sort_keys=True))
+        caller = _Caller(inputs, tokens, on_hedge)
+        with self._lock:
+            batch = self._open.get(group)
+            if batch is not None and (batch.inputs + len(inputs) > self.max_inputs
+                                      or batch.tokens + tokens > self.max_tokens):
+                # no room left: send the open batch now and start a new one
+                del self._open[group]
+                batch.full.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._open[group] = _Batch()
+            caller.offset = batch.inputs
+            batch.callers.append(caller)
+            batch.inputs += len(inputs)
+            batch.tokens += tokens
+            if batch.inputs >= self.max_inputs or batch.tokens >= self.max_tokens:
+                del self._open[group]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(group) is batch:
+                    del self._open[group]
+            try:
+                self._send(path, keys, options, batch)
+            except Exception as e:
+                batch.error = e
+                raise
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+        return caller.response
+
+    def _send(self, path, keys, options, batch):
+        inputs = [v for caller in batch.callers for v in caller.inputs]
+        if len(batch.callers) == 1:
+            on_hedge = batch.callers[0].on_hedge
+        else:
+            on_hedge = lambda content: self._split_hedge(batch, content)
+        resp = key_scheduler.post(path, keys, json={**options, 'input': inputs}, model=options.get('model'),
+                                  on_hedge=on_hedge)
+        self.upstream_calls += 1
+        self.coalesced_calls += len(batch.callers)
+        if len(batch.callers) == 1:
+            batch.callers[0].response = resp
+            return
+        if resp.status_code != 200:
+            # one bad input shouldn't fail everyone, so 400s are retried one by one (response None);
+            # anything else (rate limits, outages) is everyone's answer
+            if resp.status_code != 400:
+                for caller in batch.callers:
+                    caller.response = CoalescedResponse(resp.status_code, resp.headers, resp.content)
+            return
+        result = resp.json()
+        data = sorted(result.get('data') or [], key=lambda d: d.get('index', 0))
+        total = (result.get('usage') or {}).get('prompt_tokens', 0)
+        for caller, share in zip(batch.callers, _shares(total, batch)):
+            own = [dict(d, index=i) for i, d in enumerate(data[caller.offset:caller.offset + len(caller.inputs)])]
+            content = json.dumps({'object': result.get('object', 'list'), 'data': own, 'model': result.get('model'),
+                                  'usage': {'prompt_tokens': share, 'total_tokens': share}}).encode()
+            caller.response = CoalescedResponse(200, {'content-type': 'application/json'}, content)
+
+    def _split_hedge(self, batch, content):
+        # the losing copy of a hedged batch, billed to its callers by their share of the tokens
+        total = (loads(content).get('usage') or {}).get('prompt_tokens', 0)
+        for caller, share in zip(batch.callers, _shares(total, batch)):
+            if caller.on_hedge is not None:
+                caller.on_hedge(json.dumps({'usage': {'prompt_tokens': share, 'total_tokens': share}}).encode())
+
+    def stats(self):
+        return {'upstream_calls': self.upstream_calls, 'coalesced_calls': self.coalesced_calls,
+                'open_batches': len(self._open)}
+
+
+embedding_coalescer = EmbeddingCoalescer()
@@ -0,0 +1,428 @@
+import fcntl, mmap, os, struct, threading, time, zlib
+
+try:
+    import redis
+except ImportError:  # optional, only for COUNTERS_BACKEND = 'redis'
+    redis = None
+
+# Names of the counters, per internal API key ('k:<id>') and project ('p:<id>'):
+#   spent:<who>      committed spend, seeded from the db the first time it's needed
+#   held:<who>       reserved by calls in flight
+#   unflushed:<who>  spend not yet added to the db totals
+#   rate:<name>      tokens used in the current window, window index in ratew:<name>
+
+
+def _fields(internal_api_key_id, project_id):
+    return f'k:{internal_api_key_id}', f'p:{project_id}'
+
+
+def _joined(key_costs, project_costs):
+    # ({1: .5}, {2: .5}) -> {'k:1': .5, 'p:2': .5}, without zeros
+    joined = {f'k:{id}': cost for id, cost in key_costs.items() if cost}
+    joined.update({f'p:{id}': cost for id, cost in project_costs.items() if cost})
+    return joined
+
+
+def _split(costs):
+    # {'k:1': .5, 'p:2': .5} -> ({1: .5}, {2: .5})
+    keys, projects = {}, {}
+    for field, value in costs.items():
+        kind, id = field.split(':')
+        (keys if kind == 'k' else projects)[int(id)] = value
+    return keys, projects
+
+
+class _DictTable:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+    def set(self, name, value):
+        self.data[name] = value
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+    def items(self, prefix):
+        return [(n, v) for n, v in self.data.items() if n.startswith(prefix)]
+
+
+class _MmapTable:
+    # Open addressing hash table of name -> float in a shared mmap. Slots are
+    # never freed; deleting sets a slot to NaN so its name can be reused.
+    SLOT = struct.Struct('48sd')
+
+    def __init__(self, mm, slots):
+        self.mm = mm
+        self.slots = slots
+
+    def _find(self, name):
+        # -> (slot offset, whether the name is stored there)
+        key = name.encode()
+        if len(key) > 48:
+            raise ValueError(f'Counter name too long: {name}')
+        at = zlib.crc32(key) % self.slots
+        for n in range(self.slots):
+            offset = ((at + n) % self.slots) * self.SLOT.size
+            stored, _ = self.SLOT.unpack_from(self.mm, offset)
+            stored = stored.rstrip(b'\0')
+            if stored == key or not stored:
+                return offset, bool(stored)
+        raise RuntimeError('The shared counter table is full, raise COUNTERS_SHM_SLOTS')
+
+    def get(self, name, default=None):
+        offset, found = self._find(name)
+        if not found:
+            return default
+        value = self.SLOT.unpack_from(self.mm, offset)[1]
+        return default if value != value else value  # NaN: deleted
+
+    def set(self, name, value):
+        offset, _ = self._find(name)
+        self.SLOT.pack_into(self.mm, offset, name.encode(), value)
+
+    def delete(self, name):
+        offset, found = self._find(name)
+        if found:
+            self.SLOT.pack_into(self.mm, offset, name.encode(), float('nan'))
+
+    def items(self, prefix):
+        key = prefix.encode()
+        out = []
+        for offset in range(0, self.slots * self.SLOT.size, self.SLOT.size):
+            stored, value = self.SLOT.unpack_from(self.mm, offset)
+            if stored[:1] != b'\0' and stored.startswith(key) and value == value:
+                out.append((stored.rstrip(b'\0').decode(), value))
+        return out
+
+
+class _TableCounters:
+    # The counter operations over a table; subclasses provide _table(), a
+    # context manager that holds the table exclusively.
+    shared = False
+
+    def reserve(self, internal_api_key_id, project_id, amount, key_limit, project_limit, key_spent, project_spent):
+        # Atomic check-and-reserve. -> None, or 'project'/'key' when that limit would be crossed.
+        # key_spent/project_spent are the db totals: shared counters only seed from them.
+        key, project = _fields(internal_api_key_id, project_id)
+        with self._table() as t:
+            def current(field, seed):
+                spent = seed
+                if self.shared:
+                    spent = t.get(f'spent:{field}')
+                    if spent is None:
+                        spent = seed + t.get(f'unflushed:{field}', 0.0)
+                        t.set(f'spent:{field}', spent)
+                return spent + t.get(f'held:{field}', 0.0)
+            if project_limit and current(project, project_spent) + amount > project_limit * .98:
+                return 'project'
+            if key_limit and current(key, key_spent) + amount > key_limit * .98:
+                return 'key'
+            if amount:
+                for field in (key, project):
+                    t.set(f'held:{field}', t.get(f'held:{field}', 0.0) + amount)
+        return None
+
+    def release(self, internal_api_key_id, project_id, amount):
+        with self._table() as t:
+            for field in _fields(internal_api_key_id, project_id):
+                self._unhold(t, field, amount)
+
+    def _unhold(self, t, field, amount):
+        held = t.get(f'held:{field}', 0.0) - amount
+        if held <= 1e-12:
+            t.delete(f'held:{field}')
+        else:
+            t.set(f'held:{field}', held)
+
+    def settle(self, key_costs, project_costs, reservations, count_spent=True):
+        # Saved calls: their cost becomes spend, to be flushed to the db, and their reservations go
+        costs = _joined(key_costs, project_costs)
+        with self._table() as t:
+            if self.shared:
+                for field, cost in costs.items():
+                    spent = t.get(f'spent:{field}')
+                    if spent is not None and count_spent:
+                        t.set(f'spent:{field}', spent + cost)
+                    t.set(f'unflushed:{field}', t.get(f'unflushed:{field}', 0.0) + cost)
+            for internal_api_key_id, project_id, amount in reservations:
+                if amount:
+                    for field in _fields(internal_api_key_id, project_id):
+                        self._unhold(t, field, amount)
+
+    def take_unflushed(self):
+        # -> ({internal_api_key_id: cost}, {project_id: cost}) added since the last call, and resets them
+        with self._table() as t:
+            items = t.items('unflushed:')
+            for name, _ in items:
+                t.delete(name)
+        return _split({name[len('unflushed:'):]: value for name, value in items if value})
+
+    def set_spent(self, key_totals, project_totals):
+        # Replaces the committed spend with db totals just recomputed from the saved calls.
+        # Those hold the unflushed spend too, so it goes.
+        if not self.shared:
+            return
+        with self._table() as t:
+            for name, _ in t.items('spent:') + t.items('unflushed:'):
+                t.delete(name)
+            for field, total in _joined(key_totals, project_totals).items():
+                t.set(f'spent:{field}', total)
+
+    def consume_rate(self, items, window=60):
+        # items: [(name, amount, limit)]. Adds every amount to its window, or none when
+        # one would go over its limit. -> the name that was over, or None.
+        # An amount bigger than a whole limit still gets through into an empty window.
+        index = int(time.time() // window)
+        with self._table() as t:
+            used = {}
+            for name, amount, limit in items:
+                if t.get(f'ratew:{name}') != index:
+                    t.set(f'ratew:{name}', index)
+                    t.set(f'rate:{name}', 0.0)
+                used[name] = t.get(f'rate:{name}', 0.0)
+                if limit and used[name] and used[name] + amount > limit:
+                    return name
+            for name, amount, limit in items:
+                t.set(f'rate:{name}', used[name] + amount)
+        return None
+
+    def held(self):
+        with self._table() as t:
+            return _split({name[len('held:'):]: value for name, value in t.items('held:')})
+
+
+class LocalCounters(_TableCounters):
+    # Per process. Spend checks use the db totals the auth cache holds, as they always did.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = _DictTable()
+
+    def _table(self):
+        return _Locked(self._lock, lambda: self._data)
+
+
+class _Locked:
+    def __init__(self, lock, table, release=None):
+        self.lock = lock
+        self.table = table
+        self.release = release
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.table()
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        try:
+            if self.release:
+                self.release()
+        finally:
+            self.lock.release()
+
+
+class SharedMemoryCounters(_TableCounters):
+    # For the workers of one host: a table in a memory-mapped file, under flock
+    shared = True
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._mm = None
+
+    def _open(self):
+        # per process: a flock taken through a descriptor inherited across fork wouldn't exclude anyone
+        if self._pid == os.getpid():
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        size = self.slots * _MmapTable.SLOT.size
+        self._file = open(self.path, 'a+b')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        self._pid = os.getpid()
+
+    def _acquire(self):
+        self._open()
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return _MmapTable(self._mm, self.slots)
+
+    def _table(self):
+        return _Locked(self._lock, self._acquire, lambda: fcntl.flock(self._file, fcntl.LOCK_UN))
+
+
+# The Redis versions of the _TableCounters operations; hashes KEYS[1..3] are spent, held, unflushed
+_LUA_HELPERS = """
+local function unhold(field, amount)
+    if tonumber(redis.call('HINCRBYFLOAT', KEYS[2], field, -amount)) <= 1e-12 then
+        redis.call('HDEL', KEYS[2], field)
+    end
+end
+"""
+_RESERVE = """
+local function current(field, seed)
+    local spent = redis.call('HGET', KEYS[1], field)
+    if not spent then
+        spent = tonumber(seed) + tonumber(redis.call('HGET', KEYS[3], field) or '0')
+        redis.call('HSET', KEYS[1], field, spent)
+    end
+    return tonumber(spent) + tonumber(redis.call('HGET', KEYS[2], field) or '0')
+end
+local key, project, amount = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local key_limit, project_limit = tonumber(ARGV[4]), tonumber(ARGV[5])
+if project_limit > 0 and current(project, ARGV[7]) + amount > project_limit * 0.98 then return 'project' end
+if key_limit > 0 and current(key, ARGV[6]) + amount > key_limit * 0.98 then return 'key' end
+if amount ~= 0 then
+    redis.call('HINCRBYFLOAT', KEYS[2], key, amount)
+    redis.call('HINCRBYFLOAT', KEYS[2], project, amount)
+end
+return false
+"""
+_RELEASE = _LUA_HELPERS + """
+for i = 1, #ARGV, 2 do unhold(ARGV[i], tonumber(ARGV[i + 1])) end
+"""
+_SETTLE = _LUA_HELPERS + """
+-- ARGV: count_spent, number of costs, field, cost, ..., field, reservation, ...
+local n = tonumber(ARGV[2])
+for i = 3, 2 + 2 * n, 2 do
+    if ARGV[1] == '1' and redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBYFLOAT', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('HINCRBYFLOAT', KEYS[3], ARGV[i], ARGV[i + 1])
+end
+for i = 3 + 2 * n, #ARGV, 2 do unhold(ARGV[i], tonumber(ARGV[i + 1])) end
+"""
+_TAKE = """
+local items = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return items
+"""
+_RATE = """
+-- KEYS: one per window; ARGV: ttl, then amount, limit per key
+for i, key in ipairs(KEYS) do
+    local used = tonumber(redis.call('GET', key) or '0')
+    local amount, limit = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    if limit > 0 and used > 0 and used + amount > limit then return i end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('INCRBYFLOAT', key, ARGV[2 * i])
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return 0
+"""
+
+
+class RedisCounters:
+    # The same operations as _TableCounters, for workers on any number of hosts, as Lua scripts
+    shared = True
+
+    def __init__(self, url, prefix):
+        if redis is None:
+            raise RuntimeError("COUNTERS_BACKEND = 'redis' needs redis-py (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.hashes = [f'{prefix}spent', f'{prefix}held', f'{prefix}unflushed']
+        self._reserve = self.client.register_script(_RESERVE)
+        self._release = self.client.register_script(_RELEASE)
+        self._settle = self.client.register_script(_SETTLE)
+        self._take = self.client.register_script(_TAKE)
+        self._rate = self.client.register_script(_RATE)
+
+    def reserve(self, internal_api_key_id, project_id, amount, key_limit, project_limit, key_spent, project_spent):
+        key, project = _fields(internal_api_key_id, project_id)
+        failed = self._reserve(keys=self.hashes, args=[key, project, amount, key_limit or 0, project_limit or 0,
+                                                       key_spent or 0, project_spent or 0])
+        return failed.decode() if failed else None
+
+    def release(self, internal_api_key_id, project_id, amount):
+        if amount:
+            key, project = _fields(internal_api_key_id, project_id)
+            self._release(keys=self.hashes, args=[key, amount, project, amount])
+
+    def settle(self, key_costs, project_costs, reservations, count_spent=True):
+        costs = list(_joined(key_costs, project_costs).items())
+        args = ['1' if count_spent else '0', len(costs)] + [x for pair in costs for x in pair]
+        for internal_api_key_id, project_id, amount in reservations:
+            if amount:
+                key, project = _fields(internal_api_key_id, project_id)
+                args += [key, amount, project, amount]
+        if len(args) > 2:
+            self._settle(keys=self.hashes, args=args)
+
+    def take_unflushed(self):
+        items = self._take(keys=[self.hashes[2]])
+        return _split({items[i].decode(): float(items[i + 1]) for i in range(0, len(items), 2)})
+
+    def set_spent(self, key_totals, project_totals):
+        totals = _joined(key_totals, project_totals)
+        with self.client.pipeline() as pipe:  # MULTI/EXEC
+            pipe.delete(self.hashes[0], self.hashes[2])
+            if totals:
+                pipe.hset(self.hashes[0], mapping=totals)
+            pipe.execute()
+
+    def consume_rate(self, items, window=60):
+        index = int(time.time() // window)
+        keys = [f'{self.prefix}rate:{name}:{index}' for name, _, _ in items]
+        args = [window * 2] + [x for _, amount, limit in items for x in (amount, limit or 0)]
+        over = self._rate(keys=keys, args=args)
+        return items[over - 1][0] if over else None
+
+    def held(self):
+        return _split({field.decode(): float(value) for field, value in self.client.hgetall(self.hashes[1]).items()})
+
+
+class Counters:
+    """Counters shared by the workers: spend, reservations in flight and token rates.
+
+    COUNTERS_BACKEND picks where they live: 'local' keeps them per process
+    (spend checks use the db totals held by the auth cache, as before),
+    'shm' shares them between the workers of one host through a memory-mapped
+    file at COUNTERS_SHM_PATH, 'redis' between all hosts through the server
+    at COUNTERS_REDIS_URL. Every check-and-reserve is one atomic operation.
+    With a shared backend, saved spend is added to the counters at once and
+    to the db totals every COUNTERS_FLUSH_INTERVAL seconds (see spend.py),
+    and tokens_per_minute is also enforced across workers (see admission.py).
+    """
+
+    def __init__(self):
+        self.backend = LocalCounters()
+
+    def init_app(self, app):
+        app.config.setdefault('COUNTERS_BACKEND', 'local')
+        app.config.setdefault('COUNTERS_SHM_PATH', os.path.join(app.instance_path, 'counters.shm'))
+        app.config.setdefault('COUNTERS_SHM_SLOTS', 65536)
+        app.config.setdefault('COUNTERS_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('COUNTERS_REDIS_PREFIX', 'openai_manager:')
+        name = app.config['COUNTERS_BACKEND']
+        if name == 'local':
+            self.backend = LocalCounters()
+        elif name == 'shm':
+            self.backend = SharedMemoryCounters(app.config['COUNTERS_SHM_PATH'], app.config['COUNTERS_SHM_SLOTS'])
+        elif name == 'redis':
+            self.backend = RedisCounters(app.config['COUNTERS_REDIS_URL'], app.config['COUNTERS_REDIS_PREFIX'])
+        else:
+            raise ValueError(f"COUNTERS_BACKEND must be local, shm or redis, not {name!r}")
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    def __getattr__(self, name):
+        # reserve, release, settle, take_unflushed, set_spent, consume_rate, held
+        return getattr(self.backend, name)
+
+
+counters = Counters()
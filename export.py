@@ -0,0 +1,120 @@
+"""Streaming export of api_response as NDJSON or CSV.
+
+Rows are read with a server-side cursor (stream_results + yield_per) and
+written out in ~64KB pieces, optionally gzipped on the fly, so memory stays
+flat however many rows match. Used by /api_responses/export and
+`flask export-api-responses`.
+"""
+from datetime import datetime, timedelta
+import csv, io, json, zlib
+from models import db, APIResponse, InternalAPIKey, Project, User
+from payloads import payload_store
+
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson
+    orjson = None
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+COLUMNS = ('id', 'time_created', 'project_id', 'project', 'user_id', 'username', 'internal_api_key_id',
+           'model_name', 'tokens_in', 'tokens_out', 'in_cost', 'out_cost', 'cached', 'hedge')
+PAYLOAD_COLUMNS = ('request', 'response')
+PIECE_SIZE = 64 * 1024
+
+
+def export_query(project_ids=None, user_id=None, model=None, start=None, end=None, payloads=False):
+    # start and end are dates, both included, as in the activity report
+    r, k = APIResponse.__table__, InternalAPIKey.__table__
+    p, u = Project.__table__, User.__table__
+    columns = [r.c.id, r.c.time_created, k.c.project_id, p.c.name.label('project'), k.c.user_id, u.c.username,
+               r.c.internal_api_key_id, r.c.model_name, r.c.tokens_in, r.c.tokens_out, r.c.in_cost, r.c.out_cost,
+               r.c.cached, r.c.hedge]
+    if payloads:
+        columns += [r.c.request, r.c.response, r.c.request_ref, r.c.response_ref]
+    query = db.select(*columns).select_from(
+        r.outerjoin(k, r.c.internal_api_key_id == k.c.id)
+         .outerjoin(p, k.c.project_id == p.c.id)
+         .outerjoin(u, k.c.user_id == u.c.id))
+    if project_ids is not None:
+        query = query.where(k.c.project_id.in_(project_ids))
+    if user_id is not None:
+        query = query.where(k.c.user_id == user_id)
+    if model:
+        query = query.where(r.c.model_name == model)
+    if start:
+        query = query.where(r.c.time_created >= datetime(start.year, start.month, start.day))
+    if end:
+        query = query.where(r.c.time_created < datetime(end.year, end.month, end.day) + timedelta(days=1))
+    return query
+
+
+def iter_records(query, payloads=False, chunk_size=5000):
+    # -> dicts of COLUMNS (+ PAYLOAD_COLUMNS), fetched chunk_size rows at a time
+    result = db.session.connection().execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+    for chunk in result.mappings().partitions():
+        for row in chunk:
+            record = {c: row[c] for c in COLUMNS}
+            if payloads:
+                record['request'] = row['request'] if row['request_ref'] is None else payload_store.load(row['request_ref'])
+                record['response'] = row['response'] if row['response_ref'] is None else payload_store.load(row['response_ref'])
+            yield record
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def ndjson_lines(records):
+    for record in records:
+        if orjson is not None:
+            yield orjson.dumps(record) + b'\n'
+        else:
+            yield json.dumps(record, default=_iso).encode() + b'\n'
+
+
+def csv_lines(records, payloads=False):
+    # payloads go in as JSON text
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS + (PAYLOAD_COLUMNS if payloads else ()))
+    for record in records:
+        row = [record[c] for c in COLUMNS]
+        row[1] = row[1].isoformat() if row[1] else ''
+        if payloads:
+            row += [None if record[c] is None else json.dumps(record[c]) for c in PAYLOAD_COLUMNS]
+        writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def pieces(lines, size=PIECE_SIZE):
+    # joins small lines into pieces of about size bytes
+    pending, length = [], 0
+    for line in lines:
+        pending.append(line)
+        length += len(line)
+        if length >= size:
+            yield b''.join(pending)
+            pending, length = [], 0
+    if pending:
+        yield b''.join(pending)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(fmt='ndjson', payloads=False, gzip=False, chunk_size=5000, **filters):
+    # -> iterator of bytes of the whole export
+    records = iter_records(export_query(payloads=payloads, **filters), payloads, chunk_size)
+    lines = ndjson_lines(records) if fmt == 'ndjson' else csv_lines(records, payloads)
+    out = pieces(lines)
+    return gzipped(out) if gzip else out
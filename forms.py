@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, SelectMultipleField, IntegerField, DateTimeField, SelectField
+from wtforms import StringField, PasswordField, SubmitField, SelectMultipleField, IntegerField, DateTimeField, SelectField, BooleanField
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError
 from wtforms.fields import DateTimeLocalField
 from datetime import datetime
@@ -13,10 +13,16 @@ class LoginForm(FlaskForm):
 class ProjectForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     api_key = SelectField('Choose which OpenAI API key to use for this project', coerce=int)
+    extra_api_keys = SelectMultipleField('More OpenAI API keys to spread its calls over (optional)', coerce=int)
     spending_limit = IntegerField('Spending Limit ($US). Leave at 0 for no spending limit.')
     users = SelectMultipleField('Users', coerce=int)
     project_leads = SelectMultipleField('Project Leads', coerce=int)
     allowed_models = SelectMultipleField('Allowed Models', coerce=int)
+    payload_policy = SelectField('Which request and response bodies to keep',
+                                 choices=[('full', 'Everything'), ('truncated', 'Truncated'),
+                                          ('metadata', 'Nothing, only tokens and cost'), ('sampled', 'A sample')],
+                                 default='full')
+    response_cache_enabled = BooleanField('Answer repeated deterministic calls from the response cache')
     submit = SubmitField('Submit')
 
 class OpenAIModelForm(FlaskForm):
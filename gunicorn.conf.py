@@ -0,0 +1,24 @@
+# Picked up automatically by gunicorn from the working directory
+import os, shutil
+
+# /metrics adds up the metrics of all workers through files in this directory (see metrics.py)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'prometheus'))
+
+def on_starting(server):
+    # metrics of a previous run would be added to ours
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+def worker_exit(server, worker):
+    # flush queued APIResponse rows before the worker goes away
+    from write_behind import api_response_writer
+    from spend import spend_ledger
+    api_response_writer.stop()
+    spend_ledger.stop()
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
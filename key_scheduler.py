@@ -0,0 +1,384 @@
+from collections import deque
+from concurrent.futures import wait as futures_wait, FIRST_COMPLETED
+import asyncio, json, logging, math, random, re, threading, time
+import requests
+from werkzeug.exceptions import HTTPException, TooManyRequests
+from upstream import upstream, async_upstream
+from metrics import metrics
+from resilience import resilience, TIMEOUT_ERRORS
+
+try:
+    import httpx
+    TRANSIENT_ERRORS = (requests.RequestException, httpx.TransportError)
+except ImportError:
+    TRANSIENT_ERRORS = (requests.RequestException,)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+log = logging.getLogger(__name__)
+
+
+def parse_duration(value):
+    # OpenAI's x-ratelimit-reset-* values ('20ms', '1s', '6m0s', '1h2m3.5s') -> seconds
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(n) * scale[unit] for n, unit in parts)
+
+
+class _KeyState:
+    # What one worker knows about one APIKey
+    def __init__(self):
+        self.calls = deque()  # (time, estimated tokens) within the window
+        self.window_tokens = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.cooldown_until = 0
+        self.limit_requests = None
+        self.limit_tokens = None
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.remaining_until = 0
+
+    def trim(self, now, window):
+        while self.calls and self.calls[0][0] < now - window:
+            self.window_tokens -= self.calls.popleft()[1]
+
+    def utilisation(self, now):
+        # share of the per-minute limits in use, by our own count or by what upstream last told us
+        used = []
+        if self.limit_requests:
+            used.append(len(self.calls) / self.limit_requests)
+        if self.limit_tokens:
+            used.append(self.window_tokens / self.limit_tokens)
+        if now < self.remaining_until:
+            if self.limit_requests and self.remaining_requests is not None:
+                used.append(1 - self.remaining_requests / self.limit_requests)
+            if self.limit_tokens and self.remaining_tokens is not None:
+                used.append(1 - self.remaining_tokens / self.limit_tokens)
+        return max(used, default=0.0)
+
+
+class KeyScheduler:
+    """Spreads a project's upstream calls over its pool of APIKeys.
+
+    Each call goes to the least loaded key that isn't cooling down after a
+    429: lowest utilisation of its rate limits (counted over the last
+    KEY_SCHEDULER_WINDOW seconds and read from upstream's x-ratelimit-*
+    headers), then fewest calls in flight. 429s, 5xx and connection errors
+    are retried on another key up to UPSTREAM_MAX_RETRIES times, with
+    jittered exponential backoff starting at UPSTREAM_RETRY_BACKOFF seconds.
+    When every key is cooling down for longer than UPSTREAM_RETRY_MAX_BACKOFF,
+    the call gets a 429 with Retry-After instead. Counters are per worker
+    process.
+    """
+
+    def __init__(self):
+        self.window = 60
+        self.max_retries = 2
+        self.backoff = 0.25
+        self.max_backoff = 8
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('KEY_SCHEDULER_WINDOW', self.window)
+        app.config.setdefault('UPSTREAM_MAX_RETRIES', self.max_retries)
+        app.config.setdefault('UPSTREAM_RETRY_BACKOFF', self.backoff)
+        app.config.setdefault('UPSTREAM_RETRY_MAX_BACKOFF', self.max_backoff)
+        self.window = app.config['KEY_SCHEDULER_WINDOW']
+        self.max_retries = app.config['UPSTREAM_MAX_RETRIES']
+        self.backoff = app.config['UPSTREAM_RETRY_BACKOFF']
+        self.max_backoff = app.config['UPSTREAM_RETRY_MAX_BACKOFF']
+
+    def _state(self, api_key_id):
+        state = self._keys.get(api_key_id)
+        if state is None:
+            state = self._keys.setdefault(api_key_id, _KeyState())
+        return state
+
+    def pick(self, keys, exclude=()):
+        # keys: [(api_key_id, key_string)] -> the one to use next, and seconds until it's off cooldown
+        now = time.monotonic()
+        candidates = [k for k in keys if k[0] not in exclude] or list(keys)
+        with self._lock:
+            def load(key):
+                state = self._state(key[0])
+                state.trim(now, self.window)
+                return (state.cooldown_until > now and state.cooldown_until, state.utilisation(now),
+                        state.in_flight, len(state.calls))
+            key = min(candidates, key=load)
+            return key, max(0.0, self._state(key[0]).cooldown_until - now)
+
+    def _choose(self, keys, model, tried):
+        # pick() for the next attempt; rather than send it to a key known to be rate limited,
+        # a 429 when every key is cooling down for longer than we'd wait
+        usable = resilience.available(keys, model)
+        key, wait = self.pick(usable, tried)
+        if wait > self.max_backoff and tried:
+            key, wait = self.pick(usable)  # a key already tried may be free
+        if wait > self.max_backoff:
+            retry_after = math.ceil(wait)
+            log.warning('All %d upstream API keys are rate limited for %s, the next for %ss', len(keys), model, retry_after)
+            raise TooManyRequests(f'Every upstream API key is rate limited; try again in {retry_after}s',
+                                  retry_after=retry_after)
+        return key, wait
+
+    def post(self, path, keys, data=None, json=None, stream=False, model=None, on_hedge=None):
+        # upstream.post with the Authorization of a key from the pool; retries on another key.
+        # on_hedge(content) is called with the 200 body of a hedged call's losing copy, to bill it.
+        if data is None:
+            data = _dumps(json)
+        tokens = len(data) // 4
+        tried = set()
+        attempt = 0
+        while True:
+            key, wait = self._choose(keys, model, tried)
+            if wait:
+                time.sleep(wait)
+            delay = None if stream else resilience.hedge_delay(path, model)
+            executor = delay is not None and resilience.hedge_slot()
+            try:
+                if executor:
+                    resp = self._hedged(executor, delay, path, keys, key, data, tokens, model, on_hedge)
+                else:
+                    resp = self._send(path, key, data, tokens, stream, model)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise resilience.failed(e) from e
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return resp
+                resp.close()
+            attempt += 1
+            self._retried(tried, key[0], keys)
+            time.sleep(self._backoff(attempt))
+
+    def _send(self, path, key, data, tokens, stream, model):
+        # one attempt on one key
+        api_key_id, key_string = key
+        self._start(api_key_id, tokens)
+        resilience.started(api_key_id, model)
+        started = time.perf_counter()
+        try:
+            resp = upstream.post(path, api_key_id, headers=_headers(key_string), data=data, stream=stream,
+                                 timeout=resilience.timeout(path, model))
+        except TRANSIENT_ERRORS as e:
+            self._failed(path, api_key_id, model, e)
+            raise
+        except BaseException:
+            self._abandoned(api_key_id, model)
+            raise
+        self._answered(path, api_key_id, model, resp, None if stream else time.perf_counter() - started)
+        return resp
+
+    def _hedged(self, executor, delay, path, keys, key, data, tokens, model, on_hedge):
+        # A call that's slower than usual is sent again, to another key when there is one,
+        # and the first good answer wins. The other copy is billed too, so on_hedge records it.
+        try:
+            first = executor.submit(self._send, path, key, data, tokens, False, model)
+            done, _ = futures_wait([first], timeout=delay)
+            if done:
+                return first.result()
+            try:
+                second_key, wait = self.pick(resilience.available(keys, model), {key[0]})
+            except HTTPException:
+                return first.result()
+            if wait:
+                return first.result()  # the other keys are rate limited
+            second = executor.submit(self._send, path, second_key, data, tokens, False, model)
+            pending = [first, second]
+            while True:
+                done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    if not pending or future.exception() is None and future.result().status_code not in RETRY_STATUSES:
+                        resilience.count_hedge(path, model, won=future is second)
+                        loser = first if future is second else second
+                        loser.add_done_callback(lambda loser: _bill_loser(loser, on_hedge))
+                        return future.result()
+        finally:
+            resilience.release_hedge_slot()
+
+    async def post_async(self, path, keys, data, stream=False, model=None, on_hedge=None):
+        # post() for the asyncio engine, through async_upstream
+        tokens = len(data) // 4
+        tried = set()
+        attempt = 0
+        while True:
+            key, wait = self._choose(keys, model, tried)
+            if wait:
+                await asyncio.sleep(wait)
+            delay = None if stream else resilience.hedge_delay(path, model)
+            try:
+                if delay is not None:
+                    resp = await self._hedged_async(delay, path, keys, key, data, tokens, model, on_hedge)
+                else:
+                    resp = await self._send_async(path, key, data, tokens, stream, model)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise resilience.failed(e) from e
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return resp
+                if stream:
+                    await resp.aclose()
+            attempt += 1
+            self._retried(tried, key[0], keys)
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def _send_async(self, path, key, data, tokens, stream, model):
+        api_key_id, key_string = key
+        self._start(api_key_id, tokens)
+        resilience.started(api_key_id, model)
+        started = time.perf_counter()
+        try:
+            resp = await async_upstream.post(path, api_key_id, headers=_headers(key_string), data=data, stream=stream,
+                                             timeout=resilience.timeout(path, model))
+        except TRANSIENT_ERRORS as e:
+            self._failed(path, api_key_id, model, e)
+            raise
+        except BaseException:
+            self._abandoned(api_key_id, model)
+            raise
+        self._answered(path, api_key_id, model, resp, None if stream else time.perf_counter() - started)
+        return resp
+
+    async def _hedged_async(self, delay, path, keys, key, data, tokens, model, on_hedge):
+        # _hedged() on the event loop; the losing copy is left to finish on its own
+        first = asyncio.ensure_future(self._send_async(path, key, data, tokens, False, model))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        try:
+            second_key, wait = self.pick(resilience.available(keys, model), {key[0]})
+        except HTTPException:
+            return await first
+        if wait:
+            return await first
+        second = asyncio.ensure_future(self._send_async(path, second_key, data, tokens, False, model))
+        pending = {first, second}
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not pending or task.exception() is None and task.result().status_code not in RETRY_STATUSES:
+                    loser = first if task is second else second
+                    loser.add_done_callback(lambda loser: _bill_loser(loser, on_hedge, asyncio.get_running_loop()))
+                    resilience.count_hedge(path, model, won=task is second)
+                    return task.result()
+
+    def _failed(self, path, api_key_id, model, e):
+        self._finish(api_key_id, None, None)
+        metrics.upstream_response(path, 'timeout' if isinstance(e, TIMEOUT_ERRORS) else 'error')
+        resilience.finished(path, api_key_id, model, None, error=e)
+
+    def _abandoned(self, api_key_id, model):
+        # cancelled or a bug, not the upstream's fault
+        self._finish(api_key_id, None, None)
+        resilience.abandoned(api_key_id, model)
+
+    def _answered(self, path, api_key_id, model, resp, seconds):
+        self._finish(api_key_id, resp.status_code, resp.headers)
+        metrics.upstream_response(path, resp.status_code)
+        resilience.finished(path, api_key_id, model, resp.status_code, seconds)
+
+    def _retried(self, tried, api_key_id, keys):
+        tried.add(api_key_id)
+        if len(tried) >= len(keys):
+            tried.clear()
+
+    def _backoff(self, attempt):
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _start(self, api_key_id, tokens):
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(api_key_id)
+            state.trim(now, self.window)
+            state.calls.append((now, tokens))
+            state.window_tokens += tokens
+            state.in_flight += 1
+            state.requests += 1
+
+    def _finish(self, api_key_id, status_code, headers):
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(api_key_id)
+            state.in_flight -= 1
+            if headers is None:
+                return
+            for attr, header in (('limit_requests', 'x-ratelimit-limit-requests'),
+                                 ('limit_tokens', 'x-ratelimit-limit-tokens'),
+                                 ('remaining_requests', 'x-ratelimit-remaining-requests'),
+                                 ('remaining_tokens', 'x-ratelimit-remaining-tokens')):
+                if headers.get(header, '').isdigit():
+                    setattr(state, attr, int(headers[header]))
+            resets = [parse_duration(headers.get(h)) for h in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+            resets = [r for r in resets if r is not None]
+            if resets:
+                state.remaining_until = now + max(resets)
+            if status_code == 429:
+                state.throttled += 1
+                if headers.get('retry-after-ms'):
+                    retry_after = parse_duration(headers['retry-after-ms'] + 'ms')
+                else:
+                    retry_after = parse_duration(headers.get('retry-after'))  # http-dates aren't handled
+                state.cooldown_until = now + (retry_after or max(resets, default=1.0))
+            elif state.remaining_requests == 0 and resets:
+                state.cooldown_until = now + resets[0]
+
+    def stats(self):
+        now = time.monotonic()
+        out = {}
+        with self._lock:
+            for api_key_id, state in self._keys.items():
+                state.trim(now, self.window)
+                out[api_key_id] = {
+                    'requests': state.requests,
+                    'window_requests': len(state.calls),
+                    'window_tokens': state.window_tokens,
+                    'in_flight': state.in_flight,
+                    'throttled': state.throttled,
+                    'utilisation': round(state.utilisation(now), 3),
+                    'limit_requests': state.limit_requests,
+                    'limit_tokens': state.limit_tokens,
+                    'cooling_down_for': round(max(0.0, state.cooldown_until - now), 1),
+                }
+        return out
+
+
+def _dumps(body):
+    return json.dumps(body).encode()
+
+
+def _bill_loser(future, on_hedge, loop=None):
+    # A hedged call's losing copy, once it's done: upstream bills it if it got a 200.
+    # Its errors were logged by resilience.finished. With a loop, on_hedge runs in a thread.
+    if future.cancelled() or future.exception() is not None or on_hedge is None:
+        return
+    resp = future.result()
+    if resp.status_code != 200:
+        return
+    if loop is not None:
+        loop.run_in_executor(None, on_hedge, resp.content)
+        return
+    try:
+        on_hedge(resp.content)
+    except Exception:
+        log.exception('Saving the usage of a hedged call failed')
+
+
+def _headers(key_string):
+    return {'Content-Type': 'application/json', 'Authorization': f'Bearer {key_string}'}
+
+
+key_scheduler = KeyScheduler()
@@ -0,0 +1,92 @@
+import os
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # optional, /metrics answers 501 without it
+    prometheus_client = None
+
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+SLOW_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Metrics:
+    """Prometheus metrics for the proxy: latency of auth, upstream and db writes,
+    request and upstream status counters, calls in flight, tokens and cost.
+
+    Needs prometheus_client; without it every method is a no-op. Under
+    gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a shared
+    directory so /metrics adds up all workers.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.token = app.config['METRICS_TOKEN']
+        if prometheus_client is None or self.enabled:
+            return
+        self.enabled = True
+        Counter, Histogram, Gauge = prometheus_client.Counter, prometheus_client.Histogram, prometheus_client.Gauge
+        self.requests = Counter('proxy_requests_total', 'Proxied calls by response status',
+                                ['project', 'model', 'endpoint', 'status'])
+        self.request_seconds = Histogram('proxy_request_seconds', 'Time until the response (headers, when streamed)',
+                                         ['project', 'model', 'endpoint'], buckets=SLOW_BUCKETS)
+        self.in_flight = Gauge('proxy_in_flight', 'Proxied calls being handled', ['endpoint'],
+                               multiprocess_mode='livesum')
+        self.auth_seconds = Histogram('proxy_auth_seconds', 'API key lookup and checks', buckets=FAST_BUCKETS)
+        self.upstream_seconds = Histogram('proxy_upstream_seconds', 'Upstream calls, retries included',
+                                          ['project', 'model', 'endpoint'], buckets=SLOW_BUCKETS)
+        self.upstream_responses = Counter('proxy_upstream_responses_total', 'Upstream responses by status, per attempt',
+                                          ['endpoint', 'status'])
+        self.db_write_seconds = Histogram('proxy_db_write_seconds', 'Writing a batch of api_response rows',
+                                          buckets=FAST_BUCKETS + (2.5, 5, 10))
+        self.db_rows = Counter('proxy_db_rows_total', 'api_response rows written')
+        self.tokens = Counter('proxy_tokens_total', 'Tokens of saved calls', ['project', 'model', 'direction'])
+        self.cost = Counter('proxy_cost_dollars_total', 'Cost of saved calls', ['project', 'model'])
+
+    def request_started(self, endpoint):
+        if self.enabled:
+            self.in_flight.labels(endpoint).inc()
+
+    def request_finished(self, endpoint, project, model, status, seconds):
+        if self.enabled:
+            self.in_flight.labels(endpoint).dec()
+            self.requests.labels(project or '', model or '', endpoint, str(status)).inc()
+            self.request_seconds.labels(project or '', model or '', endpoint).observe(seconds)
+
+    def observe_auth(self, seconds):
+        if self.enabled:
+            self.auth_seconds.observe(seconds)
+
+    def observe_upstream(self, endpoint, project, model, seconds):
+        if self.enabled:
+            self.upstream_seconds.labels(project or '', model or '', endpoint).observe(seconds)
+
+    def upstream_response(self, endpoint, status):
+        if self.enabled:
+            self.upstream_responses.labels(endpoint, str(status)).inc()
+
+    def observe_db_write(self, seconds, rows):
+        if self.enabled:
+            self.db_write_seconds.observe(seconds)
+            self.db_rows.inc(rows)
+
+    def count_usage(self, project, model, tokens_in, tokens_out, cost):
+        if self.enabled:
+            self.tokens.labels(project, model, 'in').inc(tokens_in or 0)
+            self.tokens.labels(project, model, 'out').inc(tokens_out or 0)
+            if cost:
+                self.cost.labels(project, model).inc(cost)
+
+    def render(self):
+        # -> (body, content type) of a scrape
+        registry = prometheus_client.REGISTRY
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+metrics = Metrics()
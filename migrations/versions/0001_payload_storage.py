@@ -0,0 +1,55 @@
+"""payload storage: api_response payload refs, project payload policy, payload_blob
+
+Revision ID: 0001_payload_storage
+Revises: 
+Create Date: 2026-10-18 09:40:00
+
+The schema was created with db.create_all() until now, and the app still
+calls it on start, so every step here checks what already exists.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_payload_storage'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    existing = _columns('api_response')
+    with op.batch_alter_table('api_response') as batch_op:
+        if 'request_ref' not in existing:
+            batch_op.add_column(sa.Column('request_ref', sa.String(length=64), nullable=True))
+        if 'response_ref' not in existing:
+            batch_op.add_column(sa.Column('response_ref', sa.String(length=64), nullable=True))
+    existing = _columns('project')
+    with op.batch_alter_table('project') as batch_op:
+        if 'payload_policy' not in existing:
+            batch_op.add_column(sa.Column('payload_policy', sa.String(length=16), nullable=True, server_default='full'))
+        if 'payload_sample_rate' not in existing:
+            batch_op.add_column(sa.Column('payload_sample_rate', sa.Float(), nullable=True, server_default='0.01'))
+    if not sa.inspect(op.get_bind()).has_table('payload_blob'):
+        op.create_table('payload_blob',
+            sa.Column('digest', sa.String(length=64), nullable=False),
+            sa.Column('codec', sa.String(length=8), nullable=False),
+            sa.Column('size', sa.Integer(), nullable=True),
+            sa.Column('data', sa.LargeBinary(), nullable=False),
+            sa.PrimaryKeyConstraint('digest')
+        )
+
+
+def downgrade():
+    op.drop_table('payload_blob')
+    with op.batch_alter_table('project') as batch_op:
+        batch_op.drop_column('payload_sample_rate')
+        batch_op.drop_column('payload_policy')
+    with op.batch_alter_table('api_response') as batch_op:
+        batch_op.drop_column('response_ref')
+        batch_op.drop_column('request_ref')
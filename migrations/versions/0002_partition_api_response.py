@@ -0,0 +1,90 @@
+"""partition api_response by month on time_created, archived_partition table
+
+Revision ID: 0002_partition_api_response
+Revises: 0001_payload_storage
+Create Date: 2026-10-18 10:05:00
+
+PostgreSQL only: api_response is rebuilt as a table partitioned by range
+on time_created, with one partition per month from the oldest row to three
+months ahead. The primary key becomes (id, time_created), as partitioned
+tables require. New months are added with "flask partitions create"; until
+then their rows land in the api_response_default partition.
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_partition_api_response'
+down_revision = '0001_payload_storage'
+branch_labels = None
+depends_on = None
+
+
+def _add_months(dt, n):
+    month = dt.month - 1 + n
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('archived_partition'):
+        op.create_table('archived_partition',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=64), nullable=False),
+            sa.Column('range_start', sa.DateTime(), nullable=False),
+            sa.Column('range_end', sa.DateTime(), nullable=False),
+            sa.Column('path', sa.String(length=512), nullable=False),
+            sa.Column('format', sa.String(length=16), nullable=False),
+            sa.Column('row_count', sa.Integer(), nullable=True),
+            sa.Column('time_archived', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('name')
+        )
+    if bind.dialect.name != 'postgresql':
+        return
+    partitioned = bind.execute(sa.text(
+        "SELECT count(*) FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'api_response'")).scalar()
+    if partitioned:
+        return
+
+    op.execute("UPDATE api_response SET time_created = now() at time zone 'utc' WHERE time_created IS NULL")
+    op.execute("ALTER TABLE api_response RENAME TO api_response_unpartitioned")
+    op.execute("ALTER SEQUENCE api_response_id_seq OWNED BY NONE")
+    op.execute("CREATE TABLE api_response (LIKE api_response_unpartitioned INCLUDING DEFAULTS) "
+               "PARTITION BY RANGE (time_created)")
+    op.execute("ALTER TABLE api_response ALTER COLUMN time_created SET NOT NULL")
+    op.execute("ALTER TABLE api_response ADD PRIMARY KEY (id, time_created)")
+    op.execute("ALTER TABLE api_response ADD FOREIGN KEY (internal_api_key_id) REFERENCES internal_api_key (id)")
+    op.execute("ALTER SEQUENCE api_response_id_seq OWNED BY api_response.id")
+
+    oldest = bind.execute(sa.text("SELECT min(time_created) FROM api_response_unpartitioned")).scalar()
+    now = datetime.utcnow()
+    start = datetime((oldest or now).year, (oldest or now).month, 1)
+    last = _add_months(datetime(now.year, now.month, 1), 3)
+    while start <= last:
+        op.execute(f"CREATE TABLE api_response_y{start.year}m{start.month:02d} PARTITION OF api_response "
+                   f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{_add_months(start, 1):%Y-%m-%d}')")
+        start = _add_months(start, 1)
+    # catches rows for months nobody created a partition for yet
+    op.execute("CREATE TABLE api_response_default PARTITION OF api_response DEFAULT")
+
+    op.execute("INSERT INTO api_response SELECT * FROM api_response_unpartitioned")
+    op.execute("DROP TABLE api_response_unpartitioned")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute("ALTER SEQUENCE api_response_id_seq OWNED BY NONE")
+        op.execute("ALTER TABLE api_response RENAME TO api_response_partitioned")
+        op.execute("CREATE TABLE api_response (LIKE api_response_partitioned INCLUDING DEFAULTS)")
+        op.execute("ALTER TABLE api_response ADD PRIMARY KEY (id)")
+        op.execute("ALTER TABLE api_response ALTER COLUMN time_created DROP NOT NULL")
+        op.execute("ALTER TABLE api_response ADD FOREIGN KEY (internal_api_key_id) REFERENCES internal_api_key (id)")
+        op.execute("ALTER SEQUENCE api_response_id_seq OWNED BY api_response.id")
+        op.execute("INSERT INTO api_response SELECT * FROM api_response_partitioned")
+        op.execute("DROP TABLE api_response_partitioned CASCADE")
+    op.drop_table('archived_partition')
@@ -0,0 +1,48 @@
+"""response cache: project opt-in, cached flag on api_response, savings in usage_daily
+
+Revision ID: 0003_response_cache
+Revises: 0002_partition_api_response
+Create Date: 2026-10-18 11:20:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_response_cache'
+down_revision = '0002_partition_api_response'
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if 'cached' not in _columns('api_response'):
+        # on postgres this also reaches every monthly partition
+        op.add_column('api_response', sa.Column('cached', sa.Boolean(), nullable=True, server_default=sa.false()))
+    existing = _columns('project')
+    with op.batch_alter_table('project') as batch_op:
+        if 'response_cache_enabled' not in existing:
+            batch_op.add_column(sa.Column('response_cache_enabled', sa.Boolean(), nullable=True, server_default=sa.false()))
+        if 'response_cache_ttl' not in existing:
+            batch_op.add_column(sa.Column('response_cache_ttl', sa.Integer(), nullable=True))
+    if sa.inspect(op.get_bind()).has_table('usage_daily'):
+        existing = _columns('usage_daily')
+        with op.batch_alter_table('usage_daily') as batch_op:
+            if 'cached_requests' not in existing:
+                batch_op.add_column(sa.Column('cached_requests', sa.Integer(), nullable=True, server_default='0'))
+            if 'saved_cost' not in existing:
+                batch_op.add_column(sa.Column('saved_cost', sa.Float(), nullable=True, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('usage_daily') as batch_op:
+        batch_op.drop_column('saved_cost')
+        batch_op.drop_column('cached_requests')
+    with op.batch_alter_table('project') as batch_op:
+        batch_op.drop_column('response_cache_ttl')
+        batch_op.drop_column('response_cache_enabled')
+    op.drop_column('api_response', 'cached')
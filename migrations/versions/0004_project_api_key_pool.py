@@ -0,0 +1,29 @@
+"""projects_api_keys: a pool of APIKeys per project
+
+Revision ID: 0004_project_api_key_pool
+Revises: 0003_response_cache
+Create Date: 2026-10-18 12:10:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_project_api_key_pool'
+down_revision = '0003_response_cache'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not sa.inspect(op.get_bind()).has_table('projects_api_keys'):
+        op.create_table('projects_api_keys',
+            sa.Column('project_id', sa.Integer(), nullable=True),
+            sa.Column('api_key_id', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['api_key_id'], ['api_key.id'], ),
+            sa.ForeignKeyConstraint(['project_id'], ['project.id'], )
+        )
+
+
+def downgrade():
+    op.drop_table('projects_api_keys')
@@ -0,0 +1,46 @@
+"""admission limits on project and internal_api_key
+
+Revision ID: 0005_admission_limits
+Revises: 0004_project_api_key_pool
+Create Date: 2026-10-18 12:50:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_admission_limits'
+down_revision = '0004_project_api_key_pool'
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    existing = _columns('project')
+    with op.batch_alter_table('project') as batch_op:
+        if 'max_concurrency' not in existing:
+            batch_op.add_column(sa.Column('max_concurrency', sa.Integer(), nullable=True))
+        if 'tokens_per_minute' not in existing:
+            batch_op.add_column(sa.Column('tokens_per_minute', sa.Integer(), nullable=True))
+        if 'share_weight' not in existing:
+            batch_op.add_column(sa.Column('share_weight', sa.Float(), nullable=True, server_default='1'))
+    existing = _columns('internal_api_key')
+    with op.batch_alter_table('internal_api_key') as batch_op:
+        if 'max_concurrency' not in existing:
+            batch_op.add_column(sa.Column('max_concurrency', sa.Integer(), nullable=True))
+        if 'tokens_per_minute' not in existing:
+            batch_op.add_column(sa.Column('tokens_per_minute', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('internal_api_key') as batch_op:
+        batch_op.drop_column('tokens_per_minute')
+        batch_op.drop_column('max_concurrency')
+    with op.batch_alter_table('project') as batch_op:
+        batch_op.drop_column('share_weight')
+        batch_op.drop_column('tokens_per_minute')
+        batch_op.drop_column('max_concurrency')
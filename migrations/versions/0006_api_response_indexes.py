@@ -0,0 +1,31 @@
+"""composite indexes on api_response for per-key, per-model and keyset listing
+
+Revision ID: 0006_api_response_indexes
+Revises: 0005_admission_limits
+Create Date: 2026-10-18 14:10:00
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_api_response_indexes'
+down_revision = '0005_admission_limits'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_api_response_key_time': '(internal_api_key_id, time_created)',
+    'ix_api_response_model_time': '(model_name, time_created)',
+    'ix_api_response_time_id': '(time_created, id)',
+}
+
+
+def upgrade():
+    # on a partitioned api_response (PostgreSQL) this creates them on every partition too
+    for name, columns in INDEXES.items():
+        op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON api_response {columns}")
+
+
+def downgrade():
+    for name in INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
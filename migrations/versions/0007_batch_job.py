@@ -0,0 +1,44 @@
+"""batch_job: JSONL batch jobs run by `flask batch-worker`
+
+Revision ID: 0007_batch_job
+Revises: 0006_api_response_indexes
+Create Date: 2026-10-18 16:20:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_batch_job'
+down_revision = '0006_api_response_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not sa.inspect(op.get_bind()).has_table('batch_job'):
+        op.create_table('batch_job',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('internal_api_key_id', sa.Integer(), nullable=True),
+            sa.Column('endpoint', sa.String(length=64), nullable=True),
+            sa.Column('status', sa.String(length=16), nullable=True),
+            sa.Column('total_lines', sa.Integer(), nullable=True),
+            sa.Column('completed_lines', sa.Integer(), nullable=True),
+            sa.Column('failed_lines', sa.Integer(), nullable=True),
+            sa.Column('cost', sa.Float(), nullable=True),
+            sa.Column('error', sa.String(length=512), nullable=True),
+            sa.Column('time_created', sa.DateTime(), nullable=True),
+            sa.Column('time_started', sa.DateTime(), nullable=True),
+            sa.Column('time_finished', sa.DateTime(), nullable=True),
+            sa.Column('heartbeat', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['internal_api_key_id'], ['internal_api_key.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_batch_job_internal_api_key_id', 'batch_job', ['internal_api_key_id'])
+        op.create_index('ix_batch_job_status', 'batch_job', ['status'])
+
+
+def downgrade():
+    op.drop_index('ix_batch_job_status', table_name='batch_job')
+    op.drop_index('ix_batch_job_internal_api_key_id', table_name='batch_job')
+    op.drop_table('batch_job')
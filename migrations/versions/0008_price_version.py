@@ -0,0 +1,31 @@
+"""price_version: a generation counter so every worker notices price changes
+
+Revision ID: 0008_price_version
+Revises: 0007_batch_job
+Create Date: 2026-10-19 10:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_price_version'
+down_revision = '0007_batch_job'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('price_version'):
+        op.create_table('price_version',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('generation', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not bind.execute(sa.text('SELECT 1 FROM price_version WHERE id = 1')).first():
+        bind.execute(sa.text('INSERT INTO price_version (id, generation) VALUES (1, 0)'))
+
+
+def downgrade():
+    op.drop_table('price_version')
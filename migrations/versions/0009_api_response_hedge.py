@@ -0,0 +1,25 @@
+"""hedge flag on api_response: the losing copy of a hedged upstream call
+
+Revision ID: 0009_api_response_hedge
+Revises: 0008_price_version
+Create Date: 2026-10-19 11:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009_api_response_hedge'
+down_revision = '0008_price_version'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'hedge' not in {c['name'] for c in sa.inspect(op.get_bind()).get_columns('api_response')}:
+        # on postgres this also reaches every monthly partition
+        op.add_column('api_response', sa.Column('hedge', sa.Boolean(), nullable=True, server_default=sa.false()))
+
+
+def downgrade():
+    op.drop_column('api_response', 'hedge')
@@ -2,7 +2,8 @@ from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy import JSON, and_, or_, desc
+from sqlalchemy import JSON, and_, or_, desc, event
+from sqlalchemy.orm import Session
 
 db = SQLAlchemy()
 
@@ -25,6 +26,12 @@ projects_models = db.Table('projects_models',
     db.Column('open_ai_model_id', db.Integer, db.ForeignKey('open_ai_model.id'))
 )
 
+# Extra APIKeys a project spreads its calls over, next to Project.api_key (see key_scheduler.py)
+projects_api_keys = db.Table('projects_api_keys',
+    db.Column('project_id', db.Integer, db.ForeignKey('project.id')),
+    db.Column('api_key_id', db.Integer, db.ForeignKey('api_key.id'))
+)
+
 class APIKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
@@ -62,6 +69,17 @@ class Project(db.Model):
     api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id')) 
     spending_limit = db.Column(db.Float, default = 0)
     total_spent = db.Column(db.Float, default = 0)
+    # What to keep of request/response bodies: full, truncated, metadata (nothing) or sampled
+    payload_policy = db.Column(db.String(16), default='full')
+    payload_sample_rate = db.Column(db.Float, default=0.01)
+    # Serve repeated deterministic calls from the response cache (response_cache.py)
+    response_cache_enabled = db.Column(db.Boolean, default=False)
+    response_cache_ttl = db.Column(db.Integer)  # seconds, RESPONSE_CACHE_TTL when empty
+    # Admission limits (admission.py); empty means no limit
+    max_concurrency = db.Column(db.Integer)
+    tokens_per_minute = db.Column(db.Integer)
+    share_weight = db.Column(db.Float, default=1.0)  # share of capacity when projects compete for it
+    api_keys = db.relationship('APIKey', secondary=projects_api_keys, backref=db.backref('pool_projects', lazy='dynamic'))
     allowed_models = db.relationship('OpenAIModel', secondary=projects_models, backref=db.backref('projects', lazy='dynamic'))
     internal_api_keys = db.relationship('InternalAPIKey', backref='project', lazy='dynamic')
     
@@ -70,24 +88,28 @@ class Project(db.Model):
 
 
     def update_spending(self):
-        for internal_api_key in self.internal_api_keys:
-            # Fetch all the APIResponse objects once
-            api_responses = APIResponse.query.filter(
-                APIResponse.internal_api_key_id == internal_api_key.id,
-                APIResponse.time_created > internal_api_key.spending_last_checked
-            ).all()
-            # Find the most recent time_created among these APIResponses
-            latest_time_created = max([api_response.time_created for api_response in api_responses], default=None)
-            # Now calculate and update the spending for this InternalAPIKey
-            for api_response in api_responses:
-                cost = api_response.get_costs()
-                if cost:  # Make sure the cost was actually computed
-                    internal_api_key.total_spent += cost['total_cost']
-            # Update the spending_last_checked to the most recent time_created
-            if latest_time_created:
-                internal_api_key.spending_last_checked = latest_time_created
-        # Now, update the Project.total_spent to reflect the sum of total_spent of all its internal_api_keys
-        self.total_spent = sum([internal_api_key.total_spent for internal_api_key in self.internal_api_keys])
+        # Reconciliation for the totals the writer increments on every saved call:
+        # recompute them from api_response with one aggregate query per project,
+        # plus whatever was archived
+        spent = db.select(db.func.coalesce(db.func.sum(db.func.coalesce(APIResponse.in_cost, 0) + db.func.coalesce(APIResponse.out_cost, 0)), 0)) \
+            .where(APIResponse.internal_api_key_id == InternalAPIKey.id).scalar_subquery()
+        db.session.execute(db.update(InternalAPIKey)
+                           .where(InternalAPIKey.project_id == self.id)
+                           .values(total_spent=spent, spending_last_checked=datetime.utcnow())
+                           .execution_options(synchronize_session=False))
+        # months that were archived out of api_response (see archive.py)
+        from archive import archived_spend
+        key_ids = [id for (id,) in db.session.query(InternalAPIKey.id).filter(InternalAPIKey.project_id == self.id)]
+        archived = [{'b_id': id, 'b_cost': cost} for id, cost in archived_spend(key_ids).items() if cost]
+        if archived:
+            table = InternalAPIKey.__table__
+            db.session.execute(table.update().where(table.c.id == db.bindparam('b_id'))
+                               .values(total_spent=table.c.total_spent + db.bindparam('b_cost')), archived)
+        key_totals = db.select(db.func.coalesce(db.func.sum(InternalAPIKey.total_spent), 0)) \
+            .where(InternalAPIKey.project_id == Project.id).scalar_subquery()
+        db.session.execute(db.update(Project).where(Project.id == self.id).values(total_spent=key_totals)
+                           .execution_options(synchronize_session=False))
+        db.session.expire(self)
 
 
 class OpenAIModel(db.Model):
@@ -115,52 +137,127 @@ class ModelCost(db.Model):
     end_date = db.Column(db.DateTime, nullable=True)
 
 
+class PriceVersion(db.Model):
+    # One row, bumped in the same transaction as any change to ModelCost or OpenAIModel,
+    # so every process can tell cheaply that its PriceIndex is stale (see pricing.py)
+    __tablename__ = 'price_version'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
 class APIResponse(db.Model):
     __tablename__ = 'api_response'
+    __table_args__ = (db.Index('ix_api_response_key_time', 'internal_api_key_id', 'time_created'),
+                      db.Index('ix_api_response_model_time', 'model_name', 'time_created'),
+                      db.Index('ix_api_response_time_id', 'time_created', 'id'))
     id = db.Column(db.Integer, primary_key=True)
     model_name = db.Column(db.String(64))
     tokens_in = db.Column(db.Integer)
     tokens_out = db.Column(db.Integer)
     internal_api_key_id = db.Column(db.Integer, db.ForeignKey('internal_api_key.id')) 
-    request = db.Column(JSON)
-    response = db.Column(JSON)
+    # deferred: loaded on first access, not with every row of a listing
+    request = db.deferred(db.Column(JSON))
+    response = db.deferred(db.Column(JSON))
+    # set instead of request/response when bodies are kept in the payload store (payloads.py)
+    request_ref = db.Column(db.String(64))
+    response_ref = db.Column(db.String(64))
     time_created = db.Column(db.DateTime, default=datetime.utcnow)
     in_cost = db.Column(db.Float)
     out_cost = db.Column(db.Float)
+    cached = db.Column(db.Boolean, default=False)  # served from the response cache, costs nothing
+    hedge = db.Column(db.Boolean, default=False)  # the losing copy of a hedged call: billed, but nobody got it
+
+    def get_request(self):
+        from payloads import payload_store
+        return self.request if self.request_ref is None else payload_store.load(self.request_ref)
+
+    def get_response(self):
+        from payloads import payload_store
+        return self.response if self.response_ref is None else payload_store.load(self.response_ref)
 
     def update_cost(self):
-        # Get the relevant OpenAIModel
-        open_ai_model = OpenAIModel.query.filter_by(name=self.model_name).first()
-        current_cost = open_ai_model.get_current_cost()
-        # Compute the costs
-        self.in_cost = self.tokens_in * current_cost.in_tokens_cost / 1000 # price is in per 1k tokens
-        self.out_cost = self.tokens_out * current_cost.out_tokens_cost / 1000
+        from pricing import price_index
+        cost = price_index.cost(self.model_name, self.tokens_in, self.tokens_out)
+        if cost is not None:
+            self.in_cost, self.out_cost = cost
 
 
     #@todo: this is not used anymore, but it might be called in different places. Clean it up before deleting the method
     def get_costs(self):
-        # Get the relevant OpenAIModel
-        open_ai_model = OpenAIModel.query.filter_by(name=self.model_name).first()
-
-        if not open_ai_model:
-            return None  # or you may want to raise an exception
-
-        # Query the ModelCost instances for this OpenAIModel
-        # that were valid at the time of this APIResponse
-        model_cost = ModelCost.query.filter(
-            ModelCost.model_id == open_ai_model.id,
-            and_(ModelCost.start_date <= self.time_created, 
-                 or_(ModelCost.end_date >= self.time_created, ModelCost.end_date.is_(None)))
-        ).first()
-        if not model_cost:
-            return None  
-
-        # Compute the costs
-        in_cost = self.tokens_in * model_cost.in_tokens_cost
-        out_cost = self.tokens_out * model_cost.out_tokens_cost
+        # Costs at the price that was valid when this call was made
+        from pricing import price_index
+        cost = price_index.cost(self.model_name, self.tokens_in, self.tokens_out, self.time_created)
+        if cost is None:
+            return None
+        in_cost, out_cost = cost
         return {'in_cost': in_cost, 'out_cost': out_cost, 'total_cost' : in_cost+out_cost}
 
 
+class PayloadBlob(db.Model):
+    # Compressed request/response bodies, content addressed by sha256 of the JSON
+    __tablename__ = 'payload_blob'
+    digest = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.String(8), nullable=False)
+    size = db.Column(db.Integer)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class ArchivedPartition(db.Model):
+    # A month of api_response that was exported to a columnar file and dropped (see archive.py)
+    __tablename__ = 'archived_partition'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    range_start = db.Column(db.DateTime, nullable=False)
+    range_end = db.Column(db.DateTime, nullable=False)
+    path = db.Column(db.String(512), nullable=False)
+    format = db.Column(db.String(16), nullable=False)
+    row_count = db.Column(db.Integer)
+    time_archived = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class UsageDaily(db.Model):
+    # Per day, internal API key and model sums of api_response, kept up to date
+    # by the writer (see usage.py). The activity report reads this, not api_response.
+    __tablename__ = 'usage_daily'
+    day = db.Column(db.Date, primary_key=True)
+    internal_api_key_id = db.Column(db.Integer, db.ForeignKey('internal_api_key.id'), primary_key=True)
+    model_name = db.Column(db.String(64), primary_key=True)
+    requests = db.Column(db.Integer, default=0, nullable=False)
+    tokens_in = db.Column(db.BigInteger, default=0, nullable=False)
+    tokens_out = db.Column(db.BigInteger, default=0, nullable=False)
+    in_cost = db.Column(db.Float, default=0, nullable=False)
+    out_cost = db.Column(db.Float, default=0, nullable=False)
+    cached_requests = db.Column(db.Integer, default=0, nullable=False)
+    saved_cost = db.Column(db.Float, default=0, nullable=False)  # what the cached requests would have cost
+
+
+class BatchJob(db.Model):
+    # A JSONL file of calls run in the background for an internal API key (see batches.py).
+    # The output file is the checkpoint; the counts here are refreshed as the job runs.
+    __tablename__ = 'batch_job'
+    id = db.Column(db.Integer, primary_key=True)
+    internal_api_key_id = db.Column(db.Integer, db.ForeignKey('internal_api_key.id'), index=True)
+    endpoint = db.Column(db.String(64))  # for lines without a url, e.g. v1/embeddings
+    status = db.Column(db.String(16), default='queued', index=True)  # queued, running, completed, failed, cancelled
+    total_lines = db.Column(db.Integer, default=0)
+    completed_lines = db.Column(db.Integer, default=0)
+    failed_lines = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0)
+    error = db.Column(db.String(512))
+    time_created = db.Column(db.DateTime, default=datetime.utcnow)
+    time_started = db.Column(db.DateTime)
+    time_finished = db.Column(db.DateTime)
+    heartbeat = db.Column(db.DateTime)  # while running; a job whose heartbeat stops is taken over
+
+    def to_dict(self):
+        return {'id': self.id, 'endpoint': self.endpoint, 'status': self.status, 'total_lines': self.total_lines,
+                'completed_lines': self.completed_lines, 'failed_lines': self.failed_lines,
+                'cost': self.cost, 'error': self.error,
+                'time_created': self.time_created and self.time_created.isoformat(),
+                'time_started': self.time_started and self.time_started.isoformat(),
+                'time_finished': self.time_finished and self.time_finished.isoformat()}
+
+
 class InternalAPIKey(db.Model):
     __tablename__ = 'internal_api_key'
     id = db.Column(db.Integer, primary_key=True)
@@ -175,6 +272,8 @@ class InternalAPIKey(db.Model):
     spending_last_checked = db.Column(db.DateTime)
     time_created = db.Column(db.DateTime, default=datetime.utcnow)
     active = db.Column(db.Boolean, default=True)
+    max_concurrency = db.Column(db.Integer)
+    tokens_per_minute = db.Column(db.Integer)
     api_responses = db.relationship('APIResponse', backref='internal_api_key', lazy='dynamic')
 
     @classmethod
@@ -187,4 +286,43 @@ class InternalAPIKey(db.Model):
         if self.end_date is None:
             return today >= self.start_date
         else:
-            return self.start_date <= today <= self.end_date
\ No newline at end of file
+            return self.start_date <= today <= self.end_date
+
+
+# Callbacks that run after a commit touched one of the watched model classes.
+# Used by the in-process caches to drop stale entries when rows change through
+# the admin views or the /new/* routes.
+_change_watchers = []
+
+def on_commit_of(classes, callback):
+    _change_watchers.append((tuple(classes), callback))
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_models(session, flush_context):
+    changed = session.info.setdefault('changed_models', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed.add(type(obj))
+
+@event.listens_for(Session, 'after_flush')
+def _bump_price_version(session, flush_context):
+    if not any(isinstance(obj, (ModelCost, OpenAIModel))
+               for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        return
+    table = PriceVersion.__table__
+    connection = session.connection()
+    if not connection.execute(table.update().where(table.c.id == 1)
+                              .values(generation=table.c.generation + 1)).rowcount:
+        connection.execute(table.insert().values(id=1, generation=1))
+
+@event.listens_for(Session, 'after_commit')
+def _run_change_watchers(session):
+    changed = session.info.pop('changed_models', None)
+    if not changed:
+        return
+    for classes, callback in _change_watchers:
+        if any(issubclass(c, classes) for c in changed):
+            callback()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_changed_models(session, previous_transaction):
+    session.info.pop('changed_models', None)
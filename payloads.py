@@ -0,0 +1,147 @@
+import gzip, hashlib, json, os, random, tempfile
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, PayloadBlob
+
+try:
+    import zstandard
+except ImportError:  # optional, falls back to gzip
+    zstandard = None
+
+POLICIES = ('full', 'truncated', 'metadata', 'sampled')
+
+
+def _truncate(obj, max_chars, max_items):
+    # Keeps the shape of a body but cuts long strings and lists (embedding vectors, transcripts)
+    if isinstance(obj, str):
+        return obj if len(obj) <= max_chars else obj[:max_chars] + f'... [{len(obj) - max_chars} more chars]'
+    if isinstance(obj, list):
+        items = [_truncate(v, max_chars, max_items) for v in obj[:max_items]]
+        if len(obj) > max_items:
+            items.append(f'... [{len(obj) - max_items} more items]')
+        return items
+    if isinstance(obj, dict):
+        return {k: _truncate(v, max_chars, max_items) for k, v in obj.items()}
+    return obj
+
+
+class PayloadStore:
+    """Decides which request/response bodies are kept, and where.
+
+    keeps() and capture() apply the project's payload_policy when a call is saved.
+    With PAYLOAD_STORAGE set to 'table' or 'files', the writer moves the kept
+    bodies out of api_response into compressed, content-addressed blobs
+    (the payload_blob table, or files under PAYLOAD_DIR) and only stores their
+    digests. 'inline' keeps them in the api_response row as before.
+    APIResponse.get_request()/get_response() read them back either way.
+    """
+
+    def __init__(self):
+        self.storage = 'inline'
+        self.directory = None
+        self.truncate_chars = 1000
+        self.truncate_items = 16
+        self.codec = 'zstd' if zstandard else 'gzip'
+
+    def init_app(self, app):
+        app.config.setdefault('PAYLOAD_STORAGE', self.storage)
+        app.config.setdefault('PAYLOAD_DIR', os.path.join(app.instance_path, 'payloads'))
+        app.config.setdefault('PAYLOAD_TRUNCATE_CHARS', self.truncate_chars)
+        app.config.setdefault('PAYLOAD_TRUNCATE_ITEMS', self.truncate_items)
+        self.storage = app.config['PAYLOAD_STORAGE']
+        self.directory = app.config['PAYLOAD_DIR']
+        self.truncate_chars = app.config['PAYLOAD_TRUNCATE_CHARS']
+        self.truncate_items = app.config['PAYLOAD_TRUNCATE_ITEMS']
+        if self.storage not in ('inline', 'table', 'files'):
+            raise ValueError(f"PAYLOAD_STORAGE must be inline, table or files, not {self.storage!r}")
+
+    def keeps(self, policy, sample_rate):
+        # whether a call's bodies are kept at all; decided before the response body is decoded
+        return not (policy == 'metadata' or policy == 'sampled' and random.random() >= (sample_rate or 0))
+
+    def capture(self, policy, req_json, resp_json):
+        # -> (request, response) to keep for a call that keeps() said yes to
+        if policy == 'truncated':
+            return (_truncate(req_json, self.truncate_chars, self.truncate_items),
+                    _truncate(resp_json, self.truncate_chars, self.truncate_items))
+        return req_json, resp_json
+
+    def offload(self, rows):
+        # Moves request/response of APIResponse column dicts into the store. Runs in the writer's transaction.
+        if self.storage == 'inline':
+            return
+        blobs = {}
+        for row in rows:
+            for field in ('request', 'response'):
+                if row.get(field) is None:
+                    continue
+                raw = json.dumps(row[field], sort_keys=True, separators=(',', ':')).encode()
+                digest = hashlib.sha256(raw).hexdigest()
+                if digest not in blobs:
+                    blobs[digest] = raw
+                row[f'{field}_ref'] = digest
+                row[field] = None
+        if self.storage == 'files':
+            for digest, raw in blobs.items():
+                self._write_file(digest, raw)
+        elif blobs:
+            self._insert_blobs([{'digest': d, 'codec': self.codec, 'size': len(raw), 'data': self._compress(raw)}
+                                for d, raw in blobs.items()])
+
+    def load(self, digest):
+        if digest is None:
+            return None
+        for codec in ('zstd', 'gzip'):
+            path = self._path(digest, codec)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return json.loads(self._decompress(codec, f.read()))
+        blob = db.session.get(PayloadBlob, digest)
+        if blob is not None:
+            return json.loads(self._decompress(blob.codec, blob.data))
+        return None
+
+    def _insert_blobs(self, blobs):
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            db.session.execute(insert(PayloadBlob).on_conflict_do_nothing(index_elements=['digest']), blobs)
+            return
+        existing = {d for (d,) in db.session.query(PayloadBlob.digest).filter(PayloadBlob.digest.in_([b['digest'] for b in blobs]))}
+        db.session.add_all(PayloadBlob(**b) for b in blobs if b['digest'] not in existing)
+
+    def _path(self, digest, codec):
+        ext = 'zst' if codec == 'zstd' else 'gz'
+        return os.path.join(self.directory, digest[:2], digest[2:4], f'{digest}.{ext}')
+
+    def _write_file(self, digest, raw):
+        path = self._path(digest, self.codec)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a temp file of its own, so threads and workers saving the same blob don't write into each other's
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'{digest}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._compress(raw))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            # the same content under the same name: fine if someone else got it there first
+            if not os.path.exists(path):
+                raise
+
+    def _compress(self, raw):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(raw)
+        return gzip.compress(raw, compresslevel=6)
+
+    @staticmethod
+    def _decompress(codec, data):
+        if codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+
+payload_store = PayloadStore()
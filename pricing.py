@@ -0,0 +1,110 @@
+from bisect import bisect_right
+from datetime import datetime
+import threading, time
+from models import db, ModelCost, OpenAIModel, PriceVersion, on_commit_of
+
+
+class PriceIndex:
+    """All ModelCost rows in memory, as per-model interval lists sorted by start_date.
+
+    Answers "what did model X cost at time T" by bisection instead of two
+    queries per lookup. Loaded lazily and dropped whenever a commit in this
+    process touches ModelCost or OpenAIModel (change_price, delete_cost,
+    /new/model, admin). Such commits also bump price_version, which every
+    process reads at most every PRICE_CHECK_INTERVAL seconds, so other
+    workers reload too. Prices are per 1k tokens, like ModelCost.
+    """
+
+    def __init__(self):
+        self.check_interval = 5
+        self._models = None
+        self._generation = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PRICE_CHECK_INTERVAL', self.check_interval)
+        self.check_interval = app.config['PRICE_CHECK_INTERVAL']
+
+    def invalidate(self):
+        self._models = None
+
+    def _index(self):
+        models = self._models
+        if models is not None and time.monotonic() - self._checked >= self.check_interval:
+            with self._lock:
+                if time.monotonic() - self._checked >= self.check_interval:
+                    self._checked = time.monotonic()
+                    if self._read_generation() != self._generation:
+                        self._models = None
+            models = self._models
+        if models is None:
+            with self._lock:
+                models = self._models
+                if models is None:
+                    # read first: a change committed while loading shows up at the next check
+                    self._generation = self._read_generation()
+                    self._checked = time.monotonic()
+                    models = self._models = self._load()
+        return models
+
+    def _read_generation(self):
+        return db.session.query(PriceVersion.generation).filter(PriceVersion.id == 1).scalar()
+
+    def _load(self):
+        rows = db.session.query(OpenAIModel.name, ModelCost.start_date, ModelCost.end_date,
+                                ModelCost.in_tokens_cost, ModelCost.out_tokens_cost) \
+            .join(ModelCost, ModelCost.model_id == OpenAIModel.id) \
+            .order_by(OpenAIModel.name, ModelCost.start_date).all()
+        models = {}
+        for name, start, end, in_cost, out_cost in rows:
+            starts, intervals = models.setdefault(name, ([], []))
+            starts.append(start)
+            intervals.append((end, in_cost, out_cost))
+        return models
+
+    def price(self, model_name, at=None):
+        # (in_tokens_cost, out_tokens_cost) valid at `at`, or None if the model has no price then
+        entry = self._index().get(model_name)
+        if entry is None:
+            return None
+        return self._lookup(entry, at or datetime.utcnow())
+
+    @staticmethod
+    def _lookup(entry, at):
+        starts, intervals = entry
+        i = bisect_right(starts, at) - 1
+        if i < 0:
+            return None
+        for j in range(i, -1, -1):
+            end, in_cost, out_cost = intervals[j]
+            if end is None or end >= at:
+                return in_cost, out_cost
+        # change_price ends the old cost a day before the new one starts, so
+        # calls on that day fall in a gap; bill them at the last price that started
+        return intervals[i][1:]
+
+    def cost(self, model_name, tokens_in, tokens_out, at=None):
+        # (in_cost, out_cost) in USD, or None if the model has no price
+        price = self.price(model_name, at)
+        if price is None:
+            return None
+        return tokens_in * price[0] / 1000, tokens_out * price[1] / 1000
+
+    def bulk_costs(self, rows):
+        # rows: iterable of (model_name, time_created, tokens_in, tokens_out).
+        # Returns a list of (in_cost, out_cost) or None, in the same order.
+        index = self._index()
+        out = []
+        for model_name, at, tokens_in, tokens_out in rows:
+            entry = index.get(model_name)
+            price = self._lookup(entry, at) if entry is not None and at is not None else None
+            if price is None:
+                out.append(None)
+            else:
+                out.append(((tokens_in or 0) * price[0] / 1000, (tokens_out or 0) * price[1] / 1000))
+        return out
+
+
+price_index = PriceIndex()
+on_commit_of([ModelCost, OpenAIModel], price_index.invalidate)
@@ -0,0 +1,176 @@
+"""Pieces of the /v1/* proxy shared by the Flask views (app.py) and the asyncio engine (asgi.py)."""
+import json, logging, re
+from werkzeug.exceptions import Unauthorized, Forbidden
+from payloads import payload_store
+from pricing import price_index
+from metrics import metrics
+from upstream import loads
+from tokenizer import tokenizer
+from write_behind import api_response_writer
+
+log = logging.getLogger(__name__)
+
+# upstream response headers passed on to the client with the body
+FORWARDED_HEADERS = ('content-type', 'openai-model', 'openai-processing-ms', 'openai-version', 'x-request-id')
+
+_USAGE_KEY = re.compile(rb'"usage"\s*:\s*')
+_decoder = json.JSONDecoder()
+
+
+def bearer_token(auth_header):
+    if not auth_header:
+        raise Unauthorized('No Authorization header')
+    try:
+        auth_type, token = auth_header.split()
+    except ValueError:
+        raise Unauthorized('Invalid Authorization header')
+    if auth_type.lower() != 'bearer':
+        raise Unauthorized('Invalid Authorization type')
+    return token
+
+
+def check_api_key(ik):
+    # ik is the auth_cache.AuthEntry of the token, or None
+    if ik is None:
+        raise Unauthorized('Invalid API key')
+    if not ik.is_current():
+        raise Forbidden("Your API key is not current")
+    if not ik.api_keys:
+        raise Forbidden("Your project has no API key")
+
+
+def cache_ttl(ik):
+    # None when the project doesn't use the response cache, 0 for the default ttl
+    return (ik.response_cache_ttl or 0) if ik.response_cache_enabled else None
+
+
+def forwarded_headers(headers):
+    return [(name, headers[name]) for name in FORWARDED_HEADERS if name in headers]
+
+
+def parse_usage(content):
+    # The usage object of a JSON response body, without decoding the rest
+    # (embedding vectors are most of it). It comes last, so search from the end;
+    # inside strings the quotes of "usage" would be escaped.
+    at = content.rfind(b'"usage"')
+    match = _USAGE_KEY.match(content, at) if at != -1 else None
+    if match is not None:
+        try:
+            usage, _ = _decoder.raw_decode(content[match.end():].decode())
+            if isinstance(usage, dict):
+                return usage
+        except ValueError:
+            pass
+    try:
+        usage = loads(content).get('usage')
+    except (ValueError, AttributeError):
+        usage = None
+    if not isinstance(usage, dict):
+        # billed as no tokens rather than failing a call the client has its answer for
+        log.warning('An upstream response of %d bytes has no usage', len(content))
+        return {}
+    return usage
+
+
+def api_call_record(ik, req_json, resp_json, reservation=0, cached=False, hedge=False):
+    # The APIResponse row for a call, as handed to api_response_writer.submit.
+    # resp_json may also be the raw response body: then only its usage is
+    # parsed, unless the project keeps response bodies. A hedge row keeps no bodies.
+    raw = None
+    if isinstance(resp_json, bytes):
+        raw, resp_json = resp_json, None
+        usage = parse_usage(raw)
+    else:
+        usage = resp_json.get('usage') or {}
+    req_payload = resp_payload = None
+    if not hedge and payload_store.keeps(ik.payload_policy, ik.payload_sample_rate):
+        if resp_json is None:
+            try:
+                resp_json = loads(raw)
+            except ValueError:
+                resp_json = raw.decode('utf-8', 'replace')
+        req_payload, resp_payload = payload_store.capture(ik.payload_policy, req_json, resp_json)
+    record = dict(model_name=req_json['model'],
+                  tokens_in=usage.get('prompt_tokens', 0),
+                  tokens_out=usage.get('completion_tokens', 0),
+                  internal_api_key_id=ik.internal_api_key_id,
+                  request=req_payload,
+                  response=resp_payload,
+                  project_id=ik.project_id,
+                  reservation=reservation)
+    if cached:
+        # served from the response cache: free, but the tokens still show up as savings
+        record.update(cached=True, in_cost=0, out_cost=0)
+    if hedge:
+        record['hedge'] = True
+    return record
+
+
+def count_usage(ik, record):
+    # tokens and cost of a saved call for /metrics; the writer prices the row again when it saves it
+    if not metrics.enabled:
+        return
+    cost = None
+    if not record.get('cached'):
+        cost = price_index.cost(record['model_name'], record['tokens_in'], record['tokens_out'])
+    metrics.count_usage(ik.project_name, record['model_name'], record['tokens_in'], record['tokens_out'],
+                        sum(cost) if cost else 0)
+
+
+def hedge_recorder(app, ik, req_json):
+    # on_hedge for key_scheduler.post: saves the usage of a hedged call's losing copy,
+    # which upstream bills as well. Called from whichever thread that copy finished on.
+    def record(content):
+        with app.app_context():
+            hedge_record = api_call_record(ik, req_json, content, hedge=True)
+            count_usage(ik, hedge_record)
+            api_response_writer.submit(hedge_record)
+    return record
+
+
+def streamed_request(req_json):
+    # Ask upstream to append a usage chunk so we can still bill the call. If the
+    # client didn't ask for it themselves StreamUsage swallows that chunk again.
+    stream_options = req_json.get('stream_options') or {}
+    return {**req_json, 'stream_options': {**stream_options, 'include_usage': True}}, \
+        stream_options.get('include_usage', False)
+
+
+class StreamUsage:
+    # Picks the usage and text out of the SSE lines of a streamed call as they are relayed
+    def __init__(self, client_wants_usage, endpoint, req_json):
+        self.client_wants_usage = client_wants_usage
+        self.endpoint = endpoint
+        self.req_json = req_json
+        self.usage = None
+        self.content = []
+        self.chunks = 0
+
+    def feed(self, line):
+        # -> whether to pass the line on to the client
+        if line.startswith(b'data: ') and line != b'data: [DONE]':
+            try:
+                chunk = json.loads(line[6:])
+            except ValueError:
+                chunk = {}
+            if chunk.get('usage'):
+                self.usage = chunk['usage']
+                if not chunk.get('choices') and not self.client_wants_usage:
+                    return False
+            for choice in chunk.get('choices') or []:
+                text = choice.get('text') or (choice.get('delta') or {}).get('content')
+                if text:
+                    self.content.append(text)
+                    self.chunks += 1
+        return True
+
+    def response(self):
+        # what gets saved as the call's response
+        usage = self.usage
+        content = ''.join(self.content)
+        if usage is None:
+            # stream was cut short or upstream sent no usage: count the tokens ourselves
+            model = self.req_json.get('model') or ''
+            usage = {'prompt_tokens': tokenizer.estimate(self.endpoint, self.req_json)[0],
+                     'completion_tokens': max(tokenizer.count(model, content), self.chunks)}
+        return {'stream': True, 'content': content, 'usage': usage}
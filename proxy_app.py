@@ -0,0 +1,324 @@
+"""The proxy: the /v1/* routes, and an app factory for workers that serve nothing else.
+
+app.py is the admin role (UI, Flask-Admin, reports, CLI) and registers these
+routes as well unless PROXY_ROUTES is off. A proxy role worker, started with
+`gunicorn 'proxy_app:create_app()'`, never imports Flask-Admin, WTForms or
+the UI views, and doesn't touch the database until its first call.
+"""
+from datetime import datetime
+import os, time
+from functools import wraps
+from flask import Flask, current_app, request, jsonify, Response, make_response, g, stream_with_context, send_file
+from werkzeug.exceptions import HTTPException, BadRequest, Unauthorized, Forbidden, TooManyRequests
+from models import db, BatchJob
+from auth_cache import auth_cache
+from upstream import upstream, async_upstream
+from write_behind import api_response_writer
+from spend import spend_ledger
+from counters import counters
+from payloads import payload_store
+from response_cache import response_cache, cache_key, is_cacheable
+from coalescer import embedding_coalescer
+from key_scheduler import key_scheduler
+from pricing import price_index
+from resilience import resilience, UPSTREAM_ERRORS
+from admission import admission, estimate_tokens
+from proxy import bearer_token, check_api_key, cache_ttl, api_call_record, count_usage, hedge_recorder, streamed_request, \
+    StreamUsage, forwarded_headers
+from metrics import metrics
+from tracing import tracer, phase
+from tokenizer import tokenizer
+from batches import batch_runner
+
+PROXY_ENDPOINTS = {'v1/chat/completions': ['POST', 'GET'], 'v1/completions': ['POST'], 'v1/embeddings': ['POST']}
+
+
+def configure(app):
+    # what both roles need: settings, the extensions and JSON errors
+    # app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db' # Use SQLite for simplicity
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://myuser:mypassword@db/mydatabase'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = '2e3368c5ee5bd49c9635924c55bd22277bddebcd379c662b'
+    app.config.from_prefixed_env()  # e.g. FLASK_UPSTREAM_BASE_URL=http://localhost:8080
+
+    db.init_app(app)
+    counters.init_app(app)
+    auth_cache.init_app(app)
+    upstream.init_app(app)
+    async_upstream.init_app(app)
+    # before the writer: atexit runs the writer's drain first, then the spend flush
+    spend_ledger.init_app(app)
+    tokenizer.init_app(app)
+    api_response_writer.init_app(app)
+    payload_store.init_app(app)
+    response_cache.init_app(app)
+    embedding_coalescer.init_app(app)
+    key_scheduler.init_app(app)
+    price_index.init_app(app)
+    resilience.init_app(app)
+    admission.init_app(app)
+    metrics.init_app(app)
+    tracer.init_app(app)
+    batch_runner.init_app(app)
+
+    app.register_error_handler(Unauthorized, handle_unauthorized)
+    app.register_error_handler(Forbidden, handle_forbidden)
+    app.register_error_handler(TooManyRequests, handle_too_many_requests)
+    for error in UPSTREAM_ERRORS:
+        app.register_error_handler(error, handle_upstream_error)
+
+
+def init_proxy(app):
+    for endpoint, methods in PROXY_ENDPOINTS.items():
+        app.add_url_rule(f'/{endpoint}', endpoint, open_ai_call, methods=methods)
+    app.add_url_rule('/metrics', 'prometheus_metrics', prometheus_metrics)
+    app.add_url_rule('/v1/batches', 'create_batch', create_batch, methods=['POST'])
+    app.add_url_rule('/v1/batches', 'list_batches', list_batches)
+    app.add_url_rule('/v1/batches/<int:job_id>', 'get_batch', get_batch)
+    app.add_url_rule('/v1/batches/<int:job_id>/output', 'batch_output', batch_output)
+    app.add_url_rule('/v1/batches/<int:job_id>/cancel', 'cancel_batch', cancel_batch, methods=['POST'])
+    app.add_url_rule('/v1/batches/<int:job_id>/resume', 'resume_batch', resume_batch, methods=['POST'])
+    app.teardown_request(release_unused_reservation)
+
+
+def create_app():
+    # the proxy role
+    app = Flask(__name__)
+    configure(app)
+    init_proxy(app)
+    return app
+
+
+def prometheus_metrics():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics need prometheus_client (pip install prometheus_client)'}), 501
+    if metrics.token and request.headers.get('Authorization') != f'Bearer {metrics.token}':
+        raise Unauthorized('Invalid metrics token')
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def handle_unauthorized(e):
+    return jsonify({'error': str(e)}), 401
+
+def handle_forbidden(e):
+    return jsonify({'error': str(e)}), 403
+
+def handle_too_many_requests(e):
+    response = jsonify({'error': str(e)})
+    if getattr(e, 'retry_after', None):
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+def handle_upstream_error(e):
+    # timed out, unreachable, or every API key's circuit is open (resilience.py)
+    response = jsonify({'error': str(e)})
+    if getattr(e, 'retry_after', None):
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.code
+
+## function for creating APIResponse objects for db. The row is written in the
+## background by api_response_writer, see write_behind.py
+def save_api_call_and_response(req_json, resp_json, cached=False):
+    record = api_call_record(g.auth_entry, req_json, resp_json, g.pop('reservation', 0), cached)
+    count_usage(g.auth_entry, record)
+    api_response_writer.submit(record)
+
+def release_unused_reservation(exc):
+    # the call never got saved (upstream error etc.), so give the money back
+    if g.get('reservation'):
+        spend_ledger.release(g.internal_api_key_id, g.project_id, g.pop('reservation'))
+
+### route wrapper for checking if API key is current, can use the model, and has money
+def require_api_key(view_function):
+    @wraps(view_function)
+    def decorator(*args, **kwargs):
+        endpoint = request.url_rule.endpoint
+        started = time.perf_counter()
+        metrics.request_started(endpoint)
+        trace = tracer.start()
+        status = 500
+        try:
+            with phase('auth'):
+                token = bearer_token(request.headers.get('Authorization'))
+                ik = auth_cache.get(token)
+                check_api_key(ik)
+            metrics.observe_auth(time.perf_counter() - started)
+            g.auth_entry = ik
+            g.internal_api_key_id = ik.internal_api_key_id
+            g.api_keys = ik.api_keys
+            g.project_id = ik.project_id
+            g.response_cache_ttl = cache_ttl(ik)
+            # checks committed spend plus what in-flight calls have reserved, and reserves this call's worst case
+            with phase('spend'):
+                g.reservation = spend_ledger.reserve(ik, spend_ledger.worst_case(endpoint, request.get_json(silent=True)))
+            # if (model_name := request.get_json()['model']) not in ik.project.model_names():
+            #     raise Forbidden(f"Your API key does not have access to the model {model_name}")
+            # if you have lived a good life and made it this far, we send the request to OpenAI with the real APIKey
+            response = make_response(view_function(*args, **kwargs))
+            status = response.status_code
+            response.headers['Server-Timing'] = trace.server_timing()
+            return response
+        except HTTPException as e:
+            status = e.code
+            raise
+        finally:
+            ik = g.get('auth_entry')
+            model = (request.get_json(silent=True) or {}).get('model')
+            metrics.request_finished(endpoint, ik and ik.project_name, model, status, time.perf_counter() - started)
+            tracer.finish(trace, endpoint, ik and ik.project_name, model, status)
+    return decorator
+
+# don't think I'm using this.. just had to special case out tokens in save_api_call
+# @require_api_key
+# def completions():
+#     url = f"https://api.openai.com/{request.url_rule.endpoint}"
+#     resp = requests.post(url, headers=request.headers, data=request.data)
+#     save_api_call_and_response(request, resp)
+#     return resp.json(), 200
+
+# one endpoint to rule them all, registered by init_proxy
+@require_api_key
+def open_ai_call():
+    if request.method == 'GET':
+        return jsonify("hello")
+    endpoint = request.url_rule.endpoint
+    req_json = request.get_json()
+    if req_json.get('stream'):
+        return stream_open_ai_call(endpoint, req_json)
+    key = None
+    if g.response_cache_ttl is not None and is_cacheable(endpoint, req_json):
+        key = cache_key(g.project_id, endpoint, req_json)
+        with phase('cache'):
+            cached = response_cache.get(key)
+        if cached is not None:
+            with phase('save'):
+                save_api_call_and_response(req_json, cached, cached=True)
+            return Response(cached, status=200, content_type='application/json')
+    resp = None
+    with phase('queue'):
+        ticket = admission.acquire(g.auth_entry, estimate_tokens(request.data, req_json))
+    started = time.perf_counter()
+    try:
+        with phase('upstream'):
+            on_hedge = hedge_recorder(current_app._get_current_object(), g.auth_entry, req_json)
+            if endpoint == 'v1/embeddings' and embedding_coalescer.enabled:
+                resp = embedding_coalescer.post(endpoint, g.api_keys, req_json, on_hedge)
+            if resp is None:
+                resp = key_scheduler.post(endpoint, g.api_keys, data=request.data, model=req_json.get('model'),
+                                          on_hedge=on_hedge)
+    finally:
+        admission.release(ticket)
+        metrics.observe_upstream(endpoint, g.auth_entry.project_name, req_json.get('model'), time.perf_counter() - started)
+    # the upstream's bytes go to the client as they are; only the usage is parsed out of them
+    if resp.status_code == 200:
+        if key is not None:
+            response_cache.set(key, resp.content, g.response_cache_ttl)
+        with phase('save'):
+            save_api_call_and_response(req_json, resp.content)
+    return Response(resp.content, status=resp.status_code, headers=forwarded_headers(resp.headers))
+
+def stream_open_ai_call(endpoint, req_json):
+    upstream_json, client_wants_usage = streamed_request(req_json)
+    # the slot is held until the stream is done
+    with phase('queue'):
+        ticket = admission.acquire(g.auth_entry, estimate_tokens(request.data, req_json))
+    started = time.perf_counter()
+    try:
+        with phase('upstream'):
+            resp = key_scheduler.post(endpoint, g.api_keys, json=upstream_json, stream=True, model=req_json.get('model'))
+    except Exception:
+        admission.release(ticket)
+        raise
+    finally:
+        metrics.observe_upstream(endpoint, g.auth_entry.project_name, req_json.get('model'), time.perf_counter() - started)
+    if resp.status_code != 200:
+        body = resp.content
+        resp.close()
+        admission.release(ticket)
+        return Response(body, status=resp.status_code, content_type=resp.headers.get('Content-Type'))
+
+    def generate():
+        tally = StreamUsage(client_wants_usage, endpoint, req_json)
+        try:
+            for line in resp.iter_lines(chunk_size=None):
+                if tally.feed(line):
+                    yield line + b'\n'
+        finally:
+            resp.close()
+            admission.release(ticket)
+            save_api_call_and_response(req_json, tally.response())
+
+    response = Response(stream_with_context(generate()), content_type='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also when the client goes away before the first chunk
+    response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+
+### batch jobs (batches.py), for the internal API key that created them
+
+def batch_auth():
+    ik = auth_cache.get(bearer_token(request.headers.get('Authorization')))
+    check_api_key(ik)
+    return ik
+
+def own_batch_job(job_id):
+    ik = batch_auth()
+    job = db.session.get(BatchJob, job_id)
+    if job is None or job.internal_api_key_id != ik.internal_api_key_id:
+        return None
+    return job
+
+def create_batch():
+    # the JSONL file as the body, or as the `file` of a form; ?url=/v1/embeddings for lines without one
+    ik = batch_auth()
+    upload = request.files.get('file')
+    try:
+        job = batch_runner.create(ik, upload.stream if upload else request.stream, request.args.get('url'))
+    except BadRequest as e:
+        return jsonify({'error': e.description}), 400
+    return jsonify(job.to_dict()), 201
+
+def list_batches():
+    ik = batch_auth()
+    jobs = BatchJob.query.filter_by(internal_api_key_id=ik.internal_api_key_id) \
+        .order_by(BatchJob.id.desc()).limit(100).all()
+    return jsonify([job.to_dict() for job in jobs])
+
+def get_batch(job_id):
+    job = own_batch_job(job_id)
+    if job is None:
+        return jsonify({'error': 'No such batch job'}), 404
+    return jsonify(job.to_dict())
+
+def batch_output(job_id):
+    # one result per line, in the order they finished; while the job runs, the ones so far
+    job = own_batch_job(job_id)
+    if job is None:
+        return jsonify({'error': 'No such batch job'}), 404
+    path = batch_runner.output_path(job.id)
+    if not os.path.exists(path):
+        return Response(b'', content_type='application/x-ndjson')
+    return send_file(path, mimetype='application/x-ndjson', download_name=f'batch-{job.id}.output.jsonl',
+                     conditional=False, etag=False)
+
+def cancel_batch(job_id):
+    job = own_batch_job(job_id)
+    if job is None:
+        return jsonify({'error': 'No such batch job'}), 404
+    if job.status in ('queued', 'running'):
+        # a running job stops at its next checkpoint
+        job.status = 'cancelled'
+        job.time_finished = datetime.utcnow()
+        db.session.commit()
+    return jsonify(job.to_dict())
+
+def resume_batch(job_id):
+    # runs the lines of a failed or cancelled job that have no result yet
+    job = own_batch_job(job_id)
+    if job is None:
+        return jsonify({'error': 'No such batch job'}), 404
+    if job.status in ('failed', 'cancelled'):
+        job.status, job.error, job.time_finished = 'queued', None, None
+        db.session.commit()
+    return jsonify(job.to_dict())
@@ -0,0 +1,268 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging, math, threading, time
+import requests
+from werkzeug.exceptions import BadGateway, GatewayTimeout, ServiceUnavailable
+
+try:
+    import httpx
+    TIMEOUT_ERRORS = (requests.Timeout, httpx.TimeoutException)
+except ImportError:
+    TIMEOUT_ERRORS = (requests.Timeout,)
+
+log = logging.getLogger(__name__)
+
+# upstream statuses that count against a circuit; 429s are the key scheduler's cooldown
+FAILURE_STATUSES = (500, 502, 503, 504)
+
+
+class UpstreamUnavailable(ServiceUnavailable):
+    # every APIKey that could take the call has its circuit open for the model
+    def __init__(self, description=None, retry_after=None):
+        super().__init__(description)
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(GatewayTimeout):
+    pass
+
+
+class UpstreamError(BadGateway):
+    pass
+
+
+UPSTREAM_ERRORS = (UpstreamUnavailable, UpstreamTimeout, UpstreamError)
+
+
+class _Circuit:
+    # One APIKey and model, as one worker sees it
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.opened = 0
+        self.failed_fast = 0
+
+
+class _Latencies:
+    # the last few seconds to a 200, for the hedging delay
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.added = 0
+        self.cached = None
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.added += 1
+
+    def percentile(self, p, min_samples):
+        if len(self.samples) < min_samples:
+            return None
+        # sorting is the cost here, so redone every tenth of the window only
+        if self.cached is None or self.added >= max(10, self.samples.maxlen // 10):
+            ordered = sorted(self.samples)
+            self.cached = ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+            self.added = 0
+        return self.cached
+
+
+class Resilience:
+    """Timeouts, circuit breakers and hedging around upstream calls (key_scheduler.py).
+
+    UPSTREAM_TIMEOUTS maps an endpoint ('v1/embeddings') or a model name
+    prefix ('gpt-4') to (connect, read) seconds; the longest model prefix
+    wins over the endpoint, and UPSTREAM_CONNECT_TIMEOUT and
+    UPSTREAM_READ_TIMEOUT cover the rest. After UPSTREAM_BREAKER_FAILURES
+    timeouts, connection errors or 5xx in a row, an APIKey's circuit for that
+    model opens: calls go to the project's other keys, or fail at once with a
+    503 when there is none, for UPSTREAM_BREAKER_COOLDOWN seconds. Then one
+    call is let through to probe it. With UPSTREAM_HEDGE on, a call to one of
+    UPSTREAM_HEDGE_ENDPOINTS that takes longer than the
+    UPSTREAM_HEDGE_PERCENTILE of recent ones is sent a second time, to
+    another key when there is one, and the first answer wins. Both copies
+    are billed upstream, and the loser is saved as a hedge row (see
+    key_scheduler.post), so only idempotent and cheap endpoints should be
+    hedged. State is per worker process.
+    """
+
+    def __init__(self):
+        self.timeouts = {'v1/embeddings': (5, 60)}
+        self.connect_timeout = 5
+        self.read_timeout = 600
+        self.breaker_failures = 5
+        self.breaker_cooldown = 30
+        self.hedge = False
+        self.hedge_endpoints = ('v1/embeddings',)
+        self.hedge_percentile = 95
+        self.hedge_min_samples = 50
+        self.hedge_min_delay = 0.05
+        self.hedge_workers = 32
+        self._circuits = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._hedge_slots = None
+        self.timed_out = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def init_app(self, app):
+        app.config.setdefault('UPSTREAM_TIMEOUTS', self.timeouts)
+        app.config.setdefault('UPSTREAM_BREAKER_FAILURES', self.breaker_failures)
+        app.config.setdefault('UPSTREAM_BREAKER_COOLDOWN', self.breaker_cooldown)
+        app.config.setdefault('UPSTREAM_HEDGE', self.hedge)
+        app.config.setdefault('UPSTREAM_HEDGE_ENDPOINTS', self.hedge_endpoints)
+        app.config.setdefault('UPSTREAM_HEDGE_PERCENTILE', self.hedge_percentile)
+        app.config.setdefault('UPSTREAM_HEDGE_MIN_SAMPLES', self.hedge_min_samples)
+        app.config.setdefault('UPSTREAM_HEDGE_MIN_DELAY', self.hedge_min_delay)
+        app.config.setdefault('UPSTREAM_HEDGE_WORKERS', self.hedge_workers)
+        # UPSTREAM_CONNECT_TIMEOUT and UPSTREAM_READ_TIMEOUT are upstream.py's
+        self.connect_timeout = app.config.get('UPSTREAM_CONNECT_TIMEOUT', self.connect_timeout)
+        self.read_timeout = app.config.get('UPSTREAM_READ_TIMEOUT', self.read_timeout)
+        self.timeouts = {name.strip('/'): tuple(value) for name, value in app.config['UPSTREAM_TIMEOUTS'].items()}
+        self.breaker_failures = app.config['UPSTREAM_BREAKER_FAILURES']
+        self.breaker_cooldown = app.config['UPSTREAM_BREAKER_COOLDOWN']
+        self.hedge = app.config['UPSTREAM_HEDGE']
+        self.hedge_endpoints = tuple(e.strip('/') for e in app.config['UPSTREAM_HEDGE_ENDPOINTS'])
+        self.hedge_percentile = app.config['UPSTREAM_HEDGE_PERCENTILE']
+        self.hedge_min_samples = app.config['UPSTREAM_HEDGE_MIN_SAMPLES']
+        self.hedge_min_delay = app.config['UPSTREAM_HEDGE_MIN_DELAY']
+        self.hedge_workers = app.config['UPSTREAM_HEDGE_WORKERS']
+
+    def timeout(self, path, model):
+        # (connect, read) seconds for a call
+        best = None
+        for name, value in self.timeouts.items():
+            if model and model.startswith(name) and (best is None or len(name) > len(best)):
+                best = name
+        if best is not None:
+            return self.timeouts[best]
+        return self.timeouts.get(path.strip('/'), (self.connect_timeout, self.read_timeout))
+
+    ### circuit breaker
+
+    def available(self, keys, model):
+        # keys: [(api_key_id, key_string)] -> those whose circuit for the model lets a call through
+        if not self.breaker_failures:
+            return keys
+        now = time.monotonic()
+        with self._lock:
+            usable = [key for key in keys if self._lets_through(self._circuits.get((key[0], model)), now)]
+            if usable:
+                return usable
+            circuits = [self._circuits[(key[0], model)] for key in keys]
+            for circuit in circuits:
+                circuit.failed_fast += 1
+            retry_after = max(1, math.ceil(min(circuit.open_until for circuit in circuits) - now))
+        log.warning('Upstream circuit open for %s on all %d API keys, failing fast', model, len(keys))
+        raise UpstreamUnavailable(f'The upstream is failing for {model}; try again in {retry_after}s',
+                                  retry_after=retry_after)
+
+    def _lets_through(self, circuit, now):
+        # closed, or open long enough to be probed by one call
+        return circuit is None or circuit.open_until <= now and not circuit.probing
+
+    def started(self, api_key_id, model):
+        if not self.breaker_failures:
+            return
+        with self._lock:
+            circuit = self._circuits.get((api_key_id, model))
+            if circuit is not None and circuit.open_until:
+                circuit.probing = True
+
+    def abandoned(self, api_key_id, model):
+        # an attempt that ended without an answer or a transport error; it counts neither way
+        with self._lock:
+            circuit = self._circuits.get((api_key_id, model))
+            if circuit is not None:
+                circuit.probing = False
+
+    def finished(self, path, api_key_id, model, status_code, seconds=None, error=None):
+        # the outcome of one upstream attempt. seconds: time to a 200, for hedging
+        if error is not None and isinstance(error, TIMEOUT_ERRORS):
+            self.timed_out += 1
+            log.warning('Upstream %s call for %s timed out on API key %s: %s', path, model, api_key_id, error)
+        elif error is not None:
+            log.warning('Upstream %s call for %s failed on API key %s: %s', path, model, api_key_id, error)
+        elif status_code in FAILURE_STATUSES:
+            log.warning('Upstream %s call for %s answered %s on API key %s', path, model, status_code, api_key_id)
+        if seconds is not None and status_code == 200:
+            with self._lock:
+                latencies = self._latencies.get((path, model))
+                if latencies is None:
+                    latencies = self._latencies[(path, model)] = _Latencies(max(self.hedge_min_samples, 200))
+                latencies.add(seconds)
+        if not self.breaker_failures:
+            return
+        failed = error is not None or status_code in FAILURE_STATUSES
+        with self._lock:
+            circuit = self._circuits.get((api_key_id, model))
+            if circuit is None:
+                if not failed:
+                    return
+                circuit = self._circuits[(api_key_id, model)] = _Circuit()
+            probe, circuit.probing = circuit.probing, False
+            if not failed:
+                if circuit.open_until:
+                    log.warning('Upstream circuit for %s on API key %s closed again', model, api_key_id)
+                circuit.failures, circuit.open_until = 0, 0
+                return
+            circuit.failures += 1
+            if probe or circuit.failures >= self.breaker_failures:
+                circuit.open_until = time.monotonic() + self.breaker_cooldown
+                circuit.opened += 1
+                log.warning('Upstream circuit for %s on API key %s opened for %ss after %d failures',
+                            model, api_key_id, self.breaker_cooldown, circuit.failures)
+
+    ### hedging
+
+    def hedge_delay(self, path, model):
+        # seconds to wait before hedging a call, or None to send it once
+        if not self.hedge or path.strip('/') not in self.hedge_endpoints:
+            return None
+        with self._lock:
+            latencies = self._latencies.get((path, model))
+            delay = latencies and latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def hedge_slot(self):
+        # an executor for a hedged call's two copies, or None when it is busy: then it is sent once
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._hedge_slots = threading.BoundedSemaphore(max(1, self.hedge_workers // 2))
+                    self._executor = ThreadPoolExecutor(self.hedge_workers, thread_name_prefix='upstream-hedge')
+        return self._executor if self._hedge_slots.acquire(blocking=False) else None
+
+    def release_hedge_slot(self):
+        self._hedge_slots.release()
+
+    def count_hedge(self, path, model, won):
+        self.hedged += 1
+        if won:
+            self.hedges_won += 1
+        log.info('Hedged a slow upstream %s call for %s; %s copy answered first', path, model,
+                 'the second' if won else 'the first')
+
+    def failed(self, e):
+        # the HTTP error for a call whose last attempt raised a transport error
+        if isinstance(e, TIMEOUT_ERRORS):
+            return UpstreamTimeout('The upstream did not answer in time')
+        return UpstreamError('Could not reach the upstream')
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            circuits = {f'{api_key_id}/{model}': {
+                'state': 'open' if circuit.open_until > now else 'half-open' if circuit.open_until else 'closed',
+                'failures': circuit.failures,
+                'opened': circuit.opened,
+                'failed_fast': circuit.failed_fast,
+                'open_for': round(max(0.0, circuit.open_until - now), 1),
+            } for (api_key_id, model), circuit in self._circuits.items()}
+            hedge_delays = {f'{path}/{model}': latencies.cached for (path, model), latencies in self._latencies.items()}
+        return {'timed_out': self.timed_out, 'hedged': self.hedged, 'hedges_won': self.hedges_won,
+                'circuits': circuits, 'hedge_delays': hedge_delays}
+
+
+resilience = Resilience()
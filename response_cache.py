@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import hashlib, json, os, sqlite3, threading, time
+
+
+def cache_key(project_id, endpoint, body):
+    # Canonical JSON, so key order and whitespace in the client's request don't matter.
+    # Scoped to the project: projects never see each other's responses.
+    canonical = json.dumps([project_id, endpoint, body.get('model'), body], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def is_cacheable(endpoint, body):
+    # Only calls that give the same answer for the same request
+    if body.get('stream'):
+        return False
+    if endpoint == 'v1/embeddings':
+        return True
+    return body.get('temperature') == 0 and body.get('n', 1) == 1
+
+
+class MemoryBackend:
+    # Per-process LRU bounded by total bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + ttl)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value, expires = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self._bytes}
+
+
+class SQLiteBackend:
+    # On-disk LRU shared by all gunicorn workers on the host
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, expires REAL NOT NULL, last_access REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)')
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return None
+        conn.execute('UPDATE cache SET last_access = ? WHERE key = ?', (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, size, expires, last_access) VALUES (?, ?, ?, ?, ?)',
+                     (key, value, len(value), now + ttl, now))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM cache WHERE expires < ?', (now,))
+        total = conn.execute('SELECT coalesce(sum(size), 0) FROM cache').fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute('SELECT key, size FROM cache ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            conn.executemany('DELETE FROM cache WHERE key = ?', [(k,) for k, _ in rows])
+            total -= sum(size for _, size in rows)
+
+    def stats(self):
+        entries, size = self._conn().execute('SELECT count(*), coalesce(sum(size), 0) FROM cache').fetchone()
+        return {'entries': entries, 'bytes': size}
+
+
+class ResponseCache:
+    """Exact-match cache of upstream responses for projects that opt in.
+
+    Only deterministic calls are cached: embeddings, and completions with
+    temperature 0 that aren't streamed. RESPONSE_CACHE_BACKEND is 'memory'
+    (per worker) or 'sqlite' (one file at RESPONSE_CACHE_PATH shared by the
+    workers on a host). Entries expire after the project's
+    response_cache_ttl, or RESPONSE_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 24 * 3600
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')
+        app.config.setdefault('RESPONSE_CACHE_PATH', os.path.join(app.instance_path, 'response_cache.sqlite3'))
+        app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('RESPONSE_CACHE_TTL', self.ttl)
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        if app.config['RESPONSE_CACHE_BACKEND'] == 'sqlite':
+            self.backend = SQLiteBackend(app.config['RESPONSE_CACHE_PATH'], app.config['RESPONSE_CACHE_MAX_BYTES'])
+        else:
+            self.backend = MemoryBackend(app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl or self.ttl)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, **self.backend.stats()}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,174 @@
+import atexit, logging, threading
+from werkzeug.exceptions import Forbidden
+from models import db, InternalAPIKey, Project
+from counters import counters
+from tokenizer import tokenizer
+
+log = logging.getLogger(__name__)
+
+
+# a PostgreSQL advisory lock: flushes hold it shared and recompute() exclusively
+TOTALS_LOCK = 0x7370656e64
+
+
+def _lock_totals(exclusive=False):
+    # so spend a flush has taken from the counters isn't added on top of totals being recomputed.
+    # PostgreSQL only; SQLite is for development
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(db.text(f"SELECT pg_advisory_xact_lock{'' if exclusive else '_shared'}(:id)"),
+                           {'id': TOTALS_LOCK})
+
+
+class OutOfMoney(Forbidden):
+    # a spending limit is reached; batch jobs stop on it instead of failing every line left
+    pass
+
+
+def add_spend(key_costs, project_costs):
+    # Atomic increments, so concurrent workers never overwrite each other's totals
+    for model, costs in ((InternalAPIKey, key_costs), (Project, project_costs)):
+        params = [{'b_id': id, 'b_cost': cost} for id, cost in costs.items() if cost]
+        if params:
+            table = model.__table__
+            db.session.execute(table.update()
+                               .where(table.c.id == db.bindparam('b_id'))
+                               .values(total_spent=db.func.coalesce(table.c.total_spent, 0) + db.bindparam('b_cost')),
+                               params)
+
+
+class SpendLedger:
+    """Money reserved by calls that haven't been saved yet.
+
+    require_api_key reserves the most every call may cost before it is sent
+    upstream (see tokenizer.py), and the reservation is released once the
+    real cost has been added to the totals. The 98% limit check counts committed spend plus
+    everything still in flight, in one atomic step on the shared counters
+    (counters.py), so concurrent calls can't all slip under the limit
+    together. With SPEND_RESERVATIONS off, the check looks at committed
+    spend only, as before.
+
+    With a shared COUNTERS_BACKEND, committed spend is read from the counters
+    rather than the db, and saved calls add to the db totals in batches,
+    every COUNTERS_FLUSH_INTERVAL seconds, from a background thread.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.estimate = 0.0
+        self.flush_interval = 5
+        self.app = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def init_app(self, app):
+        app.config.setdefault('SPEND_RESERVATIONS', self.enabled)
+        app.config.setdefault('SPEND_RESERVATION_ESTIMATE', self.estimate)
+        app.config.setdefault('COUNTERS_FLUSH_INTERVAL', self.flush_interval)
+        self.enabled = app.config['SPEND_RESERVATIONS']
+        self.estimate = app.config['SPEND_RESERVATION_ESTIMATE']
+        self.flush_interval = app.config['COUNTERS_FLUSH_INTERVAL']
+        self.app = app
+        atexit.register(self.stop)
+
+    def worst_case(self, endpoint, body):
+        # the most a call may cost: its prompt and max_tokens at the model's price.
+        # None for a model without a price, so SPEND_RESERVATION_ESTIMATE is reserved instead.
+        if not self.enabled or not isinstance(body, dict):
+            return None
+        return tokenizer.estimate_cost(endpoint, body)
+
+    def reserve(self, ik, amount=None):
+        # ik is an auth_cache.AuthEntry. Returns the amount reserved.
+        amount = (self.estimate if amount is None else amount) if self.enabled else 0
+        over = counters.reserve(ik.internal_api_key_id, ik.project_id, amount,
+                                ik.spending_limit, ik.project_spending_limit,
+                                ik.total_spent or 0, ik.project_total_spent or 0)
+        if over and amount and counters.reserve(ik.internal_api_key_id, ik.project_id, 0,
+                                                ik.spending_limit, ik.project_spending_limit,
+                                                ik.total_spent or 0, ik.project_total_spent or 0) is None:
+            # there's money left, just not this call's worst case
+            raise Forbidden(f"This call may cost up to ${amount:.4f}, more than your {'project' if over == 'project' else 'API key'} "
+                            f"has left; lower max_tokens")
+        if over == 'project':
+            raise OutOfMoney("Your project is out of money")
+        if over == 'key':
+            raise OutOfMoney("Your API key is out of money")
+        return amount
+
+    def release(self, internal_api_key_id, project_id, amount):
+        if amount:
+            counters.release(internal_api_key_id, project_id, amount)
+
+    def settle(self, key_costs, project_costs, reservations):
+        # Saved calls: their cost is committed spend now, and their reservations go.
+        # reservations: [(internal_api_key_id, project_id, amount)]
+        counters.settle(key_costs, project_costs, reservations)
+        if counters.shared:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        # Started lazily so gunicorn forks before any thread exists
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='spend-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Flushing spend counters to the db failed')
+
+    def flush(self):
+        # Adds spend saved since the last flush, by any worker, to the db totals
+        with self.app.app_context():
+            _lock_totals()
+            key_costs, project_costs = counters.take_unflushed()
+            if not key_costs and not project_costs:
+                db.session.rollback()
+                return
+            try:
+                add_spend(key_costs, project_costs)
+                db.session.commit()
+            except Exception:
+                # put it back for the next flush, without counting it as spent twice
+                counters.settle(key_costs, project_costs, [], count_spent=False)
+                raise
+
+    def recompute(self):
+        # update-spending: every project's totals from its saved calls, and the shared counters with them
+        self.flush()  # first, so no saved spend is lost if the rest fails
+        _lock_totals(exclusive=True)
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # no calls are saved until the totals are committed (SQLite has one writer anyway), so
+            # what's unflushed at the end is counted in them and nothing saved meanwhile goes missing
+            db.session.execute(db.text('LOCK TABLE api_response IN SHARE MODE'))
+        for project in Project.query.all():
+            project.update_spending()
+        counters.set_spent({k.id: k.total_spent or 0 for k in InternalAPIKey.query},
+                           {p.id: p.total_spent or 0 for p in Project.query})
+        db.session.commit()
+
+    def stop(self):
+        # run after api_response_writer.stop(), so the spend of its last rows goes too
+        if self._thread is not None and self._thread.is_alive():
+            self._stopping.set()
+            self._thread.join()
+        if counters.shared:
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Flushing spend counters to the db failed')
+
+    def stats(self):
+        keys, projects = counters.held()
+        return {'keys': keys, 'projects': projects}
+
+
+spend_ledger = SpendLedger()
@@ -0,0 +1,30 @@
+import pytest
+from models import db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # the proxy role on a file SQLite database, so forked processes can share it
+    monkeypatch.setenv('FLASK_SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "test.db"}')
+    monkeypatch.setenv('FLASK_WRITE_BEHIND_SPILL_DIR', str(tmp_path / 'spill'))
+    monkeypatch.setenv('FLASK_PAYLOAD_DIR', str(tmp_path / 'payloads'))
+    from proxy_app import create_app
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    yield app
+    from write_behind import api_response_writer
+    api_response_writer.stop()
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # COUNTERS_BACKEND = 'redis' against one in-process server, Lua scripts included
+    fakeredis = pytest.importorskip('fakeredis')
+    import redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url', lambda url: fakeredis.FakeRedis(server=server))
+    return server
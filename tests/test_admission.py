@@ -0,0 +1,75 @@
+import time
+from types import SimpleNamespace
+import pytest
+from werkzeug.exceptions import TooManyRequests
+from admission import AdmissionScheduler
+
+
+def entry(project_id, key_id, weight=1, project_concurrency=None, key_concurrency=None, key_tpm=None):
+    return SimpleNamespace(project_id=project_id, internal_api_key_id=key_id, project_weight=weight,
+                           project_max_concurrency=project_concurrency, project_tokens_per_minute=None,
+                           max_concurrency=key_concurrency, tokens_per_minute=key_tpm)
+
+
+def admit_all(scheduler):
+    # -> the order the waiting tickets are admitted in, one at a time
+    order = []
+    while scheduler._waiting:
+        ticket = scheduler._next(time.monotonic())
+        scheduler._start(ticket, time.monotonic())
+        scheduler.release(ticket)
+        order.append(ticket)
+    return order
+
+
+def test_a_backlog_does_not_hold_back_another_project():
+    scheduler = AdmissionScheduler()
+    busy, quiet = entry(1, 1), entry(2, 2)
+    backlog = [scheduler._enqueue(busy, 10) for _ in range(4)]
+    single = scheduler._enqueue(quiet, 10)
+    assert admit_all(scheduler) == [backlog[0], single, *backlog[1:]]
+
+
+def test_share_weight_sets_how_far_ahead_a_project_goes():
+    scheduler = AdmissionScheduler()
+    light, heavy = entry(1, 1), entry(2, 2, weight=4)
+    light_tickets = [scheduler._enqueue(light, 10) for _ in range(2)]
+    heavy_tickets = [scheduler._enqueue(heavy, 10) for _ in range(4)]
+    # finish tags: light 10, 20; heavy 2.5, 5, 7.5, 10, and the earlier ticket wins a tie
+    assert admit_all(scheduler) == [*heavy_tickets[:3], light_tickets[0], heavy_tickets[3], light_tickets[1]]
+
+
+def test_a_key_at_its_concurrency_limit_lets_the_projects_other_keys_go():
+    scheduler = AdmissionScheduler()
+    limited, other = entry(1, 1, key_concurrency=1), entry(1, 2)
+    scheduler.acquire(limited, 10)
+    scheduler._enqueue(limited, 10)  # ahead in the queue, but the key has no slot left
+    behind = scheduler._enqueue(other, 10)
+    assert scheduler._next(time.monotonic()) is behind
+
+
+def test_tokens_per_minute_hold_a_call_until_the_window_frees():
+    scheduler = AdmissionScheduler()
+    limited = entry(1, 1, key_tpm=100)
+    scheduler.release(scheduler.acquire(limited, 80))
+    ticket = scheduler._enqueue(limited, 30)
+    assert scheduler._next(time.monotonic()) is None
+    assert 59 < scheduler._retry_in(time.monotonic()) <= 60
+    scheduler._waiting.remove(ticket)
+    # a call bigger than the whole budget still goes into an empty window
+    assert scheduler.acquire(entry(2, 2, key_tpm=100), 500).admitted
+
+
+def test_a_call_waiting_too_long_or_behind_a_full_queue_gets_a_429():
+    scheduler = AdmissionScheduler()
+    scheduler.max_wait = 0.05
+    limited = entry(1, 1, project_concurrency=1)
+    scheduler.acquire(limited, 10)
+    with pytest.raises(TooManyRequests):
+        scheduler.acquire(limited, 10)
+    assert scheduler.rejected_timeout == 1 and not scheduler._waiting
+    scheduler.max_queue = 1
+    scheduler._enqueue(limited, 10)
+    with pytest.raises(TooManyRequests):
+        scheduler.acquire(limited, 10)
+    assert scheduler.rejected_queue_full == 1
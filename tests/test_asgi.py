@@ -0,0 +1,145 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+import asyncio, json, sys, threading
+import pytest
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('a2wsgi')
+from models import db, APIKey, Project, InternalAPIKey, APIResponse
+from counters import counters
+from spend import spend_ledger
+from upstream import upstream
+from write_behind import api_response_writer
+
+AUTH = {'Authorization': 'Bearer tok'}
+
+
+class Upstream(BaseHTTPRequestHandler):
+    # embeddings and chat, streamed or not; counts the calls it gets
+    protocol_version = 'HTTP/1.1'
+    calls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        Upstream.calls += 1
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if body.get('stream'):
+            events = [{'choices': [{'delta': {'content': 'hi'}}]},
+                      {'choices': [], 'usage': {'prompt_tokens': 2, 'completion_tokens': 1}}]
+            out = b''.join(b'data: ' + json.dumps(event).encode() + b'\n\n' for event in events) + b'data: [DONE]\n\n'
+            content_type = 'text/event-stream'
+        else:
+            out = json.dumps({'data': [{'embedding': [0.1]}], 'usage': {'prompt_tokens': 3, 'total_tokens': 3}}).encode()
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+@pytest.fixture
+def asgi(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Upstream.calls = 0
+    # the settings below end up on the shared objects, so the next test gets the old ones back
+    for obj, name in [(api_response_writer, 'enabled'), (spend_ledger, 'enabled'), (spend_ledger, 'estimate'),
+                      (upstream, 'base_url')]:
+        monkeypatch.setattr(obj, name, getattr(obj, name))
+    monkeypatch.setenv('FLASK_SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "test.db"}')
+    monkeypatch.setenv('FLASK_PAYLOAD_DIR', str(tmp_path / 'payloads'))
+    monkeypatch.setenv('FLASK_UPSTREAM_BASE_URL', f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setenv('FLASK_WRITE_BEHIND_ENABLED', 'false')
+    monkeypatch.setenv('FLASK_SPEND_RESERVATIONS', 'true')
+    monkeypatch.setenv('FLASK_SPEND_RESERVATION_ESTIMATE', '0.5')
+    # app.py builds its app on import, so each test imports a fresh one
+    monkeypatch.delitem(sys.modules, 'app', raising=False)
+    monkeypatch.delitem(sys.modules, 'asgi', raising=False)
+    import asgi
+    with asgi.flask_app.app_context():
+        db.create_all()
+        project = Project(name='p', spending_limit=100, api_key=APIKey(name='k', key_string='sk-test'),
+                          response_cache_enabled=True)
+        db.session.add(InternalAPIKey(internal_api_key_string='tok', project=project, spending_limit=100,
+                                      start_date=datetime(2020, 1, 1)))
+        db.session.commit()
+    yield asgi
+    with asgi.flask_app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    server.shutdown()
+
+
+def call(asgi, method, path, **kwargs):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi.app), base_url='http://proxy') as client:
+            try:
+                return await client.request(method, path, **kwargs)
+            finally:
+                # its clients belong to this test's event loop
+                await asgi.async_upstream.aclose()
+    return asyncio.run(run())
+
+
+def saved(asgi):
+    with asgi.flask_app.app_context():
+        return [(r.tokens_in, r.tokens_out, r.cached) for r in db.session.query(APIResponse).order_by(APIResponse.id)]
+
+
+def held():
+    keys, projects = counters.held()
+    return sum(keys.values()) + sum(projects.values())
+
+
+def test_a_call_is_proxied_and_saved(asgi):
+    resp = call(asgi, 'POST', '/v1/embeddings', headers=AUTH, json={'model': 'm', 'input': 'x'})
+    assert resp.status_code == 200
+    assert resp.json()['usage']['prompt_tokens'] == 3
+    assert 'server-timing' in resp.headers
+    assert saved(asgi) == [(3, 0, False)]
+    assert held() == 0
+
+
+def test_a_streamed_call_is_relayed_and_saved_with_its_usage(asgi):
+    resp = call(asgi, 'POST', '/v1/chat/completions', headers=AUTH,
+                json={'model': 'm', 'stream': True, 'messages': [{'role': 'user', 'content': 'x'}]})
+    assert resp.status_code == 200
+    assert resp.headers['content-type'] == 'text/event-stream'
+    assert b'"content": "hi"' in resp.content and resp.content.rstrip().endswith(b'data: [DONE]')
+    # the client didn't ask for usage, so it doesn't get the usage chunk
+    assert b'"usage"' not in resp.content
+    assert saved(asgi) == [(2, 1, False)]
+    assert held() == 0
+
+
+def test_a_repeated_call_is_served_from_the_cache(asgi):
+    body = {'model': 'm', 'input': 'x'}
+    first = call(asgi, 'POST', '/v1/embeddings', headers=AUTH, json=body)
+    second = call(asgi, 'POST', '/v1/embeddings', headers=AUTH, json=body)
+    assert second.status_code == 200 and second.content == first.content
+    assert Upstream.calls == 1
+    assert saved(asgi) == [(3, 0, False), (3, 0, True)]
+    assert held() == 0
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_a_call_admission_turns_away_gets_a_429_and_its_reservation_back(asgi, monkeypatch, stream):
+    reserved = []
+    reserve = asgi.spend_ledger.reserve
+    monkeypatch.setattr(asgi.spend_ledger, 'reserve', lambda *args: reserved.append(reserve(*args)) or reserved[-1])
+    monkeypatch.setattr(asgi.admission, 'max_queue', 0)
+    resp = call(asgi, 'POST', '/v1/chat/completions', headers=AUTH,
+                json={'model': 'm', 'stream': stream, 'messages': [{'role': 'user', 'content': 'x'}]})
+    assert resp.status_code == 429
+    assert reserved == [0.5] and Upstream.calls == 0
+    assert saved(asgi) == []
+    assert held() == 0
+
+
+def test_other_routes_reach_the_flask_app(asgi):
+    resp = call(asgi, 'GET', '/login')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'].startswith('text/html')
+    assert Upstream.calls == 0
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+import time
+import pytest
+from models import db, Project, InternalAPIKey, APIKey, OpenAIModel
+from auth_cache import AuthCache, auth_cache
+
+
+@pytest.fixture
+def keys(app):
+    # project p with its own key and a pool key, and internal keys ik1..ik3
+    with app.app_context():
+        project = Project(name='p', spending_limit=100, api_key=APIKey(name='own', key_string='sk-own'))
+        db.session.add_all([project, OpenAIModel(name='m', description='test model')])
+        for n in (1, 2, 3):
+            db.session.add(InternalAPIKey(internal_api_key_string=f'ik{n}', project=project, spending_limit=10,
+                                          start_date=datetime(2020, 1, 1)))
+        db.session.commit()
+    auth_cache.clear()
+    return app
+
+
+def change(app, update):
+    # what an admin view does: change rows and commit
+    with app.app_context():
+        update(db.session.query(InternalAPIKey).filter_by(internal_api_key_string='ik1').one())
+        db.session.commit()
+
+
+def test_a_key_ended_in_the_admin_is_refused_at_once(keys):
+    with keys.app_context():
+        assert auth_cache.get('ik1').is_current()
+    change(keys, lambda ik: setattr(ik, 'end_date', datetime.utcnow() - timedelta(days=1)))
+    with keys.app_context():
+        assert not auth_cache.get('ik1').is_current()
+
+
+def test_changed_limits_are_seen_by_the_next_call(keys):
+    with keys.app_context():
+        assert (auth_cache.get('ik1').spending_limit, auth_cache.get('ik1').project_spending_limit) == (10, 100)
+    change(keys, lambda ik: setattr(ik, 'spending_limit', 5))
+    change(keys, lambda ik: setattr(ik.project, 'spending_limit', 50))
+    with keys.app_context():
+        assert (auth_cache.get('ik1').spending_limit, auth_cache.get('ik1').project_spending_limit) == (5, 50)
+
+
+def test_changing_a_projects_models_or_keys_drops_the_cache(keys):
+    with keys.app_context():
+        entry = auth_cache.get('ik1')
+        assert auth_cache.get('ik1') is entry
+    change(keys, lambda ik: ik.project.allowed_models.append(db.session.query(OpenAIModel).one()))
+    with keys.app_context():
+        assert auth_cache.get('ik1') is not entry
+    change(keys, lambda ik: ik.project.api_keys.append(APIKey(name='pool', key_string='sk-pool')))
+    with keys.app_context():
+        assert [key for _, key in auth_cache.get('ik1').api_keys] == ['sk-own', 'sk-pool']
+
+
+def test_an_entry_is_loaded_again_once_it_expires(keys):
+    cache = AuthCache(ttl=60)
+    with keys.app_context():
+        entry = cache.get('ik1')
+        assert cache.get('ik1') is entry
+        cache._entries['ik1'].expires = time.monotonic() - 1
+        assert cache.peek('ik1') is None
+        assert cache.get('ik1') is not entry
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_the_least_recently_used_entry_is_dropped(keys):
+    cache = AuthCache(maxsize=2)
+    with keys.app_context():
+        cache.get('ik1')
+        cache.get('ik2')
+        cache.get('ik1')
+        cache.get('ik3')
+        assert list(cache._entries) == ['ik1', 'ik3']
+        # unknown keys aren't cached
+        assert cache.get('nope') is None
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 4}
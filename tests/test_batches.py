@@ -0,0 +1,67 @@
+import json, threading
+from datetime import datetime
+import pytest
+from models import db, BatchJob, InternalAPIKey
+from batches import batch_runner
+
+
+@pytest.fixture
+def job(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_runner, 'dir', str(tmp_path / 'batches'))
+    (tmp_path / 'batches').mkdir()
+    with app.app_context():
+        db.session.add(InternalAPIKey(internal_api_key_string='ik'))
+        db.session.flush()
+        job = BatchJob(internal_api_key_id=1, total_lines=4, endpoint='v1/embeddings')
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+    with open(batch_runner.input_path(job_id), 'w') as f:
+        for n in range(4):
+            f.write(json.dumps({'custom_id': str(n), 'body': {'model': 'm', 'input': str(n)}}) + '\n')
+    return job_id
+
+
+def result(n, cost=1.0):
+    return json.dumps({'line': n, 'custom_id': str(n), 'cost': cost}).encode() + b'\n'
+
+
+def test_checkpoint_keeps_the_first_result_of_a_line(job):
+    with open(batch_runner.output_path(job), 'wb') as f:
+        f.write(result(0) + result(2) + result(0, cost=5.0) + b'{"line": 3, "cu')
+    assert batch_runner._checkpoint(job) == ({0, 2}, 2, 0, 2.0)
+    with open(batch_runner.output_path(job), 'rb') as f:
+        assert f.read() == result(0) + result(2)
+
+
+def test_lines_finishing_after_the_job_is_taken_over_are_not_written(app, job, monkeypatch):
+    started, finish = threading.Barrier(3), threading.Event()
+
+    def call(token, default_url, n, raw):
+        started.wait(5)
+        finish.wait(5)
+        return result(n), 1.0
+
+    def save(job_id, heartbeat, *args, **kwargs):
+        # another worker has the job by the first checkpoint
+        finish.set()
+        return None
+
+    monkeypatch.setattr(batch_runner, '_call', call)
+    monkeypatch.setattr(batch_runner, '_save', save)
+    monkeypatch.setattr(batch_runner, 'concurrency', 2)
+    monkeypatch.setattr(batch_runner, 'checkpoint_interval', 0)
+    with open(batch_runner.output_path(job), 'wb') as f:
+        f.write(result(0))
+    monkeypatch.setattr(batch_runner, '_checkpoint', lambda job_id: ({0}, 1, 0, 1.0))
+
+    def run():
+        with app.app_context():
+            batch_runner.run(job, datetime.utcnow())
+    runner = threading.Thread(target=run)
+    runner.start()
+    started.wait(5)
+    runner.join(10)
+    assert not runner.is_alive()
+    with open(batch_runner.output_path(job), 'rb') as f:
+        assert f.read() == result(0)
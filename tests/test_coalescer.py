@@ -0,0 +1,127 @@
+from json import dumps, loads
+import threading, time
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+from coalescer import EmbeddingCoalescer, CoalescedResponse
+from key_scheduler import key_scheduler
+
+KEYS = [(1, 'sk-a')]
+
+
+class Upstream:
+    # stands in for key_scheduler.post; each vector is the length of its input
+    def __init__(self, status_code=200, prompt_tokens=13, error=None, hedge_tokens=None):
+        self.status_code = status_code
+        self.prompt_tokens = prompt_tokens
+        self.error = error
+        self.hedge_tokens = hedge_tokens
+        self.inputs = []
+
+    def post(self, path, keys, json, model=None, on_hedge=None):
+        self.inputs.append(json['input'])
+        if self.error is not None:
+            raise self.error
+        if self.hedge_tokens is not None:
+            on_hedge(dumps({'usage': {'prompt_tokens': self.hedge_tokens}}).encode())
+        # out of order, as upstream may send them
+        data = [{'object': 'embedding', 'index': i, 'embedding': [len(v)]} for i, v in enumerate(json['input'])][::-1]
+        content = dumps({'object': 'list', 'data': data, 'model': json['model'],
+                         'usage': {'prompt_tokens': self.prompt_tokens, 'total_tokens': self.prompt_tokens}})
+        return CoalescedResponse(self.status_code, {'content-type': 'application/json'}, content.encode())
+
+
+@pytest.fixture
+def coalescer():
+    coalescer = EmbeddingCoalescer()
+    coalescer.enabled, coalescer.window, coalescer.max_inputs = True, 10, 4
+    return coalescer
+
+
+def upstream(monkeypatch, **kwargs):
+    fake = Upstream(**kwargs)
+    monkeypatch.setattr(key_scheduler, 'post', fake.post)
+    return fake
+
+
+def post_all(coalescer, fake, inputs, on_hedge=None):
+    # Each input list from its own thread, in order: every caller has joined its batch before the next one comes.
+    # -> what each caller got back (its response, None or the exception it raised)
+    results = [None] * len(inputs)
+
+    def call(n):
+        try:
+            results[n] = coalescer.post('v1/embeddings', KEYS, {'model': 'm', 'input': inputs[n]},
+                                        on_hedge and (lambda content: on_hedge(n, content)))
+        except Exception as e:
+            results[n] = e
+    threads = []
+    for n in range(len(inputs)):
+        threads.append(threading.Thread(target=call, args=(n,)))
+        threads[-1].start()
+        joined = sum(len(i) for i in inputs[:n + 1])
+        deadline = time.monotonic() + 2
+        while sum(b.inputs for b in coalescer._open.values()) + sum(len(i) for i in fake.inputs) < joined:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+    for thread in threads:
+        # long before the window is over: batches go as soon as they are full
+        thread.join(2)
+        assert not thread.is_alive()
+    return results
+
+
+def test_callers_get_their_own_vectors_and_shares_of_the_usage(coalescer, monkeypatch):
+    fake = upstream(monkeypatch, prompt_tokens=13)
+    # 1, 2 + 1 and 4 estimated tokens; the fourth input fills the batch
+    results = post_all(coalescer, fake, [['a' * 4], ['b' * 8, 'c' * 2], ['d' * 16]])
+    assert fake.inputs == [['a' * 4, 'b' * 8, 'c' * 2, 'd' * 16]]
+    got = [r.json() for r in results]
+    assert [r['data'] for r in got] == [[{'object': 'embedding', 'index': 0, 'embedding': [4]}],
+                                        [{'object': 'embedding', 'index': 0, 'embedding': [8]},
+                                         {'object': 'embedding', 'index': 1, 'embedding': [2]}],
+                                        [{'object': 'embedding', 'index': 0, 'embedding': [16]}]]
+    # 13 tokens split 1:3:4, the last caller gets what rounding left
+    assert [r['usage']['prompt_tokens'] for r in got] == [2, 5, 6]
+    assert coalescer.stats() == {'upstream_calls': 1, 'coalesced_calls': 3, 'open_batches': 0}
+
+
+def test_a_caller_that_does_not_fit_sends_the_open_batch(coalescer, monkeypatch):
+    coalescer.max_inputs, coalescer.max_tokens = 100, 5
+    fake = upstream(monkeypatch)
+    # 4 tokens, then 2 that don't fit with them, then 3 that fill the second batch
+    results = post_all(coalescer, fake, [['a' * 16], ['b' * 8], ['c' * 12]])
+    assert fake.inputs == [['a' * 16], ['b' * 8, 'c' * 12]]
+    assert [r.json()['usage']['prompt_tokens'] for r in results] == [13, 5, 8]
+
+
+def test_a_call_too_big_to_merge_goes_on_its_own(coalescer, monkeypatch):
+    fake = upstream(monkeypatch)
+    assert coalescer.post('v1/embeddings', KEYS, {'model': 'm', 'input': ['x'] * 4}) is None
+    assert coalescer.post('v1/embeddings', KEYS, {'model': 'm', 'input': [{'not': 'text'}]}) is None
+    assert fake.inputs == []
+
+
+def test_a_400_sends_every_caller_on_its_own(coalescer, monkeypatch):
+    fake = upstream(monkeypatch, status_code=400)
+    assert post_all(coalescer, fake, [['a'], ['b'], ['c', 'd']]) == [None, None, None]
+
+
+def test_other_errors_are_every_callers_answer(coalescer, monkeypatch):
+    fake = upstream(monkeypatch, status_code=429)
+    results = post_all(coalescer, fake, [['a'], ['b'], ['c', 'd']])
+    assert [r.status_code for r in results] == [429, 429, 429]
+
+
+def test_the_leaders_exception_is_raised_in_every_caller(coalescer, monkeypatch):
+    error = ServiceUnavailable('upstream is down')
+    fake = upstream(monkeypatch, error=error)
+    assert post_all(coalescer, fake, [['a'], ['b'], ['c', 'd']]) == [error, error, error]
+    assert coalescer.stats()['open_batches'] == 0
+
+
+def test_the_losing_copy_of_a_hedged_batch_is_billed_by_share(coalescer, monkeypatch):
+    fake = upstream(monkeypatch, hedge_tokens=13)
+    billed = {}
+    post_all(coalescer, fake, [['a' * 4], ['b' * 8, 'c' * 2], ['d' * 16]],
+             on_hedge=lambda n, content: billed.update({n: loads(content)['usage']['prompt_tokens']}))
+    assert billed == {0: 2, 1: 5, 2: 6}
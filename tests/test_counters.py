@@ -0,0 +1,69 @@
+import pytest
+from counters import LocalCounters, SharedMemoryCounters, RedisCounters
+
+
+def opener(request, tmp_path):
+    # -> a function that opens the counters of one more worker on the same store
+    if request.param == 'local':
+        return LocalCounters
+    if request.param == 'shm':
+        return lambda: SharedMemoryCounters(str(tmp_path / 'counters.shm'), 1024)
+    request.getfixturevalue('fake_redis')
+    return lambda: RedisCounters('redis://localhost:6379/0', 'test:')
+
+
+@pytest.fixture(params=['local', 'shm', 'redis'])
+def backend(request, tmp_path):
+    return opener(request, tmp_path)()
+
+
+@pytest.fixture(params=['shm', 'redis'])
+def shared(request, tmp_path):
+    return opener(request, tmp_path)
+
+
+def test_reserve_checks_spent_plus_held(backend):
+    # key 1 of project 2, limits 10 and 100, 5 spent
+    assert backend.reserve(1, 2, 4, 10, 100, 5, 5) is None
+    assert backend.held() == ({1: 4}, {2: 4})
+    # 5 + 4 + 1 is over 98% of 10
+    assert backend.reserve(1, 2, 1, 10, 100, 5, 5) == 'key'
+    assert backend.reserve(3, 2, 92, 0, 100, 0, 5) == 'project'
+    assert backend.held() == ({1: 4}, {2: 4})
+
+
+def test_release_and_settle_give_the_reservation_back(backend):
+    backend.reserve(1, 2, 4, 10, 100, 0, 0)
+    backend.reserve(1, 2, 3, 10, 100, 0, 0)
+    backend.release(1, 2, 4)
+    assert backend.held() == ({1: 3}, {2: 3})
+    backend.settle({1: 2.5}, {2: 2.5}, [(1, 2, 3)])
+    assert backend.held() == ({}, {})
+
+
+def test_tokens_per_minute_are_counted_all_or_nothing(backend):
+    assert backend.consume_rate([('p:1', 60, 100)]) is None
+    # the project would go over, so the key isn't charged either
+    assert backend.consume_rate([('k:1', 50, 100), ('p:1', 50, 100)]) == 'p:1'
+    assert backend.consume_rate([('k:1', 90, 100)]) is None
+    assert backend.consume_rate([('k:1', 20, 100)]) == 'k:1'
+
+
+def test_shared_spend_is_counted_and_flushed_once(shared):
+    worker, other = shared(), shared()
+    assert worker.reserve(1, 2, 1, 10, 0, 6, 6) is None
+    worker.settle({1: 2.0}, {2: 2.0}, [(1, 2, 1)])
+    # the other worker sees the spend before it is in the db: 6 + 2 + 2 is over 98% of 10
+    assert other.reserve(1, 2, 2, 10, 0, 6, 6) == 'key'
+    assert other.take_unflushed() == ({1: 2.0}, {2: 2.0})
+    assert worker.take_unflushed() == ({}, {})
+
+
+def test_set_spent_drops_what_the_recomputed_totals_hold(shared):
+    counters = shared()
+    counters.reserve(1, 2, 0, 10, 0, 0, 0)
+    counters.settle({1: 2.0}, {2: 2.0}, [])
+    counters.set_spent({1: 5.0}, {2: 5.0})
+    assert counters.take_unflushed() == ({}, {})
+    assert counters.reserve(1, 2, 5, 10, 0, 0, 0) == 'key'
+    assert counters.reserve(1, 2, 4.5, 10, 0, 0, 0) is None
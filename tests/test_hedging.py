@@ -0,0 +1,74 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json, threading, time
+from types import SimpleNamespace
+import pytest
+from models import db, APIResponse
+from proxy import hedge_recorder
+from key_scheduler import key_scheduler
+from resilience import resilience
+from upstream import upstream
+
+
+class Upstream(BaseHTTPRequestHandler):
+    # embeddings; the key sk-slow answers after 0.3s
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        key = self.headers['Authorization'].split()[1]
+        if key == 'sk-slow':
+            time.sleep(0.3)
+        body = json.dumps({'data': [], 'usage': {'prompt_tokens': 7 if key == 'sk-slow' else 3}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def hedging(app):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url, upstream.base_url = upstream.base_url, f'http://127.0.0.1:{server.server_port}'
+    resilience.hedge, resilience.hedge_min_samples = True, 1
+    resilience.finished('v1/embeddings', 0, 'm', 200, seconds=0.05)
+    yield
+    resilience.hedge, resilience.hedge_min_samples = False, 50
+    resilience._latencies.clear()
+    upstream.base_url = base_url
+    server.shutdown()
+
+
+def test_the_losing_copy_of_a_hedged_call_is_billed(hedging, monkeypatch):
+    billed = []
+    done = threading.Event()
+
+    def on_hedge(content):
+        billed.append(json.loads(content)['usage'])
+        done.set()
+    # the slow key first, then the other
+    monkeypatch.setattr(key_scheduler, 'pick', lambda keys, exclude=(): (next(k for k in keys if k[0] not in exclude), 0))
+    resp = key_scheduler.post('v1/embeddings', [(1, 'sk-slow'), (2, 'sk-fast')], json={'model': 'm', 'input': 'x'},
+                              model='m', on_hedge=on_hedge)
+    # the fast copy answered, and the slow one is billed once it's back
+    assert resp.json()['usage'] == {'prompt_tokens': 3}
+    assert done.wait(2)
+    assert billed == [{'prompt_tokens': 7}]
+
+
+def test_a_hedge_row_keeps_usage_but_no_bodies(app):
+    ik = SimpleNamespace(internal_api_key_id=1, project_id=1, project_name='p', payload_policy='full', payload_sample_rate=1)
+    hedge_recorder(app, ik, {'model': 'm', 'input': 'x'})(b'{"data": [[0.1]], "usage": {"prompt_tokens": 7}}')
+    deadline = time.monotonic() + 5
+    while True:
+        with app.app_context():
+            row = db.session.query(APIResponse).first()
+            if row is not None:
+                assert (row.hedge, row.tokens_in, row.request, row.response, row.request_ref) == (True, 7, None, None, None)
+                break
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
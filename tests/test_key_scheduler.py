@@ -0,0 +1,35 @@
+import time
+import pytest
+from werkzeug.exceptions import TooManyRequests
+from key_scheduler import KeyScheduler
+
+KEYS = [(1, 'sk-a'), (2, 'sk-b')]
+
+
+def cool_down(scheduler, api_key_id, seconds):
+    scheduler._state(api_key_id).cooldown_until = time.monotonic() + seconds
+
+
+def test_every_key_cooling_down_for_long_gets_a_429():
+    scheduler = KeyScheduler()
+    cool_down(scheduler, 1, 30)
+    cool_down(scheduler, 2, 20)
+    with pytest.raises(TooManyRequests) as e:
+        scheduler.post('v1/embeddings', KEYS, json={'model': 'm', 'input': 'x'}, model='m')
+    assert e.value.retry_after == 20
+
+
+def test_a_key_that_is_not_cooling_down_is_used():
+    scheduler = KeyScheduler()
+    cool_down(scheduler, 1, 30)
+    assert scheduler._choose(KEYS, 'm', set()) == ((2, 'sk-b'), 0.0)
+    # even when it was tried already
+    assert scheduler._choose(KEYS, 'm', {2}) == ((2, 'sk-b'), 0.0)
+
+
+def test_a_short_cooldown_is_waited_out():
+    scheduler = KeyScheduler()
+    cool_down(scheduler, 1, 30)
+    cool_down(scheduler, 2, 1)
+    key, wait = scheduler._choose(KEYS, 'm', set())
+    assert key == (2, 'sk-b') and 0 < wait <= 1
@@ -0,0 +1,63 @@
+import glob, os, threading
+import pytest
+from payloads import PayloadStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = PayloadStore()
+    store.storage, store.directory = 'files', str(tmp_path)
+    return store
+
+
+def offload(store, body):
+    row = {'request': body, 'response': None}
+    store.offload([row])
+    return row['request_ref']
+
+
+def temp_files(store):
+    return glob.glob(os.path.join(store.directory, '**', '*.tmp'), recursive=True)
+
+
+def test_threads_saving_the_same_body_all_succeed(store):
+    body = {'input': ['x' * 1000] * 50}
+    refs, errors = [], []
+
+    def save():
+        try:
+            refs.append(offload(store, body))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=save) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and len(set(refs)) == 1
+    assert store.load(refs[0]) == body
+    assert temp_files(store) == []
+
+
+def test_a_blob_another_writer_got_in_first_is_saved(store, monkeypatch):
+    replace = os.replace
+
+    def lose_the_race(src, dst):
+        # the other writer's replace lands first, and ours is refused (as on Windows)
+        with open(src, 'rb') as f, open(dst, 'wb') as out:
+            out.write(f.read())
+        raise PermissionError(dst)
+    monkeypatch.setattr(os, 'replace', lose_the_race)
+    ref = offload(store, {'input': 'x'})
+    monkeypatch.setattr(os, 'replace', replace)
+    assert store.load(ref) == {'input': 'x'}
+    assert temp_files(store) == []
+
+
+def test_a_failed_write_leaves_no_temp_file(store, monkeypatch):
+    def full_disk(src, dst):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(os, 'replace', full_disk)
+    with pytest.raises(OSError):
+        offload(store, {'input': 'x'})
+    assert temp_files(store) == []
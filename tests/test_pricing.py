@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+import multiprocessing
+import pytest
+from models import db, OpenAIModel, ModelCost
+from pricing import price_index
+
+
+@pytest.fixture
+def priced_model(app):
+    with app.app_context():
+        model = OpenAIModel(name='gpt-test', description='test model')
+        db.session.add(model)
+        db.session.flush()
+        db.session.add(ModelCost(model_id=model.id, in_tokens_cost=1.0, out_tokens_cost=2.0,
+                                 start_date=datetime(2020, 1, 1)))
+        db.session.commit()
+        model_id = model.id
+    price_index.invalidate()
+    price_index.check_interval = 0
+    yield model_id
+    price_index.invalidate()
+    price_index.check_interval = 5
+
+
+def _change_price(app, model_id, start):
+    # what the change_price view does, from another process
+    with app.app_context():
+        db.engine.dispose(close=False)
+        current = ModelCost.query.filter_by(model_id=model_id, end_date=None).one()
+        current.end_date = start - timedelta(days=1)
+        db.session.add(ModelCost(model_id=model_id, in_tokens_cost=10.0, out_tokens_cost=20.0, start_date=start))
+        db.session.commit()
+
+
+def test_price_change_in_another_process_is_billed(app, priced_model):
+    with app.app_context():
+        assert price_index.cost('gpt-test', 1000, 1000) == (1.0, 2.0)
+    child = multiprocessing.get_context('fork').Process(
+        target=_change_price, args=(app, priced_model, datetime.utcnow() - timedelta(minutes=1)))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    with app.app_context():
+        assert price_index.cost('gpt-test', 1000, 1000) == (10.0, 20.0)
+
+
+def test_stale_index_is_kept_until_the_check_interval(app, priced_model):
+    price_index.check_interval = 3600
+    with app.app_context():
+        assert price_index.cost('gpt-test', 1000, 1000) == (1.0, 2.0)
+    child = multiprocessing.get_context('fork').Process(
+        target=_change_price, args=(app, priced_model, datetime.utcnow() - timedelta(minutes=1)))
+    child.start()
+    child.join()
+    with app.app_context():
+        assert price_index.cost('gpt-test', 1000, 1000) == (1.0, 2.0)
+        price_index._checked = 0
+        assert price_index.cost('gpt-test', 1000, 1000) == (10.0, 20.0)
+
+
+def test_calls_in_the_gap_change_price_leaves_are_billed_at_the_old_price(app, priced_model):
+    _change_price(app, priced_model, datetime(2024, 1, 10))
+    with app.app_context():
+        # the old price now ends on 2024-01-09 00:00
+        assert price_index.cost('gpt-test', 1000, 1000, datetime(2024, 1, 8)) == (1.0, 2.0)
+        assert price_index.cost('gpt-test', 1000, 1000, datetime(2024, 1, 9, 12)) == (1.0, 2.0)
+        assert price_index.cost('gpt-test', 1000, 1000, datetime(2024, 1, 10)) == (10.0, 20.0)
+        assert price_index.cost('gpt-test', 1000, 1000, datetime(2019, 12, 31)) is None
+        assert price_index.bulk_costs([('gpt-test', datetime(2024, 1, 9, 23, 59), 1000, 0),
+                                       ('gpt-test', datetime(2024, 1, 11), 1000, 0)]) == [(1.0, 0.0), (10.0, 0.0)]
@@ -0,0 +1,25 @@
+import logging
+from types import SimpleNamespace
+from proxy import parse_usage, api_call_record
+
+IK = SimpleNamespace(internal_api_key_id=1, project_id=1, payload_policy='full', payload_sample_rate=1)
+
+
+def test_parse_usage_finds_the_usage_after_the_vectors():
+    body = b'{"data": [{"embedding": [0.1, 0.2], "text": "\\"usage\\": 1"}], "usage": {"prompt_tokens": 3}}'
+    assert parse_usage(body) == {'prompt_tokens': 3}
+
+
+def test_a_response_without_usage_is_billed_as_no_tokens(caplog):
+    with caplog.at_level(logging.WARNING, logger='proxy'):
+        assert parse_usage(b'{"data": []}') == {}
+        assert parse_usage(b'not json') == {}
+        assert parse_usage(b'[]') == {}
+    assert len(caplog.records) == 3
+
+
+def test_a_call_without_usage_is_still_saved():
+    record = api_call_record(IK, {'model': 'm'}, b'<html>ok</html>')
+    assert (record['tokens_in'], record['tokens_out'], record['response']) == (0, 0, '<html>ok</html>')
+    record = api_call_record(IK, {'model': 'm'}, {'choices': []})
+    assert (record['tokens_in'], record['tokens_out']) == (0, 0)
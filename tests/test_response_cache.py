@@ -0,0 +1,101 @@
+from datetime import datetime
+import json, time
+import pytest
+from models import db, Project, InternalAPIKey, APIResponse, APIKey, OpenAIModel, ModelCost
+from pricing import price_index
+from coalescer import CoalescedResponse
+from key_scheduler import key_scheduler
+from write_behind import api_response_writer
+from response_cache import cache_key, is_cacheable, SQLiteBackend
+
+CHAT = {'model': 'gpt-test', 'temperature': 0, 'messages': [{'role': 'user', 'content': 'x'}]}
+
+
+@pytest.mark.parametrize('body', [{**CHAT, 'temperature': 0.7}, {k: v for k, v in CHAT.items() if k != 'temperature'},
+                                  {**CHAT, 'n': 2}, {**CHAT, 'stream': True}])
+def test_calls_that_may_answer_differently_are_not_cached(body):
+    assert not is_cacheable('v1/chat/completions', body)
+
+
+def test_deterministic_calls_are_cached():
+    assert is_cacheable('v1/chat/completions', CHAT)
+    assert is_cacheable('v1/completions', {'model': 'm', 'prompt': 'x', 'temperature': 0, 'n': 1})
+    assert is_cacheable('v1/embeddings', {'model': 'm', 'input': 'x'})
+    assert not is_cacheable('v1/embeddings', {'model': 'm', 'input': 'x', 'stream': True})
+
+
+def test_keys_are_scoped_to_the_project_and_ignore_key_order():
+    reordered = dict(reversed(list(CHAT.items())))
+    assert cache_key(1, 'v1/chat/completions', CHAT) == cache_key(1, 'v1/chat/completions', reordered)
+    assert cache_key(1, 'v1/chat/completions', CHAT) != cache_key(2, 'v1/chat/completions', CHAT)
+    assert cache_key(1, 'v1/chat/completions', CHAT) != cache_key(1, 'v1/completions', CHAT)
+
+
+def test_sqlite_entries_expire_and_are_shared_by_workers(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    worker, other = SQLiteBackend(path, 1024), SQLiteBackend(path, 1024)
+    worker.set('short', b'a', 0.05)
+    worker.set('long', b'b', 60)
+    assert (other.get('short'), other.get('long')) == (b'a', b'b')
+    time.sleep(0.1)
+    assert (other.get('short'), other.get('long')) == (None, b'b')
+    assert worker.stats() == {'entries': 1, 'bytes': 1}
+
+
+@pytest.fixture
+def caching_app(request, monkeypatch):
+    # projects p and q with the response cache on (internal keys ip and iq), and calls saved as they finish
+    for obj, name in [(api_response_writer, 'enabled'), (price_index, 'check_interval')]:
+        monkeypatch.setattr(obj, name, getattr(obj, name))
+    monkeypatch.setenv('FLASK_WRITE_BEHIND_ENABLED', 'false')
+    app = request.getfixturevalue('app')
+    with app.app_context():
+        model = OpenAIModel(name='gpt-test', description='test model')
+        model.costs.append(ModelCost(in_tokens_cost=1.0, out_tokens_cost=2.0, start_date=datetime(2020, 1, 1)))
+        db.session.add(model)
+        for name in ('p', 'q'):
+            project = Project(name=name, spending_limit=100, api_key=APIKey(name=name, key_string=f'sk-{name}'),
+                              response_cache_enabled=True)
+            db.session.add(InternalAPIKey(internal_api_key_string=f'i{name}', project=project, spending_limit=100,
+                                          start_date=datetime(2020, 1, 1)))
+        db.session.commit()
+    price_index.invalidate()
+    price_index.check_interval = 0
+    yield app
+    price_index.invalidate()
+
+
+def upstream(monkeypatch):
+    # -> the bodies key_scheduler.post was called with
+    calls = []
+
+    def post(path, keys, data=None, model=None, on_hedge=None, **kwargs):
+        calls.append(data)
+        content = json.dumps({'choices': [], 'usage': {'prompt_tokens': 100, 'completion_tokens': 50}}).encode()
+        return CoalescedResponse(200, {'Content-Type': 'application/json'}, content)
+    monkeypatch.setattr(key_scheduler, 'post', post)
+    return calls
+
+
+def chat(app, token):
+    return app.test_client().post('/v1/chat/completions', headers={'Authorization': f'Bearer {token}'}, json=CHAT)
+
+
+def test_a_hit_is_saved_as_a_call_that_cost_nothing(caching_app, monkeypatch):
+    calls = upstream(monkeypatch)
+    first, second = chat(caching_app, 'ip'), chat(caching_app, 'ip')
+    assert second.status_code == 200 and second.data == first.data
+    assert len(calls) == 1
+    with caching_app.app_context():
+        rows = db.session.query(APIResponse).order_by(APIResponse.id).all()
+        assert [(r.tokens_in, r.tokens_out, r.in_cost, r.out_cost, r.cached) for r in rows] == \
+            [(100, 50, 0.1, 0.1, False), (100, 50, 0, 0, True)]
+        # only the call that went upstream counts
+        assert db.session.get(InternalAPIKey, 1).total_spent == pytest.approx(0.2)
+
+
+def test_another_project_does_not_get_the_cached_response(caching_app, monkeypatch):
+    calls = upstream(monkeypatch)
+    chat(caching_app, 'ip')
+    assert chat(caching_app, 'iq').status_code == 200
+    assert len(calls) == 2
@@ -0,0 +1,125 @@
+from datetime import datetime
+import json
+import pytest
+import tokenizer as tokenizer_module
+from models import db, Project, InternalAPIKey, APIResponse, APIKey, OpenAIModel, ModelCost
+from counters import counters
+from spend import spend_ledger
+from pricing import price_index
+from coalescer import CoalescedResponse
+from key_scheduler import key_scheduler
+from write_behind import api_response_writer
+
+
+@pytest.fixture(params=['shm', 'redis'])
+def shared_app(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(counters, 'backend', counters.backend)
+    monkeypatch.setenv('FLASK_COUNTERS_BACKEND', request.param)
+    monkeypatch.setenv('FLASK_COUNTERS_SHM_PATH', str(tmp_path / 'counters.shm'))
+    if request.param == 'redis':
+        request.getfixturevalue('fake_redis')
+    app = request.getfixturevalue('app')
+    with app.app_context():
+        project = Project(name='p', spending_limit=100)
+        db.session.add(project)
+        db.session.flush()
+        db.session.add(InternalAPIKey(internal_api_key_string='ik', project_id=project.id, spending_limit=100))
+        db.session.commit()
+    return app
+
+
+def save_call(app, cost):
+    # what api_response_writer does with shared counters: the row, then its spend into the counters
+    with app.app_context():
+        db.session.add(APIResponse(model_name='m', tokens_in=1, tokens_out=1, internal_api_key_id=1,
+                                   in_cost=cost, out_cost=0, time_created=datetime.utcnow()))
+        db.session.commit()
+    counters.settle({1: cost}, {1: cost}, [])
+
+
+def test_update_spending_counts_calls_saved_while_it_runs_once(shared_app, monkeypatch):
+    save_call(shared_app, 1.0)
+    spend_ledger.flush()
+    save_call(shared_app, 2.0)  # saved, not flushed yet
+    update_spending = Project.update_spending
+    def saved_meanwhile(project):
+        save_call(shared_app, 4.0)
+        update_spending(project)
+    monkeypatch.setattr(Project, 'update_spending', saved_meanwhile)
+    with shared_app.app_context():
+        spend_ledger.recompute()
+    spend_ledger.flush()
+    with shared_app.app_context():
+        assert db.session.get(InternalAPIKey, 1).total_spent == 7.0
+        assert db.session.get(Project, 1).total_spent == 7.0
+    # the counters say 7 spent too: 7 + 92 is over 98% of 100
+    assert counters.reserve(1, 1, 92, 100, 0, 0, 0) == 'key'
+    assert counters.reserve(1, 1, 91, 100, 0, 0, 0) is None
+
+
+@pytest.fixture
+def reserving_app(request, monkeypatch):
+    # SPEND_RESERVATIONS on, calls saved as they finish and 4 bytes a token; key 1 may spend up to $2
+    for obj, name in [(spend_ledger, 'enabled'), (api_response_writer, 'enabled'), (price_index, 'check_interval')]:
+        monkeypatch.setattr(obj, name, getattr(obj, name))
+    monkeypatch.setenv('FLASK_SPEND_RESERVATIONS', 'true')
+    monkeypatch.setenv('FLASK_WRITE_BEHIND_ENABLED', 'false')
+    monkeypatch.setattr(tokenizer_module, 'tiktoken', None)
+    app = request.getfixturevalue('app')
+    with app.app_context():
+        model = OpenAIModel(name='gpt-test', description='test model')
+        model.costs.append(ModelCost(in_tokens_cost=1.0, out_tokens_cost=2.0, start_date=datetime(2020, 1, 1)))
+        project = Project(name='p', spending_limit=100, api_key=APIKey(name='k', key_string='sk-test'))
+        db.session.add_all([model, InternalAPIKey(internal_api_key_string='ik', project=project, spending_limit=2,
+                                                  start_date=datetime(2020, 1, 1))])
+        db.session.commit()
+    price_index.invalidate()
+    price_index.check_interval = 0
+    yield app
+    price_index.invalidate()
+
+
+def chat(app, monkeypatch, status=200, max_tokens=100):
+    # -> (status, body) of a chat call, and what was held while it was upstream
+    held = []
+
+    def post(path, keys, data=None, model=None, on_hedge=None, **kwargs):
+        held.append(counters.held())
+        content = json.dumps({'choices': [], 'usage': {'prompt_tokens': 9, 'completion_tokens': 50}}).encode()
+        return CoalescedResponse(status, {'Content-Type': 'application/json'}, content)
+    monkeypatch.setattr(key_scheduler, 'post', post)
+    resp = app.test_client().post('/v1/chat/completions', headers={'Authorization': 'Bearer ik'},
+                                  json={'model': 'gpt-test', 'max_tokens': max_tokens,
+                                        'messages': [{'role': 'user', 'content': 'x' * 8}]})
+    return resp, held
+
+
+def left_held():
+    keys, projects = counters.held()
+    return sum(keys.values()) + sum(projects.values())
+
+
+def test_a_saved_call_settles_its_worst_case_reservation(reserving_app, monkeypatch):
+    resp, held = chat(reserving_app, monkeypatch)
+    assert resp.status_code == 200
+    # 9 prompt tokens at $1 and 100 completion tokens at $2 per 1000
+    assert held == [({1: pytest.approx(0.209)}, {1: pytest.approx(0.209)})]
+    assert left_held() == 0
+    with reserving_app.app_context():
+        assert db.session.get(InternalAPIKey, 1).total_spent == pytest.approx(0.109)
+
+
+def test_a_call_that_is_not_saved_gets_its_reservation_back(reserving_app, monkeypatch):
+    resp, held = chat(reserving_app, monkeypatch, status=500)
+    assert resp.status_code == 500 and len(held) == 1
+    assert left_held() == 0
+    with reserving_app.app_context():
+        assert db.session.query(APIResponse).count() == 0
+
+
+def test_a_call_whose_worst_case_does_not_fit_gets_a_403(reserving_app, monkeypatch):
+    # $2.009 at most, over 98% of the key's $2
+    resp, held = chat(reserving_app, monkeypatch, max_tokens=1000)
+    assert resp.status_code == 403
+    assert 'lower max_tokens' in resp.get_json()['error'] and held == []
+    assert left_held() == 0
@@ -0,0 +1,51 @@
+import pytest
+import tokenizer as tokenizer_module
+from tokenizer import Tokenizer
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    # without tiktoken: 4 bytes a token, whatever vocabularies are on this machine
+    monkeypatch.setattr(tokenizer_module, 'tiktoken', None)
+    return Tokenizer()
+
+
+def test_a_chat_prompt_counts_every_message_and_max_tokens_every_choice(tokenizer):
+    body = {'model': 'gpt-4', 'max_tokens': 10, 'n': 2,
+            'messages': [{'role': 'system', 'content': 'x' * 8}, {'role': 'user', 'content': [{'text': 'y' * 4}]}]}
+    # 3, then 3 + role + content per message
+    assert tokenizer.estimate('v1/chat/completions', body) == (3 + (3 + 2 + 2) + (3 + 1 + 1), 20)
+
+
+def test_without_max_tokens_a_chat_call_may_use_the_rest_of_the_context_window(tokenizer):
+    body = {'model': 'gpt-4-0613', 'messages': [{'role': 'user', 'content': 'x' * 8}]}
+    assert tokenizer.estimate('v1/chat/completions', body) == (9, 8192 - 9)
+    body = {'model': 'gpt-4', 'max_tokens': None, 'messages': [{'role': 'user', 'content': 'x' * 40000}]}
+    assert tokenizer.estimate('v1/chat/completions', body) == (10007, 0)
+
+
+def test_completions_default_to_16_tokens_per_prompt(tokenizer):
+    assert tokenizer.estimate('v1/completions', {'model': 'text-davinci-003', 'prompt': ['abcd', 'efgh']}) == (2, 32)
+    # token ids are one prompt
+    assert tokenizer.estimate('v1/completions', {'model': 'text-davinci-003', 'prompt': [1, 2, 3],
+                                                 'max_tokens': 5, 'best_of': 3}) == (3, 15)
+
+
+def test_embeddings_count_their_input_and_complete_nothing(tokenizer):
+    assert tokenizer.estimate('v1/embeddings', {'model': 'm', 'input': 'abcdefgh'}) == (2, 0)
+    assert tokenizer.estimate('v1/embeddings', {'model': 'm', 'input': ['abcd', [1, 2, 3]]}) == (4, 0)
+
+
+def test_repeated_strings_are_counted_once(monkeypatch):
+    class Encoding:
+        # stands in for a tiktoken encoding: a token per word
+        name = 'fake'
+        calls = 0
+
+        def encode_ordinary(self, text):
+            Encoding.calls += 1
+            return text.split()
+    tokenizer = Tokenizer()
+    monkeypatch.setattr(tokenizer, '_encoding', lambda model: Encoding())
+    assert [tokenizer.count('m', 'a b c') for _ in range(3)] == [3, 3, 3]
+    assert Encoding.calls == 1 and (tokenizer.hits, tokenizer.misses) == (2, 1)
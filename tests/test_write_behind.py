@@ -0,0 +1,110 @@
+from datetime import datetime
+import glob, json, os, threading, time
+import pytest
+from models import db, APIResponse
+from pricing import price_index
+from write_behind import api_response_writer, _encode
+
+
+def record(model='gpt-test', **extra):
+    return dict(model_name=model, tokens_in=10, tokens_out=5, internal_api_key_id=1, project_id=1,
+                time_created=datetime(2026, 1, 1), **extra)
+
+
+def rows(app):
+    with app.app_context():
+        return sorted(r.model_name for r in db.session.query(APIResponse))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def writer(app):
+    saved = {name: getattr(api_response_writer, name) for name in ('flush_interval', 'max_attempts', 'max_queue', 'put_timeout')}
+    api_response_writer.flush_interval = 0.05
+    yield api_response_writer
+    api_response_writer.stop()
+    for name, value in saved.items():
+        setattr(api_response_writer, name, value)
+
+
+def test_replay_skips_rows_with_a_commit_marker(app, writer):
+    os.makedirs(writer.spill_dir, exist_ok=True)
+    with open(os.path.join(writer.spill_dir, 'api_response.999999.jsonl'), 'w') as f:
+        for seq, model in enumerate(['a', 'b', 'c']):
+            f.write(_encode(record(model, seq=seq)) + '\n')
+        f.write(json.dumps({'committed': [0, 2]}) + '\n')
+    writer._ensure_started()
+    assert rows(app) == ['b']
+    assert not os.path.exists(os.path.join(writer.spill_dir, 'api_response.999999.jsonl'))
+
+
+def test_replay_of_a_journal_with_counted_markers(app, writer):
+    # journals written before rows were numbered count committed rows from the start
+    os.makedirs(writer.spill_dir, exist_ok=True)
+    with open(os.path.join(writer.spill_dir, 'api_response.999998.jsonl'), 'w') as f:
+        f.write(_encode(record('a')) + '\n' + _encode(record('b')) + '\n')
+        f.write(json.dumps({'committed': 1}) + '\n')
+        f.write(_encode(record('c')) + '\n')
+    writer._ensure_started()
+    assert rows(app) == ['b', 'c']
+
+
+def test_a_row_the_db_rejects_goes_to_the_dead_letter_file(app, writer, monkeypatch):
+    writer.max_attempts = 2
+    cost = price_index.cost
+
+    def reject_bad(model_name, *args):
+        if model_name == 'bad':
+            raise ValueError('no such model')
+        return cost(model_name, *args)
+    monkeypatch.setattr(price_index, 'cost', reject_bad)
+    for model in ('a', 'bad', 'b'):
+        writer.submit(record(model))
+    wait_for(lambda: rows(app) == ['a', 'b'])
+    wait_for(lambda: os.path.exists(writer.dead_letter_path))
+    with open(writer.dead_letter_path) as f:
+        dead = [json.loads(line) for line in f]
+    assert [d['model_name'] for d in dead] == ['bad']
+    assert 'no such model' in dead[0]['error']
+    # and writing carries on
+    writer.submit(record('c'))
+    wait_for(lambda: rows(app) == ['a', 'b', 'c'])
+    journal, = glob.glob(os.path.join(writer.spill_dir, 'api_response.*.jsonl'))
+    wait_for(lambda: os.path.getsize(journal) == 0)
+
+
+def test_a_full_queue_does_not_hold_up_other_requests(app, writer, monkeypatch):
+    writer.max_queue = 1
+    writer.put_timeout = 1
+    release = threading.Event()
+    write = writer._write
+
+    def slow_write(records):
+        release.wait(5)
+        write(records)
+    monkeypatch.setattr(writer, '_write', slow_write)
+    writer.submit(record('a'))  # taken by the flusher, which then hangs
+    wait_for(lambda: writer._queue.empty())
+    writer.submit(record('b'))  # fills the queue
+    waiting = [threading.Thread(target=writer.submit, args=(record(m),)) for m in ('c', 'd')]
+    started = time.monotonic()
+    for t in waiting:
+        t.start()
+    journal, = glob.glob(os.path.join(writer.spill_dir, 'api_response.*.jsonl'))
+
+    def journaled():
+        with open(journal) as f:
+            return sum(1 for line in f if '"model_name"' in line)
+    # both waiting requests journal their row right away instead of queueing behind each other
+    wait_for(lambda: journaled() == 4, timeout=0.5)
+    assert time.monotonic() - started < 0.5
+    release.set()
+    for t in waiting:
+        t.join()
+    wait_for(lambda: rows(app) == ['a', 'b', 'c', 'd'])
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+import json, logging, os, threading
+from pricing import price_index
+
+try:
+    import tiktoken
+except ImportError:  # optional, pip install tiktoken
+    tiktoken = None
+
+log = logging.getLogger(__name__)
+
+# longest prefix first; what a call may use in total when it doesn't set max_tokens
+CONTEXT_WINDOWS = (('gpt-4-32k', 32768), ('gpt-4', 8192), ('gpt-3.5-turbo-16k', 16385), ('gpt-3.5-turbo', 4096),
+                   ('text-davinci-003', 4097), ('text-davinci-002', 4097), ('', 2049))
+
+
+def context_window(model):
+    for prefix, size in CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return size
+
+
+class Tokenizer:
+    """Token counts of a call before it goes upstream, to reserve its worst-case cost.
+
+    Counts with tiktoken's BPE vocabularies when it is installed; point
+    TOKENIZER_VOCAB_DIR at a directory of downloaded vocabularies to run
+    without network access. Without tiktoken a token is taken to be 4 bytes.
+    Counts of strings are kept in an LRU cache of TOKENIZER_CACHE_SIZE
+    entries, so a system prompt sent with every call is encoded once.
+    """
+
+    def __init__(self):
+        self.cache_size = 10000
+        self._cache = OrderedDict()
+        self._encodings = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.config.setdefault('TOKENIZER_CACHE_SIZE', self.cache_size)
+        app.config.setdefault('TOKENIZER_VOCAB_DIR', None)
+        self.cache_size = app.config['TOKENIZER_CACHE_SIZE']
+        if app.config['TOKENIZER_VOCAB_DIR']:
+            # where tiktoken looks for its vocabularies before downloading them
+            os.environ.setdefault('TIKTOKEN_CACHE_DIR', app.config['TOKENIZER_VOCAB_DIR'])
+
+    def _encoding(self, model):
+        # None when there's no tiktoken or its vocabulary can't be loaded (offline, not in TOKENIZER_VOCAB_DIR)
+        if tiktoken is None:
+            return None
+        encoding = self._encodings.get(model, False)
+        if encoding is False:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                log.warning('No tiktoken vocabulary for %s, estimating 4 bytes per token', model, exc_info=True)
+                encoding = None
+            self._encodings[model] = encoding
+        return encoding
+
+    def count(self, model, text):
+        if not text:
+            return 0
+        encoding = self._encoding(model)
+        if encoding is None:
+            return (len(text.encode()) + 3) // 4
+        key = (encoding.name, text)
+        with self._lock:
+            n = self._cache.get(key)
+            if n is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return n
+        n = len(encoding.encode_ordinary(text))
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = n
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    def _count_input(self, model, value):
+        # a prompt or embeddings input: a string, a list of strings, or token ids
+        if isinstance(value, str):
+            return self.count(model, value)
+        if not isinstance(value, list):
+            return 0
+        if all(isinstance(v, int) for v in value):
+            return len(value)
+        return sum(self._count_input(model, v) for v in value)
+
+    def _count_messages(self, model, messages):
+        # as OpenAI counts chat prompts: a few tokens per message around role and content
+        n = 3
+        for message in messages or []:
+            n += 3 + self.count(model, message.get('role'))
+            content = message.get('content')
+            if isinstance(content, list):
+                content = ''.join(part.get('text') or '' for part in content if isinstance(part, dict))
+            n += self.count(model, content if isinstance(content, str) else None)
+            if message.get('name'):
+                n += 1 + self.count(model, message['name'])
+            if message.get('function_call') or message.get('tool_calls'):
+                n += self.count(model, json.dumps(message.get('function_call') or message.get('tool_calls')))
+        return n
+
+    def estimate(self, endpoint, body):
+        # -> (prompt tokens, the most completion tokens the call may be billed for)
+        model = body.get('model') or ''
+        if endpoint == 'v1/embeddings':
+            return self._count_input(model, body.get('input')), 0
+        choices = max(body.get('n') or 1, body.get('best_of') or 1)
+        if endpoint == 'v1/chat/completions':
+            prompt = self._count_messages(model, body.get('messages'))
+            for extra in ('functions', 'tools'):
+                if body.get(extra):
+                    prompt += self.count(model, json.dumps(body[extra]))
+            max_tokens = body.get('max_tokens')
+        else:
+            prompts = body.get('prompt')
+            prompt = self._count_input(model, prompts)
+            if isinstance(prompts, list) and prompts and not isinstance(prompts[0], int):
+                choices *= len(prompts)  # one completion per prompt
+            max_tokens = body.get('max_tokens', 16)
+        if max_tokens is None:
+            max_tokens = max(context_window(model) - prompt, 0)
+        return prompt, max_tokens * choices
+
+    def estimate_cost(self, endpoint, body):
+        # USD at the model's current price, or None when it has none
+        prompt, completion = self.estimate(endpoint, body)
+        cost = price_index.cost(body.get('model'), prompt, completion)
+        return sum(cost) if cost is not None else None
+
+    def stats(self):
+        return {'tiktoken': tiktoken is not None, 'cached': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+tokenizer = Tokenizer()
@@ -0,0 +1,132 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import cProfile, os, pstats, random, threading, time
+
+_current = ContextVar('trace', default=None)
+
+
+class Trace:
+    # Phase timings of one proxied call
+    __slots__ = ('started', 'phases', 'profile', 'token')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.profile = None
+        self.token = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.phases]
+        parts.append(f'total;dur={self.total() * 1000:.1f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def phase(name):
+    # times a block as a phase of the current call, if there is one
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.phase(name):
+        yield
+
+
+class Tracer:
+    """Per-call phase timings, the slowest calls, and on-demand profiling.
+
+    Every proxied call gets a Server-Timing header with its phases (auth,
+    spend, cache, queue, upstream, save). Calls slower than
+    TRACE_SLOW_MS are sampled (TRACE_SLOW_SAMPLE_RATE) into a ring buffer of
+    TRACE_BUFFER_SIZE entries, shown in the admin under "Slow requests".
+    From there an admin can run cProfile on the next N calls (one at a time,
+    calls arriving while one is profiled are skipped); the combined stats
+    are written to PROFILE_DIR for download. Both the buffer and the profiler
+    are per worker process.
+    """
+
+    def __init__(self):
+        self.slow_ms = 1000
+        self.sample_rate = 1.0
+        self.profile_dir = None
+        self.slow = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._profile_left = 0
+        self._profiling = 0
+        self._stats = None
+
+    def init_app(self, app):
+        app.config.setdefault('TRACE_SLOW_MS', self.slow_ms)
+        app.config.setdefault('TRACE_SLOW_SAMPLE_RATE', self.sample_rate)
+        app.config.setdefault('TRACE_BUFFER_SIZE', self.slow.maxlen)
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        self.slow_ms = app.config['TRACE_SLOW_MS']
+        self.sample_rate = app.config['TRACE_SLOW_SAMPLE_RATE']
+        self.slow = deque(maxlen=app.config['TRACE_BUFFER_SIZE'])
+        self.profile_dir = app.config['PROFILE_DIR']
+
+    def start(self):
+        trace = Trace()
+        trace.token = _current.set(trace)
+        with self._lock:
+            # one call at a time, profilers don't nest
+            if self._profile_left and not self._profiling:
+                self._profile_left -= 1
+                self._profiling = 1
+                trace.profile = cProfile.Profile()
+        if trace.profile is not None:
+            trace.profile.enable()
+        return trace
+
+    def finish(self, trace, endpoint, project, model, status):
+        if trace.profile is not None:
+            trace.profile.disable()
+            self._add_profile(trace.profile)
+        _current.reset(trace.token)
+        total = trace.total()
+        if total * 1000 >= self.slow_ms and random.random() < self.sample_rate:
+            self.slow.append({'time': datetime.utcnow(), 'endpoint': endpoint, 'project': project, 'model': model,
+                              'status': status, 'total_ms': round(total * 1000, 1),
+                              'phases': [(name, round(seconds * 1000, 1)) for name, seconds in trace.phases]})
+
+    def profile_next(self, n):
+        with self._lock:
+            self._profile_left = n
+
+    def profiling(self):
+        # -> calls still to be profiled, including the ones running now
+        return self._profile_left + self._profiling
+
+    def _add_profile(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._profiling = 0
+            if self._profile_left:
+                return
+            stats, self._stats = self._stats, None
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stats.dump_stats(os.path.join(self.profile_dir, f'{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}.prof'))
+
+    def profiles(self):
+        if not self.profile_dir or not os.path.isdir(self.profile_dir):
+            return []
+        return sorted((f for f in os.listdir(self.profile_dir) if f.endswith('.prof')), reverse=True)
+
+
+tracer = Tracer()
@@ -0,0 +1,270 @@
+from urllib.parse import urlsplit
+import json, threading
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:  # optional, pip install orjson
+    loads = json.loads
+
+
+class UpstreamResponse:
+    # Thin wrapper so callers don't care whether requests or httpx did the call.
+    # Holds a pool slot until close() for streamed responses.
+    def __init__(self, raw, pool, stream):
+        self._raw = raw
+        self._pool = pool
+        self._closed = False
+        self.status_code = raw.status_code
+        self.headers = raw.headers
+        if not stream:
+            self.content
+            self.close()
+
+    @property
+    def content(self):
+        if hasattr(self._raw, 'read'):  # httpx
+            return self._raw.read()
+        return self._raw.content
+
+    def json(self):
+        return loads(self.content)
+
+    def iter_lines(self, chunk_size=None):
+        if hasattr(self._raw, 'iter_bytes'):  # httpx
+            pending = b''
+            for data in self._raw.iter_bytes():
+                pending += data
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    yield line.rstrip(b'\r')
+            if pending:
+                yield pending
+        else:
+            yield from self._raw.iter_lines(chunk_size=chunk_size)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._raw.close()
+        self._pool.release()
+
+
+class _Pool:
+    # One keep-alive connection pool per (APIKey, upstream host)
+    def __init__(self, client):
+        self.size = client.pool_size
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.waited = 0
+        if client.http2:
+            import httpx  # optional, pip install httpx[http2]
+            self.session = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=self.size,
+                                    max_keepalive_connections=self.size if client.keepalive else 0),
+                timeout=httpx.Timeout(client.read_timeout, connect=client.connect_timeout))
+        else:
+            self.session = requests.Session()
+            self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.size, pool_block=True)
+            self.session.mount('http://', self.adapter)
+            self.session.mount('https://', self.adapter)
+            if not client.keepalive:
+                self.session.headers['Connection'] = 'close'
+
+    def acquire(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            if self.in_flight > self.size:
+                self.waited += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        new_connections = None
+        if hasattr(self, 'adapter'):
+            pools = self.adapter.poolmanager.pools
+            new_connections = sum(pools[k].num_connections for k in pools.keys())
+        return {
+            'pool_size': self.size,
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'waiters': max(0, self.in_flight - self.size),
+            'requests_that_waited': self.waited,
+            'new_connections': new_connections,
+            'reuse_rate': None if new_connections is None or not self.requests
+                          else max(0.0, 1 - new_connections / self.requests),
+        }
+
+
+class UpstreamClient:
+    """Keeps a pooled, keep-alive HTTP client per APIKey and upstream host.
+
+    Settings come from the app config (UPSTREAM_*), see init_app. Setting
+    UPSTREAM_BASE_URL points every proxied call at another server, e.g. a
+    local stub. UPSTREAM_HTTP2 needs httpx[http2] to be installed.
+    """
+
+    def __init__(self):
+        self.base_url = 'https://api.openai.com'
+        self.pool_size = 10
+        self.keepalive = True
+        self.connect_timeout = 5
+        self.read_timeout = 600
+        self.http2 = False
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('UPSTREAM_BASE_URL', self.base_url)
+        app.config.setdefault('UPSTREAM_POOL_SIZE', self.pool_size)
+        app.config.setdefault('UPSTREAM_KEEPALIVE', self.keepalive)
+        app.config.setdefault('UPSTREAM_CONNECT_TIMEOUT', self.connect_timeout)
+        app.config.setdefault('UPSTREAM_READ_TIMEOUT', self.read_timeout)
+        app.config.setdefault('UPSTREAM_HTTP2', self.http2)
+        self.base_url = app.config['UPSTREAM_BASE_URL'].rstrip('/')
+        self.pool_size = app.config['UPSTREAM_POOL_SIZE']
+        self.keepalive = app.config['UPSTREAM_KEEPALIVE']
+        self.connect_timeout = app.config['UPSTREAM_CONNECT_TIMEOUT']
+        self.read_timeout = app.config['UPSTREAM_READ_TIMEOUT']
+        self.http2 = app.config['UPSTREAM_HTTP2']
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _pool(self, api_key_id, host):
+        key = (api_key_id, host)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = _Pool(self)
+        return pool
+
+    def post(self, path, api_key_id, headers, data=None, json=None, stream=False, timeout=None):
+        # timeout: (connect, read) seconds, UPSTREAM_CONNECT_TIMEOUT and UPSTREAM_READ_TIMEOUT by default
+        url = self.url(path)
+        pool = self._pool(api_key_id, urlsplit(url).netloc)
+        connect_timeout, read_timeout = timeout or (self.connect_timeout, self.read_timeout)
+        pool.acquire()
+        try:
+            if self.http2:
+                import httpx
+                req = pool.session.build_request('POST', url, headers=headers, content=data, json=json,
+                                                 timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+                raw = pool.session.send(req, stream=True)
+            else:
+                raw = pool.session.post(url, headers=headers, data=data, json=json, stream=True,
+                                        timeout=(connect_timeout, read_timeout))
+        except Exception:
+            pool.release()
+            raise
+        return UpstreamResponse(raw, pool, stream)
+
+    def stats(self):
+        return {f'{api_key_id}@{host}': pool.stats() for (api_key_id, host), pool in list(self._pools.items())}
+
+
+upstream = UpstreamClient()
+
+
+class AsyncUpstreamResponse:
+    # UpstreamResponse for the asyncio engine. content is read up front unless streamed.
+    def __init__(self, raw):
+        self._raw = raw
+        self.status_code = raw.status_code
+        self.headers = raw.headers
+        self.content = None
+
+    def json(self):
+        return loads(self.content)
+
+    async def read(self):
+        self.content = await self._raw.aread()
+        return self.content
+
+    async def aiter_lines(self):
+        pending = b''
+        async for data in self._raw.aiter_bytes():
+            pending += data
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending:
+            yield pending
+
+    async def aclose(self):
+        await self._raw.aclose()
+
+
+class AsyncUpstreamClient:
+    """httpx.AsyncClient counterpart of UpstreamClient, used by asgi.py.
+
+    Shares the UPSTREAM_* settings, except that each (APIKey, host) pool may
+    hold UPSTREAM_ASYNC_POOL_SIZE connections, since one event loop carries
+    many more calls than a thread pool.
+    """
+
+    def __init__(self):
+        self.pool_size = 500
+        self._clients = {}
+        self.requests = 0
+        self.in_flight = 0
+
+    def init_app(self, app):
+        app.config.setdefault('UPSTREAM_ASYNC_POOL_SIZE', self.pool_size)
+        self.pool_size = app.config['UPSTREAM_ASYNC_POOL_SIZE']
+
+    def _client(self, api_key_id, host):
+        client = self._clients.get((api_key_id, host))
+        if client is None:
+            import httpx
+            client = self._clients[(api_key_id, host)] = httpx.AsyncClient(
+                http2=upstream.http2,
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size if upstream.keepalive else 0),
+                timeout=httpx.Timeout(upstream.read_timeout, connect=upstream.connect_timeout))
+        return client
+
+    async def post(self, path, api_key_id, headers, data, stream=False, timeout=None):
+        import httpx
+        url = upstream.url(path)
+        client = self._client(api_key_id, urlsplit(url).netloc)
+        connect_timeout, read_timeout = timeout or (upstream.connect_timeout, upstream.read_timeout)
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            req = client.build_request('POST', url, headers=headers, content=data,
+                                       timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+            raw = await client.send(req, stream=True)
+            resp = AsyncUpstreamResponse(raw)
+            if not stream:
+                try:
+                    await resp.read()
+                finally:
+                    await resp.aclose()
+            return resp
+        finally:
+            self.in_flight -= 1
+
+    async def aclose(self):
+        for client in list(self._clients.values()):
+            await client.aclose()
+        self._clients.clear()
+
+    def stats(self):
+        return {'clients': len(self._clients), 'requests': self.requests, 'in_flight': self.in_flight}
+
+
+async_upstream = AsyncUpstreamClient()
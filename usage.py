@@ -0,0 +1,129 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, APIResponse, InternalAPIKey, UsageDaily, User
+from archive import archived_usage
+from pricing import price_index
+
+SUMMED = ('requests', 'tokens_in', 'tokens_out', 'in_cost', 'out_cost', 'cached_requests', 'saved_cost')
+
+
+def rollup(records):
+    # APIResponse column dicts -> usage_daily rows, one per (day, key, model)
+    rows = {}
+    for r in records:
+        key = (r['time_created'].date(), r['internal_api_key_id'], r['model_name'])
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = dict(zip(('day', 'internal_api_key_id', 'model_name'), key), **dict.fromkeys(SUMMED, 0))
+        row['requests'] += 1
+        row['tokens_in'] += r.get('tokens_in') or 0
+        row['tokens_out'] += r.get('tokens_out') or 0
+        row['in_cost'] += r.get('in_cost') or 0
+        row['out_cost'] += r.get('out_cost') or 0
+        if r.get('cached'):
+            row['cached_requests'] += 1
+            saved = price_index.cost(r['model_name'], r.get('tokens_in') or 0, r.get('tokens_out') or 0, r['time_created'])
+            row['saved_cost'] += sum(saved) if saved else 0
+    return list(rows.values())
+
+
+def add_to_usage_daily(rows):
+    # Upsert that adds to existing sums. Runs in the caller's transaction.
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(UsageDaily)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['day', 'internal_api_key_id', 'model_name'],
+            set_={c: getattr(UsageDaily, c) + getattr(stmt.excluded, c) for c in SUMMED})
+        db.session.execute(stmt, rows)
+        return
+    for row in rows:
+        existing = db.session.get(UsageDaily, (row['day'], row['internal_api_key_id'], row['model_name']))
+        if existing is None:
+            db.session.add(UsageDaily(**row))
+        else:
+            for c in SUMMED:
+                setattr(existing, c, getattr(existing, c) + row[c])
+
+
+def rebuild_usage_daily():
+    # Recomputes the whole rollup from api_response and the archived months, e.g. after a backfill
+    day = db.func.date(APIResponse.time_created)
+    cached = db.case((APIResponse.cached == True, 1), else_=0)
+    query = db.session.query(day, APIResponse.internal_api_key_id, APIResponse.model_name,
+                             db.func.count(),
+                             db.func.coalesce(db.func.sum(APIResponse.tokens_in), 0),
+                             db.func.coalesce(db.func.sum(APIResponse.tokens_out), 0),
+                             db.func.coalesce(db.func.sum(APIResponse.in_cost), 0),
+                             db.func.coalesce(db.func.sum(APIResponse.out_cost), 0),
+                             db.func.sum(cached),
+                             db.func.coalesce(db.func.sum(APIResponse.tokens_in * cached), 0),
+                             db.func.coalesce(db.func.sum(APIResponse.tokens_out * cached), 0)) \
+        .group_by(day, APIResponse.internal_api_key_id, APIResponse.model_name)
+    rows = []
+    for d, internal_api_key_id, model_name, requests, tokens_in, tokens_out, in_cost, out_cost, \
+            cached_requests, cached_tokens_in, cached_tokens_out in query:
+        if isinstance(d, str):  # sqlite returns date() as text
+            d = datetime.strptime(d, '%Y-%m-%d').date()
+        # savings are priced per day here, not per call
+        saved = price_index.cost(model_name, cached_tokens_in, cached_tokens_out, datetime(d.year, d.month, d.day))
+        rows.append(dict(day=d, internal_api_key_id=internal_api_key_id, model_name=model_name,
+                         requests=requests, tokens_in=tokens_in, tokens_out=tokens_out, in_cost=in_cost,
+                         out_cost=out_cost, cached_requests=cached_requests or 0, saved_cost=sum(saved) if saved else 0))
+    rows.extend(archived_usage())
+    db.session.query(UsageDaily).delete()
+    for n in range(0, len(rows), 1000):
+        add_to_usage_daily(rows[n:n + 1000])
+    return len(rows)
+
+
+def project_activity(project, user_ids=None, start_date=None, end_date=None):
+    # Activity of a project grouped by day, user and model. Dates are matched by day.
+    filters = [InternalAPIKey.project_id == project.id]
+    if user_ids:
+        filters.append(InternalAPIKey.user_id.in_(user_ids))
+    if start_date:
+        filters.append(UsageDaily.day >= start_date.date())
+    if end_date:
+        filters.append(UsageDaily.day <= end_date.date())
+    query = db.session.query(UsageDaily.day, User.username, UsageDaily.model_name,
+                             db.func.sum(UsageDaily.tokens_in), db.func.sum(UsageDaily.tokens_out),
+                             db.func.sum(UsageDaily.in_cost), db.func.sum(UsageDaily.out_cost),
+                             db.func.sum(UsageDaily.cached_requests), db.func.sum(UsageDaily.saved_cost)) \
+        .join(InternalAPIKey, UsageDaily.internal_api_key_id == InternalAPIKey.id) \
+        .outerjoin(User, InternalAPIKey.user_id == User.id) \
+        .filter(*filters) \
+        .group_by(UsageDaily.day, User.username, UsageDaily.model_name) \
+        .order_by(UsageDaily.day)
+    responses = {}
+    total_costs = {'tokens_in': 0, 'tokens_out': 0, 'cached_requests': 0, 'saved_cost': 0}
+    model_costs = defaultdict(lambda: {'tokens_in': 0, 'tokens_out': 0})
+    for day, username, model_name, tokens_in, tokens_out, in_cost, out_cost, cached_requests, saved_cost in query:
+        day = day.strftime('%Y-%m-%d') if hasattr(day, 'strftime') else day
+        if day not in responses:
+            responses[day] = {
+                'total': {'tokens_in': 0, 'tokens_out': 0, 'cost': {'in_cost': 0, 'out_cost': 0},
+                          'cached_requests': 0, 'saved_cost': 0},
+                'users': defaultdict(dict)
+            }
+        responses[day]['users'][username][model_name] = {'tokens_in': tokens_in, 'tokens_out': tokens_out,
+                                                         'cost': {'in_cost': in_cost, 'out_cost': out_cost},
+                                                         'cached_requests': cached_requests, 'saved_cost': saved_cost}
+        total = responses[day]['total']
+        total['tokens_in'] += tokens_in
+        total['tokens_out'] += tokens_out
+        total['cost']['in_cost'] += in_cost
+        total['cost']['out_cost'] += out_cost
+        total['cached_requests'] += cached_requests
+        total['saved_cost'] += saved_cost
+        total_costs['tokens_in'] += in_cost
+        total_costs['tokens_out'] += out_cost
+        total_costs['cached_requests'] += cached_requests
+        total_costs['saved_cost'] += saved_cost
+        model_costs[model_name]['tokens_in'] += in_cost
+        model_costs[model_name]['tokens_out'] += out_cost
+    return responses, total_costs, model_costs
@@ -0,0 +1,305 @@
+from datetime import datetime
+import atexit, fcntl, glob, itertools, json, logging, os, queue, threading, time
+from collections import defaultdict
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+from models import db, APIResponse
+from pricing import price_index
+from usage import rollup, add_to_usage_daily
+from payloads import payload_store
+from auth_cache import auth_cache
+from spend import spend_ledger, add_spend
+from counters import counters
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+COLUMNS = [c.name for c in APIResponse.__table__.columns if c.name != 'id']
+
+
+def _encode(record):
+    return json.dumps({**record, 'time_created': record['time_created'].isoformat()})
+
+def _decode(line):
+    record = json.loads(line)
+    record['time_created'] = datetime.fromisoformat(record['time_created'])
+    return record
+
+
+class WriteBehindQueue:
+    """Batches APIResponse rows and writes them from a background thread.
+
+    submit() journals the record to this worker's spill file and puts it on a
+    bounded queue; the flusher thread inserts queued records in multi-row
+    INSERTs once WRITE_BEHIND_BATCH_SIZE records are waiting or
+    WRITE_BEHIND_FLUSH_INTERVAL seconds have passed. After every committed
+    batch a marker with the journal numbers of its rows is journaled, so a
+    journal left behind by a crashed worker can be replayed without
+    duplicating rows. When the queue stays full for WRITE_BEHIND_PUT_TIMEOUT
+    seconds the caller writes its own row instead. A batch that fails
+    WRITE_BEHIND_MAX_ATTEMPTS times is written row by row, and rows the
+    database rejects go to dead_letter.jsonl in the spill directory.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.batch_size = 200
+        self.flush_interval = 1.0
+        self.max_queue = 10000
+        self.put_timeout = 0.5
+        self.drain_timeout = 10
+        self.max_attempts = 3
+        self.fsync = False
+        self.app = None
+        self._queue = None
+        self._thread = None
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._seq = None
+        self._unqueued = 0  # journaled, but neither queued nor written yet
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.written = 0
+        self.written_sync = 0
+        self.dead_lettered = 0
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BEHIND_ENABLED', self.enabled)
+        app.config.setdefault('WRITE_BEHIND_BATCH_SIZE', self.batch_size)
+        app.config.setdefault('WRITE_BEHIND_FLUSH_INTERVAL', self.flush_interval)
+        app.config.setdefault('WRITE_BEHIND_MAX_QUEUE', self.max_queue)
+        app.config.setdefault('WRITE_BEHIND_PUT_TIMEOUT', self.put_timeout)
+        app.config.setdefault('WRITE_BEHIND_DRAIN_TIMEOUT', self.drain_timeout)
+        app.config.setdefault('WRITE_BEHIND_MAX_ATTEMPTS', self.max_attempts)
+        app.config.setdefault('WRITE_BEHIND_FSYNC', self.fsync)
+        app.config.setdefault('WRITE_BEHIND_SPILL_DIR', os.path.join(app.instance_path, 'spill'))
+        self.enabled = app.config['WRITE_BEHIND_ENABLED']
+        self.batch_size = app.config['WRITE_BEHIND_BATCH_SIZE']
+        self.flush_interval = app.config['WRITE_BEHIND_FLUSH_INTERVAL']
+        self.max_queue = app.config['WRITE_BEHIND_MAX_QUEUE']
+        self.put_timeout = app.config['WRITE_BEHIND_PUT_TIMEOUT']
+        self.drain_timeout = app.config['WRITE_BEHIND_DRAIN_TIMEOUT']
+        self.max_attempts = app.config['WRITE_BEHIND_MAX_ATTEMPTS']
+        self.fsync = app.config['WRITE_BEHIND_FSYNC']
+        self.spill_dir = app.config['WRITE_BEHIND_SPILL_DIR']
+        self.app = app
+        atexit.register(self.stop)
+
+    def submit(self, record):
+        record.setdefault('time_created', datetime.utcnow())
+        if not self.enabled:
+            return self._write([record])
+        self._ensure_started()
+        with self._journal_lock:
+            record['seq'] = next(self._seq)
+            self._journal_write(_encode(record))
+            try:
+                self._queue.put_nowait(record)
+                return
+            except queue.Full:
+                self._unqueued += 1
+        # the queue is full: wait for room without holding up other requests
+        try:
+            self._queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            # backpressure: this request pays for its own insert
+            self.written_sync += 1
+            try:
+                self._write([record])
+            finally:
+                with self._journal_lock:
+                    self._unqueued -= 1
+            self._committed([record], last=False)
+            return
+        with self._journal_lock:
+            self._unqueued -= 1
+
+    def _ensure_started(self):
+        # Started lazily so gunicorn forks before any thread or file handle exists
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._stopping.clear()
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._replay_orphaned_journals()
+            path = os.path.join(self.spill_dir, f'api_response.{os.getpid()}.jsonl')
+            self._journal = open(path, 'a+')
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+            self._seq = itertools.count()
+            self._thread = threading.Thread(target=self._run, name='api-response-writer', daemon=True)
+            self._thread.start()
+
+    def _journal_write(self, line):
+        self._journal.write(line + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _replay_orphaned_journals(self):
+        # A journal we can lock belongs to a worker that is gone
+        for path in glob.glob(os.path.join(self.spill_dir, 'api_response.*.jsonl')):
+            with open(path, 'r+') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                records, committed, count = [], set(), 0
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if line.startswith('{"committed"'):
+                        seqs = json.loads(line)['committed']
+                        if isinstance(seqs, int):
+                            count += seqs  # journals from before rows were numbered
+                        else:
+                            committed.update(seqs)
+                    else:
+                        records.append(_decode(line))
+                pending = [record for n, record in enumerate(records)
+                           if (record['seq'] not in committed if 'seq' in record else n >= count)]
+                for record in pending:
+                    record.pop('reservation', None)  # held by the dead worker's ledger, not ours
+                if pending:
+                    log.warning('Replaying %d unwritten api_response rows from %s', len(pending), path)
+                    for n in range(0, len(pending), self.batch_size):
+                        batch = pending[n:n + self.batch_size]
+                        try:
+                            self._write(batch)
+                        except (OperationalError, InterfaceError):
+                            raise  # the db is down; the journal stays for the next start
+                        except Exception:
+                            log.exception('Replaying %d api_response rows failed, writing them one by one', len(batch))
+                            _, remaining = self._write_each(batch)
+                            if remaining:
+                                raise RuntimeError(f'Could not replay {path}')
+                os.unlink(path)
+
+    def _next_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set() and self._queue.empty():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if self._stopping.is_set():
+                    return
+                continue
+            failures = 0
+            while batch:
+                if failures >= self.max_attempts:
+                    # one bad row mustn't hold up the rest: write them one at a time and set
+                    # aside those the db rejects. What's left over failed on the db itself.
+                    written, batch = self._write_each(batch)
+                    self._committed(written, last=not batch)
+                else:
+                    try:
+                        self._write(batch)
+                        self._committed(batch)
+                        break
+                    except Exception:
+                        log.exception('Writing %d api_response rows failed', len(batch))
+                if batch:
+                    failures += 1
+                    if self._stopping.is_set():
+                        return  # rows stay in the journal and are replayed on next start
+                    time.sleep(self.flush_interval)
+
+    def _committed(self, records, last=True):
+        # journals that these rows are in the db (or the dead letter file)
+        with self._journal_lock:
+            if last and self._queue.empty() and not self._unqueued:
+                # nothing else is waiting, so the whole journal is done with
+                self._journal.truncate(0)
+            elif records:
+                self._journal_write(json.dumps({'committed': [r['seq'] for r in records if 'seq' in r]}))
+
+    def _write_each(self, records):
+        # -> (rows written or set aside, rows left because the db itself is failing)
+        for n, record in enumerate(records):
+            try:
+                self._write([record])
+            except (OperationalError, InterfaceError):
+                log.exception('Writing an api_response row failed')
+                return records[:n], records[n:]
+            except Exception as e:
+                log.exception('The db rejected an api_response row; it is kept in %s', self.dead_letter_path)
+                self._dead_letter(record, e)
+        return records, []
+
+    @property
+    def dead_letter_path(self):
+        return os.path.join(self.spill_dir, 'dead_letter.jsonl')
+
+    def _dead_letter(self, record, error):
+        with open(self.dead_letter_path, 'a') as f:
+            f.write(_encode({**record, 'error': str(error)[:1000]}) + '\n')
+        self.dead_lettered += 1
+        # the row will never be saved, so its reservation goes
+        spend_ledger.release(record.get('internal_api_key_id'), record.get('project_id'), record.get('reservation', 0))
+
+    def _write(self, records):
+        # Inserts the rows and adds them to usage_daily and the spend totals in one transaction
+        key_costs, project_costs, reservations = defaultdict(float), defaultdict(float), []
+        started = time.perf_counter()
+        with self.app.app_context():
+            rows = []
+            for record in records:
+                # every row needs the same keys for the executemany
+                r = {c: record.get(c) for c in COLUMNS}
+                r['cached'] = bool(r['cached'])
+                r['hedge'] = bool(r['hedge'])
+                project_id = record.get('project_id')
+                reservations.append((r['internal_api_key_id'], project_id, record.get('reservation', 0)))
+                if r.get('in_cost') is None:
+                    cost = price_index.cost(r['model_name'], r['tokens_in'], r['tokens_out'], r['time_created'])
+                    if cost is not None:
+                        r['in_cost'], r['out_cost'] = cost
+                cost = (r.get('in_cost') or 0) + (r.get('out_cost') or 0)
+                key_costs[r['internal_api_key_id']] += cost
+                if project_id is not None:
+                    project_costs[project_id] += cost
+                rows.append(r)
+            payload_store.offload(rows)
+            db.session.execute(insert(APIResponse), rows)
+            add_to_usage_daily(rollup(rows))
+            if not counters.shared:
+                add_spend(key_costs, project_costs)  # otherwise spend_ledger flushes it
+            db.session.commit()
+        metrics.observe_db_write(time.perf_counter() - started, len(records))
+        self.written += len(records)
+        auth_cache.add_spend(key_costs, project_costs)
+        spend_ledger.settle(key_costs, project_costs, reservations)
+
+    def stop(self):
+        # Graceful drain: let the flusher empty the queue before the worker exits
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopping.set()
+        self._thread.join(self.drain_timeout)
+        if self._thread.is_alive():
+            log.warning('api_response writer did not drain in %ss; %d rows left in the journal',
+                        self.drain_timeout, self._queue.qsize())
+
+    def stats(self):
+        return {'queued': self._queue.qsize() if self._queue else 0,
+                'written': self.written, 'written_sync': self.written_sync, 'dead_lettered': self.dead_lettered}
+
+
+api_response_writer = WriteBehindQueue()